@@ -0,0 +1,185 @@
+"""
+Fingerprinted, precompressed static files and compressed pages.
+
+`flask build-assets` (run by the Dockerfile) copies every file in static/
+to static/dist/ under a name carrying a hash of its content, e.g.
+modern-theme.3f9c0a1b2d4e.css, next to .gz and (with the brotli package)
+.br variants at the highest compression levels, and writes
+static/dist/manifest.json. While that manifest exists,
+url_for('static', filename='modern-theme.css') links to the fingerprinted
+copy, which is served in the best encoding the browser accepts with
+`Cache-Control: public, max-age=31536000, immutable`: a changed file gets a
+new name, so browsers never have to revalidate. Run the command again after
+changing a static file; without a manifest (and in debug mode) the plain
+files are linked and served as before.
+
+HTML and JSON responses of at least COMPRESS_MIN_BYTES (1024) are
+compressed on the fly, with brotli (COMPRESS_BROTLI_QUALITY, 4) or gzip
+(COMPRESS_GZIP_LEVEL, 6) as the browser accepts. Streamed responses and
+files (exports, backups) are sent as they are.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+
+# Encodings in order of preference, with the suffix of their prebuilt files
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+# Images and fonts are compressed already
+PRECOMPRESS_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+def _compress(data, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if level is None else level)
+    # mtime=0 keeps builds of the same file identical
+    return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+
+
+def build_assets(static_folder):
+    """Write the fingerprinted and compressed files and the manifest; returns {source name: file info}"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    files = {}
+    for root, directories, names in os.walk(static_folder):
+        if root == static_folder and DIST_DIR in directories:
+            directories.remove(DIST_DIR)
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            source = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            mimetype = mimetypes.guess_type(name)[0]
+            # Skips backups and other files a browser is never sent
+            if mimetype is None:
+                continue
+            with open(path, 'rb') as fileobj:
+                data = fileobj.read()
+            stem, extension = os.path.splitext(source)
+            target = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+            os.makedirs(os.path.dirname(os.path.join(dist, target)), exist_ok=True)
+            with open(os.path.join(dist, target), 'wb') as fileobj:
+                fileobj.write(data)
+
+            encodings = []
+            if mimetype.startswith(PRECOMPRESS_TYPES):
+                for encoding, suffix in ENCODINGS:
+                    if encoding == 'br' and brotli is None:
+                        continue
+                    compressed = _compress(data, encoding)
+                    if len(compressed) < len(data):
+                        with open(os.path.join(dist, target + suffix), 'wb') as fileobj:
+                            fileobj.write(compressed)
+                        encodings.append(encoding)
+            files[source] = {'path': target, 'bytes': len(data), 'encodings': encodings}
+
+    with open(os.path.join(dist, MANIFEST), 'w') as fileobj:
+        json.dump({'files': files}, fileobj, indent=2, sort_keys=True)
+    return files
+
+
+def load_manifest(static_folder):
+    """The build's {source name: file info}, or None when nothing was built"""
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as fileobj:
+            return json.load(fileobj)['files']
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f'Ignoring the static file manifest, serving the plain files: {e}')
+        return None
+
+
+def _accepted(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def init_assets(app):
+    """Link fingerprinted static files, serve them precompressed and compress pages"""
+    manifest = load_manifest(app.static_folder) or {}
+    # Fingerprinted path -> its encodings
+    built = {f'{DIST_DIR}/{info["path"]}': info['encodings'] for info in manifest.values()}
+    if manifest:
+        logging.info(f'Serving {len(manifest)} fingerprinted static files')
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == 'static' and not app.debug:
+            info = manifest.get(values.get('filename'))
+            if info is not None:
+                values['filename'] = f'{DIST_DIR}/{info["path"]}'
+
+    def static(filename):
+        encodings = built.get(filename)
+        if encodings is None:
+            return app.send_static_file(filename)
+        directory = os.path.join(app.static_folder, DIST_DIR)
+        name = filename[len(DIST_DIR) + 1:]
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and _accepted(encoding):
+                response = send_from_directory(directory, name + suffix, mimetype=mimetypes.guess_type(name)[0],
+                                               download_name=os.path.basename(name), max_age=IMMUTABLE_MAX_AGE)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(directory, name, max_age=IMMUTABLE_MAX_AGE)
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+                or response.status_code in (204, 206, 304) or request.method == 'HEAD'
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = next((encoding for encoding, _ in ENCODINGS
+                         if (encoding != 'br' or brotli is not None) and _accepted(encoding)), None)
+        data = response.get_data()
+        if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+            return response
+        level = COMPRESS_BROTLI_QUALITY if encoding == 'br' else COMPRESS_GZIP_LEVEL
+        response.set_data(_compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        # A strong ETag names the uncompressed bytes
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and precompress the static files"""
+    files = build_assets(current_app.static_folder)
+    if brotli is None:
+        click.echo('brotli is not installed; only gzip variants were written.')
+    dist = os.path.join(current_app.static_folder, DIST_DIR)
+    for source, info in sorted(files.items()):
+        sizes = ''.join(f', {encoding} {os.path.getsize(os.path.join(dist, info["path"] + suffix))}'
+                        for encoding, suffix in ENCODINGS if encoding in info['encodings'])
+        click.echo(f'{source:24} -> {DIST_DIR}/{info["path"]}  {info["bytes"]} bytes{sizes}')
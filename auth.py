@@ -18,6 +18,9 @@ def login():
         user = User.query.filter_by(username=username).first()
         
         if user and check_password_hash(user.password_hash, password):
+            if not user.is_active:
+                flash('This account has been deactivated.', 'error')
+                return render_template('login.html')
             login_user(user)
             next_page = request.args.get('next')
             if next_page:
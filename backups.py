@@ -0,0 +1,177 @@
+"""
+Streaming backups in gzip-compressed NDJSON.
+
+A backup is one JSON document per line, written a table at a time in
+foreign key order and gzip-compressed as it is produced:
+
+    {"type": "header", "format": "battery-erp-ndjson", "version": 1, "created_at": ..., "tables": [...]}
+    {"type": "table", "table": "customer", "columns": ["id", "name", ...]}
+    [1, "Ravi", ...]                      <- one JSON array per row, in column order
+    {"type": "table_end", "table": "customer", "rows": 1234, "sha256": "..."}
+    ...
+    {"type": "manifest", "tables": {"customer": {"rows": 1234, "sha256": "..."}, ...}}
+
+The sha256 of a table covers its row lines exactly as written (UTF-8, with
+the trailing newline). Rows are read with `yield_per` on a connection of
+their own (REPEATABLE READ on PostgreSQL, so all tables come from one
+snapshot), so memory use does not grow with the database. Password hashes
+are left out, as before.
+
+Every backup records a watermark (the time it started). An incremental
+backup made "since" an earlier backup's watermark holds only the rows of the
+change-tracked tables (models.CHANGE_TRACKED_MODELS) whose changed_at is
+newer, the tombstones of rows deleted since, and the small untracked tables
+in full. The window starts CHANGE_OVERLAP before the watermark so rows
+written by transactions still open when the previous backup started are not
+missed; replaying a row twice is harmless because increments are upserted.
+"""
+import gzip
+import hashlib
+import json
+from datetime import datetime, date, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from app import db
+from models import CHANGE_TRACKED_MODELS, DeletedRow, get_indian_now
+from exports import encode_stream
+
+BACKUP_FORMAT = 'battery-erp-ndjson'
+BACKUP_VERSION = 1
+BACKUP_BATCH_SIZE = 2000
+CHUNK_SIZE = 64 * 1024
+CHANGE_OVERLAP = timedelta(minutes=10)
+
+# Columns never written to a backup
+EXCLUDED_COLUMNS = {
+    'user': {'password_hash'},
+}
+
+# Tables never written to a backup (their rows are meaningless elsewhere)
+EXCLUDED_TABLES = {'background_job'}
+
+
+def backup_tables():
+    """Every mapped table, parents before children"""
+    return [table for table in db.metadata.sorted_tables if table.name not in EXCLUDED_TABLES]
+
+
+def backup_columns(table):
+    excluded = EXCLUDED_COLUMNS.get(table.name, set())
+    return [column for column in table.columns if column.name not in excluded]
+
+
+def changed_since_filter(table, since):
+    """WHERE clause limiting an incremental backup of table, or None for all rows"""
+    if table.name in {model.__table__.name for model in CHANGE_TRACKED_MODELS}:
+        return table.c.changed_at >= since - CHANGE_OVERLAP
+    if table.name == DeletedRow.__table__.name:
+        return table.c.deleted_at >= since - CHANGE_OVERLAP
+    return None
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dump_line(value):
+    return json.dumps(value, separators=(',', ':'), default=_json_default) + '\n'
+
+
+def backup_lines(engine=None, since=None):
+    """Yield the backup as NDJSON text, a chunk at a time.
+
+    With since (an earlier backup's watermark) the backup is incremental.
+    """
+    engine = engine or db.engine
+    tables = backup_tables()
+    manifest = {}
+    options = {'isolation_level': 'REPEATABLE READ'} if engine.dialect.name == 'postgresql' else {}
+
+    header = {
+        'type': 'header',
+        'format': BACKUP_FORMAT,
+        'version': BACKUP_VERSION,
+        'created_at': datetime.now().isoformat(),
+        'kind': 'incremental' if since else 'full',
+        'watermark': get_indian_now().isoformat(),
+        'tables': [table.name for table in tables],
+    }
+    if since:
+        header['since'] = since.isoformat()
+    yield dump_line(header)
+
+    with engine.connect().execution_options(**options) as connection:
+        for table in tables:
+            columns = backup_columns(table)
+            yield dump_line({'type': 'table', 'table': table.name, 'columns': [column.name for column in columns]})
+
+            checksum = hashlib.sha256()
+            rows = 0
+            buffer = []
+            size = 0
+            query = select(*columns).order_by(*table.primary_key.columns) \
+                .execution_options(yield_per=BACKUP_BATCH_SIZE)
+            changed = changed_since_filter(table, since) if since else None
+            if changed is not None:
+                query = query.where(changed)
+            result = connection.execute(query)
+            for row in result:
+                line = dump_line(list(row))
+                checksum.update(line.encode('utf-8'))
+                rows += 1
+                buffer.append(line)
+                size += len(line)
+                if size >= CHUNK_SIZE:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+            if buffer:
+                yield ''.join(buffer)
+
+            manifest[table.name] = {'rows': rows, 'sha256': checksum.hexdigest()}
+            yield dump_line({'type': 'table_end', 'table': table.name, **manifest[table.name]})
+        connection.rollback()
+
+    yield dump_line({'type': 'manifest', 'tables': manifest})
+
+
+def backup_stream(engine=None, since=None):
+    """The gzip-compressed backup as a stream of bytes"""
+    return encode_stream(backup_lines(engine, since), compress=True)
+
+
+def backup_filename(incremental=False):
+    kind = 'incremental' if incremental else 'backup'
+    return f'battery_erp_{kind}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.ndjson.gz'
+
+
+def backup_watermark(path):
+    """The watermark in the header of an existing backup file"""
+    with open(path, 'rb') as fileobj:
+        compressed = fileobj.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rt', encoding='utf-8') if compressed else open(path, encoding='utf-8')) as lines:
+        try:
+            header = json.loads(lines.readline())
+        except ValueError:
+            header = None
+    if not isinstance(header, dict) or header.get('format') != BACKUP_FORMAT or not header.get('watermark'):
+        raise click.ClickException(f'{path} is not a backup with a watermark')
+    return datetime.fromisoformat(header['watermark'])
+
+
+@click.command('backup')
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--since-backup', type=click.Path(exists=True, dir_okay=False),
+              help='Write an incremental backup of the changes since this earlier backup.')
+@with_appcontext
+def backup_command(output, since_backup):
+    """Write a full (or incremental) gzip NDJSON backup to OUTPUT"""
+    since = backup_watermark(since_backup) if since_backup else None
+    with open(output, 'wb') as fileobj:
+        for chunk in backup_stream(since=since):
+            fileobj.write(chunk)
+    kind = f'Incremental backup since {since.isoformat()}' if since else 'Full backup'
+    click.echo(f'{kind} written to {output}')
@@ -0,0 +1,215 @@
+"""
+Concurrency-safe battery ID allocation.
+
+The next battery number lives in a single id_counter row. Numbers are
+reserved with one atomic `UPDATE ... SET next_value = next_value + n
+RETURNING next_value`, in a short transaction of their own, so the row lock
+is held for microseconds and two counters registering batteries at once can
+never get the same number. Like a database sequence, a number reserved by an
+intake that later fails is not reused.
+
+Each worker process can reserve numbers in blocks (BATTERY_ID_BLOCK_SIZE,
+default 1 so IDs stay in registration order) and hand them out without
+touching the database. Bulk intake takes a whole block at once with `take()`.
+
+IDs are formatted with the battery_id_prefix and battery_id_padding settings
+at allocation time, and the counter never goes below battery_id_start.
+
+Reservations commit on their own connection: call the allocator before the
+request's session writes anything, or SQLite will wait on its own lock.
+"""
+import os
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, case, insert, delete
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import IdCounter, Battery, Customer, SystemSettings
+
+COUNTER_NAME = 'battery'
+
+
+def id_settings():
+    """(prefix, start, padding) from the system settings"""
+    prefix = SystemSettings.get_setting('battery_id_prefix', 'BAT')
+    start = int(SystemSettings.get_setting('battery_id_start', '1') or 1)
+    padding = int(SystemSettings.get_setting('battery_id_padding', '4') or 4)
+    return prefix, start, padding
+
+
+def format_battery_id(number, prefix=None, padding=None):
+    if prefix is None or padding is None:
+        prefix, _, padding = id_settings()
+    return f"{prefix}{number:0{padding}d}"
+
+
+def highest_existing_number(connection, prefix):
+    """Largest numeric suffix among stored battery IDs that use prefix"""
+    highest = 0
+    ids = connection.execute(select(Battery.battery_id).where(Battery.battery_id.startswith(prefix, autoescape=True)))
+    for (battery_id,) in ids:
+        suffix = battery_id[len(prefix):]
+        if suffix.isdigit():
+            highest = max(highest, int(suffix))
+    return highest
+
+
+def sync_counter(connection):
+    """Move the counter past every stored battery ID (startup, after a restore)"""
+    prefix, start, _ = id_settings()
+    floor = max(highest_existing_number(connection, prefix) + 1, start)
+    table = IdCounter.__table__
+    updated = connection.execute(
+        table.update().where(table.c.name == COUNTER_NAME, table.c.next_value < floor).values(next_value=floor)
+    )
+    if updated.rowcount == 0 and connection.execute(
+            select(table.c.name).where(table.c.name == COUNTER_NAME)).first() is None:
+        connection.execute(insert(table).values(name=COUNTER_NAME, next_value=floor))
+
+
+def ensure_battery_id_counter():
+    """Create the counter row on first run, starting after the existing batteries"""
+    with db.engine.begin() as connection:
+        if connection.execute(select(IdCounter.name).where(IdCounter.name == COUNTER_NAME)).first() is None:
+            sync_counter(connection)
+
+
+def reserve_block(count):
+    """Reserve count consecutive numbers and return the first one"""
+    _, start, _ = id_settings()
+    table = IdCounter.__table__
+    current = table.c.next_value
+    for attempt in range(2):
+        with db.engine.begin() as connection:
+            new_value = connection.execute(
+                table.update().where(table.c.name == COUNTER_NAME)
+                .values(next_value=case((current < start, start), else_=current) + count)
+                .returning(table.c.next_value)
+            ).scalar()
+            if new_value is not None:
+                return new_value - count
+        # Counter row missing (e.g. deleted by hand); recreate it and retry
+        try:
+            ensure_battery_id_counter()
+        except IntegrityError:
+            pass
+    raise RuntimeError('Could not reserve battery IDs: id_counter row is missing')
+
+
+class BatteryIdAllocator:
+    """Hands out battery IDs from a block of numbers reserved for this process"""
+
+    def __init__(self, block_size=1):
+        self.block_size = max(int(block_size), 1)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._pid = None
+
+    def _numbers(self, count):
+        with self._lock:
+            # A block reserved before a fork (gunicorn --preload) belongs to the parent only
+            if self._pid != os.getpid():
+                self._next = self._end = 0
+                self._pid = os.getpid()
+            if self._end - self._next >= count:
+                first = self._next
+                self._next += count
+                return list(range(first, first + count))
+            if count >= self.block_size:
+                # Larger than a block: reserve exactly what was asked for, keep the pool
+                first = reserve_block(count)
+                return list(range(first, first + count))
+            numbers = list(range(self._next, self._end))
+            first = reserve_block(self.block_size)
+            needed = count - len(numbers)
+            numbers.extend(range(first, first + needed))
+            self._next, self._end = first + needed, first + self.block_size
+            return numbers
+
+    def take(self, count):
+        """Allocate count battery IDs, e.g. for a bulk intake"""
+        if count <= 0:
+            return []
+        prefix, _, padding = id_settings()
+        return [format_battery_id(number, prefix, padding) for number in self._numbers(count)]
+
+    def next_id(self):
+        return self.take(1)[0]
+
+    def discard(self):
+        """Drop the numbers held by this process (after a restore)"""
+        with self._lock:
+            self._next = self._end = 0
+
+
+battery_ids = BatteryIdAllocator(os.environ.get('BATTERY_ID_BLOCK_SIZE', 1))
+
+
+@click.command('stress-battery-ids')
+@click.option('--threads', default=8, help='Concurrent registering threads.')
+@click.option('--per-thread', default=500, help='Batteries registered by each thread.')
+@click.option('--block-size', default=1, help='Numbers each thread reserves at a time, like one worker process.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+@with_appcontext
+def stress_battery_ids_command(threads, per_thread, block_size, yes):
+    """Register batteries from many threads at once and check for ID collisions.
+
+    The batteries are deleted again afterwards, but the numbers they used are
+    not handed out again, so real IDs will skip ahead.
+    """
+    import time
+
+    total = threads * per_thread
+    if not yes:
+        click.confirm(f'This registers and then deletes {total} batteries and advances the battery ID '
+                      f'counter by {total}. Continue?', abort=True)
+
+    app = current_app._get_current_object()
+    customer = Customer(name='ID stress test', mobile='0000000000')
+    db.session.add(customer)
+    db.session.commit()
+    customer_id = customer.id
+
+    registered = []
+    errors = []
+
+    def register(worker):
+        allocator = BatteryIdAllocator(block_size)
+        with app.app_context():
+            for _ in range(per_thread):
+                try:
+                    battery = Battery(battery_id=allocator.next_id(), customer_id=customer_id,
+                                      battery_type='Stress test', voltage='12V', capacity='1Ah')
+                    db.session.add(battery)
+                    db.session.commit()
+                    registered.append(battery.battery_id)
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(f'thread {worker}: {e}')
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=register, args=(worker,)) for worker in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    try:
+        db.session.execute(delete(Battery).where(Battery.customer_id == customer_id))
+        db.session.execute(delete(Customer).where(Customer.id == customer_id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f'Could not remove the stress test batteries of customer {customer_id}: {e}')
+
+    duplicates = len(registered) - len(set(registered))
+    click.echo(f'{len(registered)}/{total} batteries registered by {threads} threads in {elapsed:.2f}s '
+               f'({len(registered) / elapsed:.0f}/s), {duplicates} duplicate IDs, {len(errors)} errors.')
+    for error in errors[:10]:
+        click.echo(f'  {error}')
+    if duplicates or errors or len(registered) != total:
+        raise SystemExit(1)
@@ -0,0 +1,234 @@
+"""
+Page benchmarks through the Flask test client.
+
+`flask benchmark-routes` times the pages that slow down with data:
+- the dashboard, the technician panel (IDs only and with every open
+  battery's details) and search by name, mobile and battery ID;
+- a late page of all batteries, the yearly report and the inventory pages;
+- the CSV export, backup and yearly report download jobs, each from the
+  click through to the finished file.
+
+Every case gets warm-up requests before the timed rounds. Each request
+gets its own database session, as it would in the server. Results record
+min/median/mean/max, the median template render time (from the
+Server-Timing header), the query count and the response (or artifact)
+size.
+
+They are written as JSON under instance/benchmarks/ (or --output) with the
+commit, database dialect and battery count. `--compare old.json` prints the
+change per case and exits with 1 when a median got more than
+--max-regression slower. Run the same command against SQLite and a local
+PostgreSQL (DATABASE_URL) to compare the two.
+
+Use a scratch database: --batteries tops it up with `generate-data` rows,
+and the benchmark itself leaves a few finished jobs' worth of writes behind
+(the jobs are deleted again).
+"""
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, func
+from app import db
+from models import User, Customer, Battery, BackgroundJob, get_indian_now
+
+# (name, path, form data or None for a GET, whether the request starts a background job)
+# Paths are formatted with the sample values picked by _sample_terms().
+BENCHMARK_CASES = [
+    ('dashboard', '/dashboard', None, False),
+    ('technician_panel', '/technician/panel', None, False),
+    ('technician_panel_details', '/technician/panel', {'search_query': ''}, False),
+    ('search_name', '/search', {'search_query': '{name}'}, False),
+    ('search_mobile', '/search', {'search_query': '{mobile}'}, False),
+    ('search_battery_id', '/search', {'search_query': '{battery_id}'}, False),
+    ('all_batteries', '/all_batteries?page=2', None, False),
+    ('yearly_report', '/reports/yearly', None, False),
+    ('inventory_dashboard', '/inventory/dashboard', None, False),
+    ('inventory_items', '/inventory/items', None, False),
+    ('inventory_transactions', '/inventory/transactions', None, False),
+    ('export_csv', '/export/csv', None, True),
+    ('admin_backup', '/admin/backup', None, True),
+    ('yearly_report_download', '/reports/yearly/download', None, True),
+]
+
+SERVER_TIMING_RENDER = re.compile(r'\brender;dur=([\d.]+)')
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short=12', 'HEAD'], cwd=current_app.root_path,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _sample_terms():
+    """Search terms for a customer from the middle of the table"""
+    customers = db.session.execute(select(func.count(Customer.id))).scalar()
+    customer = db.session.execute(select(Customer).order_by(Customer.id).offset(customers // 2).limit(1)).scalar()
+    battery_id = db.session.execute(
+        select(Battery.battery_id).where(Battery.customer_id == customer.id).limit(1)).scalar()
+    terms = {'name': customer.name, 'mobile': customer.mobile_normalized or customer.mobile,
+             'battery_id': battery_id or ''}
+    db.session.remove()
+    return terms
+
+
+def _finish_job(response):
+    """Run the job a request queued, as the worker would, and delete it again; returns its file size"""
+    from jobs import claim_next_job, run_job
+    job_id = int(response.headers['Location'].rstrip('/').split('/')[-1])
+    claimed = claim_next_job('benchmark')
+    if claimed != job_id:
+        raise click.ClickException(f'Another job ({claimed}) was queued; stop the job worker and retry.')
+    run_job(job_id)
+    job = db.session.get(BackgroundJob, job_id)
+    status, error, path, size = job.status, job.error, job.artifact_path, job.artifact_size
+    db.session.delete(job)
+    db.session.commit()
+    if path and os.path.exists(path):
+        os.remove(path)
+    if status != 'done':
+        raise click.ClickException(f'Job {job_id} {status}: {error}')
+    return size
+
+
+def run_benchmarks(cases, rounds=5, warmup=1):
+    """Time each case; returns {name: result}"""
+    queries = []
+
+    def count_query(*args):
+        queries.append(1)
+
+    client = current_app.test_client()
+    admin_id = db.session.execute(select(User.id).where(User.role == 'admin').limit(1)).scalar()
+    if admin_id is None:
+        raise click.ClickException('No admin user; run `flask seed` first.')
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+    terms = _sample_terms()
+
+    results = {}
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    try:
+        for name, path, data, is_job in cases:
+            if data is not None:
+                data = {key: value.format(**terms) for key, value in data.items()}
+            timings = []
+            render_timings = []
+            for round_number in range(warmup + rounds):
+                queries.clear()
+                started = time.perf_counter()
+                response = client.open(path, method='GET' if data is None else 'POST', data=data)
+                expected = 302 if is_job else 200
+                if response.status_code != expected:
+                    raise click.ClickException(f'{name}: HTTP {response.status_code} (expected {expected})')
+                size = _finish_job(response) if is_job else len(response.data)
+                elapsed = (time.perf_counter() - started) * 1000
+                render = SERVER_TIMING_RENDER.search(response.headers.get('Server-Timing', ''))
+                # Each request gets a fresh session, as it would in the server
+                db.session.remove()
+                if round_number >= warmup:
+                    timings.append(elapsed)
+                    render_timings.append(float(render.group(1)) if render else 0.0)
+            results[name] = {
+                'rounds': rounds,
+                'min_ms': round(min(timings), 2),
+                'median_ms': round(statistics.median(timings), 2),
+                'mean_ms': round(statistics.mean(timings), 2),
+                'max_ms': round(max(timings), 2),
+                'stdev_ms': round(statistics.stdev(timings), 2) if len(timings) > 1 else 0.0,
+                'render_median_ms': round(statistics.median(render_timings), 2),
+                'queries': len(queries),
+                'bytes': size,
+            }
+            click.echo(f'{name:24} median {results[name]["median_ms"]:9.1f} ms  min {results[name]["min_ms"]:9.1f} ms  '
+                       f'render {results[name]["render_median_ms"]:7.1f} ms  {len(queries):4} queries  {size:10} bytes')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+    return results
+
+
+def compare_results(baseline, current, max_regression, min_ms=5.0):
+    """Print the change per case; returns the names that regressed"""
+    regressed = []
+    click.echo(f'Compared with {baseline.get("commit")} ({baseline.get("dialect")}, '
+               f'{baseline.get("batteries")} batteries):')
+    for name, result in current['cases'].items():
+        before = baseline['cases'].get(name)
+        if before is None:
+            click.echo(f'  {name:24} new')
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else 1.0
+        # Ignore jitter on pages that take a few milliseconds either way
+        slower = ratio > 1 + max_regression and result['median_ms'] - before['median_ms'] > min_ms
+        # Results from before render times were recorded have none
+        render = (f'render {before["render_median_ms"]:.1f} -> {result["render_median_ms"]:.1f} ms  '
+                  if 'render_median_ms' in before else '')
+        click.echo(f'  {name:24} {before["median_ms"]:9.1f} -> {result["median_ms"]:9.1f} ms  {ratio:5.2f}x  '
+                   f'{render}queries {before["queries"]} -> {result["queries"]}{"  SLOWER" if slower else ""}')
+        if slower:
+            regressed.append(name)
+    return regressed
+
+
+@click.command('benchmark-routes')
+@click.option('--batteries', default=0, help='Top the database up to this many batteries with generated data first.')
+@click.option('--rounds', default=5, help='Timed requests per case.')
+@click.option('--warmup', default=1, help='Untimed requests per case first.')
+@click.option('--only', default='', help='Comma separated case names to run.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Results file (default: instance/benchmarks/).')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False),
+              help='Earlier results to compare with.')
+@click.option('--max-regression', default=0.2, help='Allowed median slowdown when comparing (0.2 = 20%).')
+@with_appcontext
+def benchmark_routes_command(batteries, rounds, warmup, only, output, baseline_path, max_regression):
+    """Time the heavy pages and jobs and store the results as JSON"""
+    from datagen import populate
+    cases = BENCHMARK_CASES
+    if only:
+        names = set(only.split(','))
+        unknown = names - {case[0] for case in cases}
+        if unknown:
+            raise click.BadParameter(f'unknown case(s) {", ".join(sorted(unknown))}', param_hint='--only')
+        cases = [case for case in cases if case[0] in names]
+
+    existing = db.session.execute(select(func.count(Battery.id))).scalar()
+    if batteries > existing:
+        click.echo(f'Generating {batteries - existing} batteries...')
+        populate(batteries - existing)
+    count = db.session.execute(select(func.count(Battery.id))).scalar()
+    dialect = db.engine.dialect.name
+    click.echo(f'Benchmarking on {dialect} with {count} batteries, {rounds} rounds per case')
+
+    results = {
+        'commit': _git_commit(),
+        'dialect': dialect,
+        'batteries': count,
+        'created_at': get_indian_now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cases': run_benchmarks(cases, rounds, warmup),
+    }
+    if not output:
+        directory = os.path.join(current_app.instance_path, 'benchmarks')
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f'{get_indian_now():%Y%m%d_%H%M%S}-{results["commit"] or "unknown"}-'
+                                         f'{dialect}.json')
+    with open(output, 'w') as fileobj:
+        json.dump(results, fileobj, indent=2)
+    click.echo(f'Results written to {output}')
+
+    if baseline_path:
+        with open(baseline_path) as fileobj:
+            baseline = json.load(fileobj)
+        regressed = compare_results(baseline, results, max_regression)
+        if regressed:
+            click.echo(f'{len(regressed)} case(s) got slower: {", ".join(regressed)}')
+            raise SystemExit(1)
@@ -0,0 +1,146 @@
+"""
+Database setup, kept out of import time.
+
+`flask init-db` applies the pending schema migrations (see migrations.py);
+`flask seed` adds the default users, settings, counters and the
+battery ID counter row. Both are idempotent and run before the web server
+starts (see the Dockerfile), so importing the app, booting a worker or
+running any other CLI command never touches the database.
+
+`flask benchmark-startup` measures how long a fresh worker process takes
+from importing the app to its first response.
+"""
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+
+
+def init_db():
+    """Create and upgrade the schema"""
+    from migrations import apply_migrations
+    if db.engine.dialect.name == 'sqlite':
+        # Persistent; lets the job worker record progress while a long export is reading
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+    return apply_migrations()
+
+
+def seed_database():
+    """Initialize database with default users and settings"""
+    from models import User, SystemSettings
+    from werkzeug.security import generate_password_hash
+
+    # Create default users if they don't exist
+    if not User.query.filter_by(username='admin').first():
+        admin_user = User()
+        admin_user.username = 'admin'
+        admin_user.password_hash = generate_password_hash('admin123')
+        admin_user.role = 'admin'
+        admin_user.full_name = 'Administrator'
+        db.session.add(admin_user)
+
+    if not User.query.filter_by(username='staff').first():
+        staff_user = User()
+        staff_user.username = 'staff'
+        staff_user.password_hash = generate_password_hash('staff123')
+        staff_user.role = 'shop_staff'
+        staff_user.full_name = 'Shop Staff'
+        db.session.add(staff_user)
+
+    if not User.query.filter_by(username='technician').first():
+        tech_user = User()
+        tech_user.username = 'technician'
+        tech_user.password_hash = generate_password_hash('tech123')
+        tech_user.role = 'technician'
+        tech_user.full_name = 'Technician'
+        db.session.add(tech_user)
+
+    # Initialize system settings
+    default_settings = [
+        ('shop_name', 'Battery Repair Service'),
+        ('battery_id_prefix', 'BAT'),
+        ('battery_id_start', '1'),
+        ('battery_id_padding', '4')
+    ]
+
+    for key, value in default_settings:
+        if not SystemSettings.query.filter_by(setting_key=key).first():
+            setting = SystemSettings()
+            setting.setting_key = key
+            setting.setting_value = value
+            db.session.add(setting)
+
+    # Populate the dashboard counters and report rollups on first run
+    from counters import ensure_counters
+    ensure_counters()
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        logging.error(f"Error creating default users and settings: {e}")
+        db.session.rollback()
+        raise
+
+    from battery_ids import ensure_battery_id_counter
+    ensure_battery_id_counter()
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Apply pending schema migrations"""
+    applied = init_db()
+    click.echo(f'Applied {len(applied)} migration(s); database schema is up to date ({db.engine.dialect.name}).')
+
+
+@click.command('seed')
+@with_appcontext
+def seed_command():
+    """Add the default users, settings and counters if they are missing"""
+    seed_database()
+    click.echo('Default users, settings and counters are in place.')
+
+
+STARTUP_PROBE = '''
+import json, time
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+response = app.test_client().get('/login')
+print(json.dumps({'import': imported - started, 'first_response': time.perf_counter() - imported,
+                  'status': response.status_code}))
+'''
+
+
+@click.command('benchmark-startup')
+@click.option('--runs', default=5, help='Fresh worker processes to time.')
+@click.option('--init-on-startup', is_flag=True,
+              help='Also run init-db and seed at import (INIT_DB_ON_STARTUP=1), as the app used to.')
+@with_appcontext
+def benchmark_startup_command(runs, init_on_startup):
+    """Time import-to-first-response of a fresh worker process"""
+    env = dict(os.environ, INIT_DB_ON_STARTUP='1' if init_on_startup else '0')
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=current_app.root_path, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise click.ClickException(f'Worker failed to start:\n{result.stderr[-2000:]}')
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        if sample['status'] != 200:
+            raise click.ClickException(f'First response was HTTP {sample["status"]}')
+        samples.append(sample)
+
+    for name in ['import', 'first_response']:
+        values = [sample[name] * 1000 for sample in samples]
+        click.echo(f'{name:15} median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms')
+    totals = [(sample['import'] + sample['first_response']) * 1000 for sample in samples]
+    click.echo(f'{"total":15} median {statistics.median(totals):8.1f} ms   max {max(totals):8.1f} ms'
+               f'   ({runs} runs, {db.engine.dialect.name})')
@@ -0,0 +1,327 @@
+"""
+Incrementally maintained battery counters and monthly rollups.
+
+The dashboard reads its totals from the battery_status_counter table and the
+reports read the monthly_status_rollup table (keyed by inward year, month and
+status) instead of scanning the whole battery table. Every route that creates
+a battery or changes its status (or prices) records the change here in the
+same transaction, and `flask rebuild-counters` recomputes everything from
+scratch. The same calls feed the intake, status and delivery counters of
+/metrics once the transaction commits.
+"""
+from datetime import datetime
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, case, extract, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from models import Battery, BatteryStatusCounter, MonthlyStatusRollup
+from metrics import BATTERIES_REGISTERED, STATUS_TRANSITIONS, DELIVERIES, count_on_commit
+
+COMPLETED_STATUSES = ['Delivered', 'Returned']
+PENDING_STATUSES = ['Received', 'Pending']
+
+ROLLUP_COLUMNS = ('battery_count', 'service_revenue', 'pickup_revenue')
+COUNTER_COLUMNS = ROLLUP_COLUMNS + ('priced_count', 'priced_total')
+
+
+def battery_snapshot(battery):
+    """Capture the counter-relevant state of a battery (call before modifying it)"""
+    pickup = (battery.pickup_charge or 0.0) if battery.is_pickup else 0.0
+    # What AVG(service_price + pickup_charge) counts: every battery with both set, pickup or not
+    priced = None if battery.service_price is None or battery.pickup_charge is None \
+        else battery.service_price + battery.pickup_charge
+    inward = battery.inward_date
+    return (battery.status, battery.service_price or 0.0, pickup, priced,
+            inward.year if inward else None, inward.month if inward else None)
+
+
+def _increment(model, keys, values):
+    """Atomically add values ({column: amount}, negative to remove batteries) to one counter row"""
+    table = model.__table__
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = dialect_insert(model).values(**keys, **values)
+        # Concurrent first increments of a row both land instead of one failing on the primary key
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: table.c[column] + statement.excluded[column] for column in values}
+        ))
+        return
+
+    result = db.session.execute(
+        table.update().where(*[table.c[key] == value for key, value in keys.items()]).values(
+            {column: table.c[column] + amount for column, amount in values.items()}
+        )
+    )
+    if result.rowcount == 0:
+        # First battery ever counted in this row
+        db.session.add(model(**keys, **values))
+        db.session.flush()
+
+
+def _deltas(snapshot, sign):
+    """(model, keys, values) of every counter row a battery is counted in"""
+    status, service, pickup, priced, year, month = snapshot
+    values = {'battery_count': sign, 'service_revenue': sign * service, 'pickup_revenue': sign * pickup}
+    yield BatteryStatusCounter, (('status', status),), dict(
+        values, priced_count=sign if priced is not None else 0, priced_total=sign * (priced or 0.0))
+    if year is not None:
+        yield MonthlyStatusRollup, (('year', year), ('month', month), ('status', status)), values
+
+
+def _adjust(snapshot, sign):
+    for model, keys, values in _deltas(snapshot, sign):
+        _increment(model, dict(keys), values)
+
+
+def record_new_battery(battery):
+    """Count a newly registered battery (call after flushing it)"""
+    _adjust(battery_snapshot(battery), 1)
+    count_on_commit(db.session, BATTERIES_REGISTERED)
+
+
+def record_new_batteries(snapshots):
+    """Count a batch of new batteries with one update per counter row touched"""
+    totals = {}
+    for snapshot in snapshots:
+        for model, keys, values in _deltas(snapshot, 1):
+            row = totals.setdefault((model, keys), dict.fromkeys(values, 0))
+            for column, amount in values.items():
+                row[column] += amount
+    for (model, keys), values in totals.items():
+        _increment(model, dict(keys), values)
+    registered = sum(values['battery_count'] for (model, _), values in totals.items() if model is BatteryStatusCounter)
+    if registered:
+        count_on_commit(db.session, BATTERIES_REGISTERED, registered)
+
+
+def record_transition(before, battery):
+    """Move a battery between counter rows after a status and/or price change"""
+    after = battery_snapshot(battery)
+    if before == after:
+        return
+    _adjust(before, -1)
+    _adjust(after, 1)
+    if before[0] != after[0]:
+        count_on_commit(db.session, STATUS_TRANSITIONS, from_status=before[0], to_status=after[0])
+        if after[0] in COMPLETED_STATUSES:
+            count_on_commit(db.session, DELIVERIES, outcome=after[0].lower())
+
+
+def get_dashboard_totals():
+    """Read the dashboard statistics from the counter table in a single query"""
+    rows = {row.status: row for row in BatteryStatusCounter.query.all()}
+
+    def count(*statuses):
+        return sum(rows[s].battery_count for s in statuses if s in rows)
+
+    completed = count(*COMPLETED_STATUSES)
+    service_revenue = sum(rows[s].service_revenue for s in COMPLETED_STATUSES if s in rows)
+    pickup_revenue = sum(rows[s].pickup_revenue for s in COMPLETED_STATUSES if s in rows)
+    total_revenue = service_revenue + pickup_revenue
+    priced_count = sum(rows[s].priced_count or 0 for s in COMPLETED_STATUSES if s in rows)
+    priced_total = sum(rows[s].priced_total or 0.0 for s in COMPLETED_STATUSES if s in rows)
+
+    return {
+        'total_batteries': sum(row.battery_count for row in rows.values()),
+        'pending_batteries': count(*PENDING_STATUSES),
+        'ready_batteries': count('Ready'),
+        'completed_batteries': completed,
+        'not_repairable_batteries': count('Not Repairable'),
+        'total_revenue': float(total_revenue),
+        'avg_service_price': float(priced_total / priced_count) if priced_count else 0.0,
+    }
+
+
+def _summarize(rows):
+    completed = [row for row in rows if row.status in COMPLETED_STATUSES]
+    return {
+        'count': sum(row.battery_count for row in rows),
+        'completed_count': sum(row.battery_count for row in completed),
+        'revenue': float(sum(row.service_revenue + row.pickup_revenue for row in completed)),
+    }
+
+
+def get_month_totals(year, month):
+    """Battery count, completed count and revenue for one inward month"""
+    return _summarize(MonthlyStatusRollup.query.filter_by(year=year, month=month).all())
+
+
+def get_year_breakdown(year):
+    """Yearly totals plus a twelve-month breakdown, read in a single query"""
+    rows = MonthlyStatusRollup.query.filter_by(year=year).all()
+    breakdown = []
+    for month in range(1, 13):
+        totals = _summarize([row for row in rows if row.month == month])
+        breakdown.append({
+            'month': datetime(year, month, 1).strftime('%B'),
+            'revenue': totals['revenue'],
+            'count': totals['completed_count'],
+        })
+    return _summarize(rows), breakdown
+
+
+def _aggregates():
+    return (
+        func.count(Battery.id),
+        func.coalesce(func.sum(Battery.service_price), 0),
+        func.coalesce(func.sum(case((Battery.is_pickup == True, Battery.pickup_charge), else_=0)), 0),
+    )
+
+
+def compute_counters():
+    """Recompute the per-status counters from the battery table"""
+    priced = Battery.service_price + Battery.pickup_charge
+    rows = db.session.query(Battery.status, *_aggregates(), func.count(priced),
+                            func.coalesce(func.sum(priced), 0)).group_by(Battery.status).all()
+    return {
+        (status,): (count, float(service), float(pickup), priced_count, float(priced_total))
+        for status, count, service, pickup, priced_count, priced_total in rows
+    }
+
+
+def compute_rollups():
+    """Recompute the monthly rollups from the battery table"""
+    year = extract('year', Battery.inward_date)
+    month = extract('month', Battery.inward_date)
+    rows = db.session.query(year, month, Battery.status, *_aggregates()).filter(
+        Battery.inward_date.isnot(None)
+    ).group_by(year, month, Battery.status).all()
+    return {
+        (int(y), int(m), status): (count, float(service), float(pickup))
+        for y, m, status, count, service, pickup in rows
+    }
+
+
+def _stored(model, key_columns, value_columns):
+    return {
+        tuple(getattr(row, key) for key in key_columns): tuple(getattr(row, column) or 0 for column in value_columns)
+        for row in model.query.all()
+    }
+
+
+def _diff(stored, actual, value_columns):
+    drift = []
+    empty = (0,) * len(value_columns)
+    for key in sorted(set(actual) | set(stored), key=str):
+        have = stored.get(key, empty)
+        want = actual.get(key, empty)
+        if any(round(value - wanted, 2) for value, wanted in zip(have, want)):
+            drift.append((key, have, want))
+    return drift
+
+
+def counter_drift():
+    """Compare stored counters and rollups with freshly computed ones.
+
+    Returns a list of (key, stored, actual) tuples for every row that differs,
+    where key is (status,) for counters and (year, month, status) for rollups.
+    """
+    return (_diff(_stored(BatteryStatusCounter, ['status'], COUNTER_COLUMNS), compute_counters(), COUNTER_COLUMNS) +
+            _diff(_stored(MonthlyStatusRollup, ['year', 'month', 'status'], ROLLUP_COLUMNS), compute_rollups(),
+                  ROLLUP_COLUMNS))
+
+
+def _replace(model, key_columns, value_columns, values):
+    model.query.delete()
+    for key, row_values in values.items():
+        db.session.add(model(**dict(zip(key_columns, key)), **dict(zip(value_columns, row_values))))
+
+
+def rebuild_counters():
+    """Replace the stored counters and rollups with recomputed values (caller commits).
+
+    Returns the drift that was corrected.
+    """
+    drift = counter_drift()
+    _replace(BatteryStatusCounter, ['status'], COUNTER_COLUMNS, compute_counters())
+    _replace(MonthlyStatusRollup, ['year', 'month', 'status'], ROLLUP_COLUMNS, compute_rollups())
+    db.session.flush()
+    return drift
+
+
+def ensure_counters():
+    """Backfill the counters and rollups if either table has never been populated"""
+    if not BatteryStatusCounter.query.first() or not MonthlyStatusRollup.query.first():
+        rebuild_counters()
+
+
+@click.command('rebuild-counters')
+@click.option('--verify-only', is_flag=True, help='Only report drift, do not rewrite the counters.')
+@with_appcontext
+def rebuild_counters_command(verify_only):
+    """Recompute the dashboard counters and report rollups, reporting drift"""
+    if verify_only:
+        drift = counter_drift()
+    else:
+        drift = rebuild_counters()
+        db.session.commit()
+
+    def describe(values):
+        text = f'count={values[0]} service={values[1]:.2f} pickup={values[2]:.2f}'
+        if len(values) > 3:
+            text += f' priced={values[3]} priced_total={values[4]:.2f}'
+        return text
+
+    for key, stored, actual in drift:
+        click.echo(f'{"/".join(str(part) for part in key)}: stored {describe(stored)} -> actual {describe(actual)}')
+
+    if not drift:
+        click.echo('Counters are in sync.')
+    elif verify_only:
+        raise SystemExit(1)
+    else:
+        click.echo(f'Rebuilt counters, corrected {len(drift)} row(s).')
+
+
+@click.command('stress-counters')
+@click.option('--threads', default=8, help='Sessions incrementing the same new counter row at once.')
+@click.option('--per-thread', default=50, help='Increments made by each session.')
+@with_appcontext
+def stress_counters_command(threads, per_thread):
+    """Increment a counter row that does not exist yet from many sessions at once and check the total.
+
+    Uses a status no battery has and deletes its row again afterwards.
+    """
+    app = current_app._get_current_object()
+    status = 'Counter stress test'
+    db.session.execute(delete(BatteryStatusCounter).where(BatteryStatusCounter.status == status))
+    db.session.commit()
+
+    start = threading.Barrier(threads)
+    errors = []
+
+    def increment(worker):
+        with app.app_context():
+            start.wait()
+            for _ in range(per_thread):
+                try:
+                    _increment(BatteryStatusCounter, {'status': status},
+                               {'battery_count': 1, 'service_revenue': 1.0, 'pickup_revenue': 0.5})
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(f'session {worker}: {e}')
+
+    workers = [threading.Thread(target=increment, args=(worker,)) for worker in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    row = db.session.get(BatteryStatusCounter, status)
+    stored = (row.battery_count, row.service_revenue, row.pickup_revenue) if row else (0, 0.0, 0.0)
+    db.session.execute(delete(BatteryStatusCounter).where(BatteryStatusCounter.status == status))
+    db.session.commit()
+
+    expected = threads * per_thread
+    click.echo(f'{threads} sessions x {per_thread} increments: count={stored[0]} service={stored[1]:.2f} '
+               f'pickup={stored[2]:.2f}, expected count={expected}; {len(errors)} errors.')
+    for error in errors[:10]:
+        click.echo(f'  {error}')
+    if errors or stored != (expected, expected * 1.0, expected * 0.5):
+        raise SystemExit(1)
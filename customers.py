@@ -0,0 +1,100 @@
+"""
+Customer lookup by normalized mobile number.
+
+customer.mobile_normalized holds the digits of the primary mobile with any
++91 / leading 0 prefix stripped, under a unique B-tree index. Intake upserts
+customers on it with INSERT ... ON CONFLICT, so two counters registering the
+same customer at once share one row, and the intake typeahead prefix-matches
+it with an index range scan.
+"""
+from sqlalchemy import select, func, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from models import Customer, Battery, normalize_mobile, get_indian_now
+
+TYPEAHEAD_MIN_DIGITS = 3
+TYPEAHEAD_CUSTOMERS = 8
+TYPEAHEAD_BATTERIES = 3
+
+
+def prefix_range(column, prefix):
+    """Index-friendly predicate for a digits-only column starting with prefix"""
+    # Incrementing the prefix as a number gives the exclusive upper bound;
+    # an all-nines prefix has no digits-only string above its range.
+    if prefix.strip('9'):
+        upper = str(int(prefix) + 1).zfill(len(prefix))
+        return db.and_(column >= prefix, column < upper)
+    return column >= prefix
+
+
+def upsert_customer(name, mobile, mobile_secondary=None):
+    """Return the id of the customer with this mobile, creating them if needed.
+
+    Existing customers keep their stored name and numbers, as before.
+    """
+    normalized = normalize_mobile(mobile)
+    values = {
+        'name': name,
+        'mobile': mobile,
+        'mobile_secondary': mobile_secondary,
+        'mobile_normalized': normalized,
+        'created_at': get_indian_now(),
+    }
+    dialect = db.engine.dialect.name
+    if normalized and dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = dialect_insert(Customer).values(**values)
+        # A no-op update so RETURNING also yields the id of an existing row
+        statement = statement.on_conflict_do_update(
+            index_elements=[Customer.mobile_normalized],
+            set_={'mobile_normalized': statement.excluded.mobile_normalized}
+        ).returning(Customer.id)
+        return db.session.execute(statement).scalar()
+
+    existing = Customer.query.filter_by(mobile_normalized=normalized).first() if normalized else None
+    if existing:
+        return existing.id
+    return db.session.execute(insert(Customer).values(**values).returning(Customer.id)).scalar()
+
+
+def typeahead(prefix):
+    """Customers whose mobile starts with prefix, each with their latest batteries"""
+    digits = ''.join(ch for ch in prefix if ch.isdigit())
+    if len(digits) < TYPEAHEAD_MIN_DIGITS:
+        return []
+    # Only strip a country code once the full number has been typed
+    normalized = normalize_mobile(digits) if len(digits) > 10 else digits
+
+    customers = Customer.query.filter(prefix_range(Customer.mobile_normalized, normalized)) \
+        .order_by(Customer.mobile_normalized).limit(TYPEAHEAD_CUSTOMERS).all()
+    if not customers:
+        return []
+
+    # Latest batteries per customer in one query
+    position = func.row_number().over(partition_by=Battery.customer_id, order_by=Battery.inward_date.desc())
+    recent = select(Battery, position.label('position')).where(
+        Battery.customer_id.in_([customer.id for customer in customers])
+    ).subquery()
+    rows = db.session.execute(select(recent).where(recent.c.position <= TYPEAHEAD_BATTERIES)
+                              .order_by(recent.c.customer_id, recent.c.position)).all()
+
+    batteries = {}
+    for row in rows:
+        batteries.setdefault(row.customer_id, []).append({
+            'id': row.id,
+            'battery_id': row.battery_id,
+            'battery_type': row.battery_type,
+            'voltage': row.voltage,
+            'capacity': row.capacity,
+            'status': row.status,
+            'inward_date': row.inward_date.strftime('%d/%m/%Y') if row.inward_date else None,
+        })
+
+    return [{
+        'id': customer.id,
+        'name': customer.name,
+        'mobile': customer.mobile,
+        'mobile_secondary': customer.mobile_secondary,
+        'batteries': batteries.get(customer.id, []),
+    } for customer in customers]
+
@@ -0,0 +1,188 @@
+"""
+Database engine settings and read-replica routing.
+
+Engine settings come from the environment, so every deployment can size
+them:
+
+    DB_POOL_SIZE            connections kept open per process (gunicorn.conf.py
+                            sets one per thread)
+    DB_MAX_OVERFLOW         extra connections under load
+    DB_POOL_TIMEOUT         seconds a request waits for a free connection (30)
+    DB_POOL_RECYCLE         seconds before a connection is replaced (300)
+    DB_STATEMENT_TIMEOUT_MS PostgreSQL statement_timeout for every statement
+                            (unset: no limit). Migrations lift it for their DDL.
+
+Set DATABASE_REPLICA_URL to a streaming replica of the primary. Some work
+then reads from the replica, away from the intake and status writes:
+- the heavy report pages (@read_replica: monthly and yearly report, all bills);
+- the read-only jobs: CSV exports, backups and yearly report downloads.
+
+Only SELECTs are routed. Flushes, INSERT/UPDATE/DELETE and raw SQL still go
+to the primary, as does everything outside those pages and jobs.
+DB_REPLICA_STATEMENT_TIMEOUT_MS can give the replica a longer limit than
+the primary.
+
+Each process checks the replica at most every DB_REPLICA_CHECK_SECONDS
+(10), giving up on a connection after DB_REPLICA_CONNECT_TIMEOUT seconds
+(3). While it is unreachable, or replaying more than
+DB_REPLICA_MAX_LAG_SECONDS (30) behind the primary, those reads fall back to
+the primary. Keep that lag bound below backups.CHANGE_OVERLAP (10 minutes):
+an incremental backup taken on a lagging replica misses rows the next one
+picks up again only within that overlap.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DB_REPLICA_MAX_LAG_SECONDS', 30))
+REPLICA_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_CHECK_SECONDS', 10))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 3))
+
+_REPLICA_KEY = 'read_replica'
+
+# Seconds the replica is behind; 0 when it has replayed everything it received
+# (pg_last_xact_replay_timestamp alone grows while the primary is idle)
+POSTGRES_REPLICA_LAG = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def engine_options(url, statement_timeout_ms=None):
+    """SQLAlchemy engine options for url from the DB_* environment settings"""
+    from metrics import TimedQueuePool
+    options = {
+        'pool_recycle': _env_int('DB_POOL_RECYCLE') or 300,
+        'pool_pre_ping': True,
+    }
+    url = make_url(url)
+    # An in-memory SQLite database keeps its single-connection pool
+    if url.database in (None, '', ':memory:'):
+        return options
+
+    # Times every pool checkout for /metrics
+    options['poolclass'] = TimedQueuePool
+    for option, name in [('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'),
+                         ('pool_timeout', 'DB_POOL_TIMEOUT')]:
+        value = _env_int(name)
+        if value is not None:
+            options[option] = value
+    if statement_timeout_ms and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+    return options
+
+
+def primary_engine_options(url):
+    return engine_options(url, _env_int('DB_STATEMENT_TIMEOUT_MS'))
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs to the replica engine set by use_replica()"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get(_REPLICA_KEY)
+        if replica is not None and bind is None and not self._flushing and getattr(clause, 'is_select', False):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """The replica engine of one process and whether it is fit to read from"""
+
+    def __init__(self, url):
+        self.url = url
+        options = engine_options(url, _env_int('DB_REPLICA_STATEMENT_TIMEOUT_MS') or _env_int('DB_STATEMENT_TIMEOUT_MS'))
+        if make_url(url).get_backend_name() == 'postgresql':
+            # A replica that is down must not hold up the request that checks it
+            options.setdefault('connect_args', {})['connect_timeout'] = REPLICA_CONNECT_TIMEOUT
+        self.engine = create_engine(url, **options)
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._healthy = False
+        self.reason = 'not checked yet'
+
+    def _check(self):
+        try:
+            with self.engine.connect() as connection:
+                lag = float(connection.execute(text(POSTGRES_REPLICA_LAG)).scalar()) \
+                    if connection.dialect.name == 'postgresql' else 0.0
+        except Exception as e:
+            message = str(e).strip().splitlines()
+            return False, f'unreachable ({type(e).__name__}{": " + message[0] if message else ""})'
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            return False, f'{lag:.0f}s behind the primary'
+        return True, f'{lag:.1f}s behind the primary'
+
+    def available(self):
+        """Whether reads may go to the replica, re-checked every REPLICA_CHECK_SECONDS"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < REPLICA_CHECK_SECONDS:
+            return self._healthy
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= REPLICA_CHECK_SECONDS:
+                healthy, reason = self._check()
+                if healthy != self._healthy or self._checked_at is None:
+                    log = logging.info if healthy else logging.warning
+                    log(f'Read replica {"in use" if healthy else "not used, reading from the primary"}: {reason}')
+                self._healthy, self.reason, self._checked_at = healthy, reason, time.monotonic()
+        return self._healthy
+
+
+def _router():
+    return current_app.extensions.get('read_replica')
+
+
+def read_engine():
+    """The replica engine if it can be used, else the primary"""
+    from app import db
+    router = _router()
+    return router.engine if router is not None and router.available() else db.engine
+
+
+@contextmanager
+def use_replica(session=None):
+    """Send the session's SELECTs to the replica (when usable) inside the block"""
+    from app import db
+    session = session or db.session
+    engine = read_engine()
+    previous = session.info.get(_REPLICA_KEY)
+    if engine is not db.engine:
+        session.info[_REPLICA_KEY] = engine
+    try:
+        yield engine
+    finally:
+        if previous is None:
+            session.info.pop(_REPLICA_KEY, None)
+        else:
+            session.info[_REPLICA_KEY] = previous
+
+
+def read_replica(view):
+    """Serve a read-only view from the replica when one is configured"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def init_replica(app):
+    """Create the replica engine if DATABASE_REPLICA_URL is set"""
+    if REPLICA_URL:
+        app.extensions['read_replica'] = ReplicaRouter(REPLICA_URL)
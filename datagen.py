@@ -0,0 +1,327 @@
+"""
+Synthetic shop data for benchmarks and load tests.
+
+`flask generate-data --batteries N` appends N batteries (10k to 5M is the
+intended range) with their customers, status history, staff notes, material
+usage and stock transactions, shaped like a real shop rather than like
+seed_rows()' uniform filler:
+
+- Intake grows over the --years period and is lighter on Sundays.
+- About a third of batteries belong to returning customers, and some
+  mobiles are stored with a +91 prefix.
+- Car, two wheeler, inverter, UPS, truck and e-rickshaw batteries each
+  have their own capacities and price range.
+- Statuses follow the battery's age: recent batteries are still being
+  worked on, old ones are delivered, returned or not repairable. History
+  rows walk through every step in order.
+- Material usage draws on eighteen generated inventory items. Purchases restock an
+  item whenever usage takes it under its minimum, so current_stock is the
+  sum of its transactions.
+
+Battery IDs are reserved from the shared counter, so intake continues after
+them. The run is seeded (--seed) and reproducible for the same database.
+Rows are inserted in chunks in one transaction. Afterwards the counters,
+rollups, search table and PostgreSQL sequences are brought up to date.
+Meant for scratch and staging databases: it adds customers, not test users.
+"""
+import math
+import random
+import time
+from datetime import timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert, select, func
+from app import db
+from models import (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, InventoryItem,
+                    StockTransaction, BatteryMaterialUsage, get_indian_now)
+
+FIRST_NAMES = ['Aarav', 'Vivaan', 'Aditya', 'Arjun', 'Sai', 'Rohan', 'Karthik', 'Rahul', 'Suresh', 'Ramesh',
+               'Mahesh', 'Ganesh', 'Prakash', 'Vijay', 'Anil', 'Sunil', 'Manoj', 'Deepak', 'Imran', 'Salman',
+               'Joseph', 'Thomas', 'Gurpreet', 'Harpreet', 'Priya', 'Lakshmi', 'Anjali', 'Divya', 'Kavya',
+               'Meena', 'Fatima', 'Ayesha', 'Sneha', 'Pooja', 'Neha', 'Rekha', 'Sunita', 'Geeta', 'Mary', 'Asha']
+LAST_NAMES = ['Sharma', 'Verma', 'Gupta', 'Kumar', 'Singh', 'Reddy', 'Naidu', 'Rao', 'Iyer', 'Nair', 'Menon',
+              'Pillai', 'Patel', 'Shah', 'Mehta', 'Joshi', 'Kulkarni', 'Deshpande', 'Khan', 'Sheikh', 'Das',
+              'Bose', 'Ghosh', 'Yadav', 'Chauhan', 'Thakur', 'Fernandes', 'Dsouza']
+
+# type, voltage, capacities, median service price, weight
+BATTERY_TYPES = [
+    ('Car', '12V', ['35Ah', '45Ah', '65Ah', '88Ah', '100Ah'], 900, 45),
+    ('Two Wheeler', '12V', ['2.5Ah', '5Ah', '7Ah', '9Ah'], 350, 25),
+    ('Inverter', '12V', ['100Ah', '150Ah', '180Ah', '200Ah'], 1400, 15),
+    ('UPS', '12V', ['7Ah', '26Ah', '42Ah'], 600, 5),
+    ('Truck', '12V', ['120Ah', '150Ah', '180Ah'], 1800, 6),
+    ('E-Rickshaw', '48V', ['100Ah', '120Ah', '140Ah'], 2200, 4),
+]
+
+# (max age in days, {final status: weight})
+STATUS_BY_AGE = [
+    (2, {'Received': 60, 'Pending': 30, 'Ready': 10}),
+    (7, {'Received': 10, 'Pending': 35, 'Ready': 40, 'Delivered': 13, 'Not Repairable': 2}),
+    (30, {'Pending': 4, 'Ready': 12, 'Delivered': 72, 'Returned': 6, 'Not Repairable': 6}),
+    (None, {'Ready': 1, 'Delivered': 85, 'Returned': 7, 'Not Repairable': 7}),
+]
+
+# item name, category, unit, unit cost, usual quantity range per battery
+INVENTORY = [
+    ('Battery acid', 'acid', 'liters', 60.0, (0.5, 3.0)),
+    ('Distilled water', 'acid', 'liters', 15.0, (0.5, 4.0)),
+    ('Positive plate 12V', 'plates', 'pieces', 180.0, (1, 6)),
+    ('Negative plate 12V', 'plates', 'pieces', 160.0, (1, 6)),
+    ('Plate set 2W', 'plates', 'sets', 220.0, (1, 1)),
+    ('PE separator', 'separators', 'pieces', 12.0, (2, 12)),
+    ('AGM separator', 'separators', 'pieces', 25.0, (2, 10)),
+    ('Lead terminal', 'terminals', 'pieces', 45.0, (1, 2)),
+    ('Brass terminal', 'terminals', 'pieces', 70.0, (1, 2)),
+    ('Terminal clamp', 'terminals', 'pieces', 35.0, (1, 2)),
+    ('Vent plug', 'accessories', 'pieces', 8.0, (1, 6)),
+    ('Float indicator', 'accessories', 'pieces', 40.0, (1, 1)),
+    ('Container 12V car', 'containers', 'pieces', 450.0, (1, 1)),
+    ('Container inverter', 'containers', 'pieces', 650.0, (1, 1)),
+    ('Lid sealant', 'consumables', 'kg', 300.0, (0.1, 0.5)),
+    ('Lead alloy', 'consumables', 'kg', 210.0, (0.2, 1.5)),
+    ('Connector strap', 'consumables', 'pieces', 30.0, (1, 5)),
+    ('Petroleum jelly', 'consumables', 'kg', 120.0, (0.05, 0.2)),
+]
+
+COMMENTS = ['Checked voltage and specific gravity', 'Cells topped up', 'Charging overnight', 'Plates sulphated',
+            'Replaced terminals', 'Customer informed by phone', 'Load test passed', 'One dead cell',
+            'Waiting for parts', 'Case cracked', 'Under warranty', '']
+NOTES = ['Customer will collect after 6 pm', 'Called customer, no answer', 'Asked for a discount',
+         'Needs pickup from the customer\'s shop', 'Warranty card missing', 'Customer wants old battery back',
+         'Pay by UPI on delivery', 'Second visit for the same issue', 'Reminder: call before delivery']
+NOTE_TYPES = ['followup', 'reminder', 'issue', 'resolved']
+
+MOBILE_SPACE = 4_000_000_000  # 6000000000..9999999999
+MOBILE_STRIDE = 2_654_435_761  # coprime with MOBILE_SPACE, so distinct customers get distinct numbers
+
+
+def _mobile(customer_pk):
+    return str(6_000_000_000 + (customer_pk * MOBILE_STRIDE) % MOBILE_SPACE)
+
+
+def _weighted(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def _daily_counts(batteries, days, start, rng):
+    """Split batteries over the days, growing towards the end and lighter on Sundays"""
+    weights = [(1 + 1.5 * day / days) * (0.4 if (start + timedelta(days=day)).weekday() == 6 else 1.0)
+               for day in range(days)]
+    total = sum(weights)
+    counts = [int(batteries * weight / total) for weight in weights]
+    for day in rng.sample(range(days), batteries - sum(counts)):
+        counts[day] += 1
+    return counts
+
+
+def _users_by_role(connection):
+    users = {}
+    for user_id, role in connection.execute(select(User.id, User.role).order_by(User.id)):
+        users.setdefault(role, []).append(user_id)
+    fallback = next(iter(users.values()), None)
+    if not fallback:
+        raise click.ClickException('Create the default users first (flask seed).')
+    return {role: users.get(role) or users.get('admin') or fallback
+            for role in ['admin', 'shop_staff', 'technician']}
+
+
+def _inventory_items(connection):
+    """The generator's inventory items as {id: (unit, unit_cost, quantity range, minimum)}, created on first use"""
+    items = {}
+    for index, (name, category, unit, cost, quantity) in enumerate(INVENTORY):
+        code = f'GEN-{index + 1:03d}'
+        item_id = connection.execute(select(InventoryItem.id).where(InventoryItem.item_code == code)).scalar()
+        if item_id is None:
+            item_id = connection.execute(insert(InventoryItem).values(
+                item_name=name, item_code=code, category=category, unit=unit, current_stock=0.0,
+                minimum_stock=quantity[1] * 10, unit_cost=cost, supplier='Generated supplier', active=True,
+            ).returning(InventoryItem.id)).scalar()
+        items[item_id] = (unit, cost, quantity, quantity[1] * 10)
+    return items
+
+
+def generate_data(connection, batteries, first_number, years=3, seed=1, chunk_size=5000, progress=None):
+    """Append batteries numbered from first_number and everything around them; returns row counts per table"""
+    from battery_ids import format_battery_id
+    rng = random.Random(seed)
+    users = _users_by_role(connection)
+    items = _inventory_items(connection)
+    stock = {item_id: current or 0.0 for item_id, current in connection.execute(
+        select(InventoryItem.id, InventoryItem.current_stock).where(InventoryItem.id.in_(list(items))))}
+    next_customer = (connection.execute(select(func.max(Customer.id))).scalar() or 0) + 1
+    next_battery = (connection.execute(select(func.max(Battery.id))).scalar() or 0) + 1
+    first_customer = next_customer
+    now = get_indian_now().replace(microsecond=0)
+    days = max(int(years * 365), 1)
+    start = (now - timedelta(days=days)).replace(hour=0, minute=0, second=0)
+    type_weights = [battery_type[4] for battery_type in BATTERY_TYPES]
+    counts = {'customer': 0, 'battery': 0, 'battery_status_history': 0, 'battery_staff_note': 0,
+              'battery_material_usage': 0, 'stock_transaction': 0}
+    buffers = {model: [] for model in (Customer, Battery, BatteryStatusHistory, BatteryStaffNote,
+                                       BatteryMaterialUsage, StockTransaction)}
+
+    def flush():
+        if not buffers[Battery]:
+            return
+        for model, rows in buffers.items():
+            if rows:
+                connection.execute(insert(model), rows)
+                counts[model.__tablename__] += len(rows)
+                rows.clear()
+        if progress:
+            progress(counts)
+
+    def use_stock(item_id, quantity, at, battery_code, user_id):
+        unit, cost, _, minimum = items[item_id]
+        if stock[item_id] - quantity < minimum:
+            # Restock the way the shop does: a bulk purchase a little before it is needed
+            bought = max(minimum * 5, quantity)
+            buffers[StockTransaction].append({
+                'inventory_item_id': item_id, 'transaction_type': 'purchase', 'quantity': bought,
+                'unit_cost': cost, 'total_cost': round(bought * cost, 2), 'reference_id': f'PO-{at:%Y%m%d}',
+                'notes': 'Generated purchase', 'created_by': users['admin'][0], 'created_at': at - timedelta(hours=2),
+            })
+            stock[item_id] += bought
+        stock[item_id] -= quantity
+        buffers[StockTransaction].append({
+            'inventory_item_id': item_id, 'transaction_type': 'usage', 'quantity': -quantity, 'unit_cost': cost,
+            'total_cost': round(quantity * cost, 2), 'reference_id': battery_code,
+            'notes': f'Used for battery {battery_code}', 'created_by': user_id, 'created_at': at,
+        })
+
+    number = first_number
+    for day, day_count in enumerate(_daily_counts(batteries, days, start, rng)):
+        day_start = start + timedelta(days=day, hours=9)
+        age = (now - day_start).days
+        weights = next(weights for max_age, weights in STATUS_BY_AGE if max_age is None or age < max_age)
+        for minute in sorted(rng.randrange(11 * 60) for _ in range(day_count)):
+            inward = day_start + timedelta(minutes=minute, seconds=rng.randrange(60))
+            if inward > now:
+                inward = now - timedelta(minutes=rng.randrange(1, 60))
+
+            # A third of the batteries come from customers who have been here before
+            if next_customer > first_customer and rng.random() < 0.35:
+                customer_pk = rng.randrange(first_customer, next_customer)
+            else:
+                customer_pk = next_customer
+                next_customer += 1
+                mobile = _mobile(customer_pk)
+                buffers[Customer].append({
+                    'id': customer_pk, 'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                    'mobile': f'+91 {mobile}' if rng.random() < 0.2 else mobile,
+                    'mobile_secondary': _mobile(customer_pk + MOBILE_SPACE // 2) if rng.random() < 0.1 else None,
+                    'mobile_normalized': mobile, 'created_at': inward,
+                })
+
+            battery_type, voltage, capacities, median_price, _ = rng.choices(BATTERY_TYPES, weights=type_weights)[0]
+            status = _weighted(rng, weights)
+            battery_pk = next_battery
+            next_battery += 1
+            battery_code = format_battery_id(number)
+            number += 1
+            is_pickup = rng.random() < 0.12
+            buffers[Battery].append({
+                'id': battery_pk, 'battery_id': battery_code, 'customer_id': customer_pk,
+                'battery_type': battery_type, 'voltage': voltage, 'capacity': rng.choice(capacities),
+                'status': status, 'inward_date': inward,
+                'service_price': 0.0 if status in ('Received', 'Pending') else
+                float(round(median_price * math.exp(rng.gauss(0, 0.35)), -1)),
+                'pickup_charge': float(rng.choice([50, 100, 150, 200])) if is_pickup else 0.0,
+                'is_pickup': is_pickup,
+            })
+
+            # Walk the battery through each status it has been in
+            path = ['Received']
+            if status != 'Received':
+                path.append('Pending')
+            if status in ('Ready', 'Delivered', 'Returned'):
+                path.append('Ready')
+            if status in ('Delivered', 'Returned', 'Not Repairable'):
+                path.append(status)
+            at = inward
+            for step, step_status in enumerate(path):
+                if step:
+                    at = min(at + timedelta(hours=rng.uniform(1, 48 if step_status != 'Delivered' else 120)), now)
+                buffers[BatteryStatusHistory].append({
+                    'battery_id': battery_pk, 'status': step_status, 'updated_at': at,
+                    'comments': rng.choice(COMMENTS) if rng.random() < 0.3 else None,
+                    'updated_by': rng.choice(users['technician' if step_status in ('Pending', 'Ready', 'Not Repairable')
+                                                   else 'shop_staff']),
+                })
+                if step_status == 'Ready' and rng.random() < 0.45:
+                    technician = rng.choice(users['technician'])
+                    for item_id in rng.sample(list(items), rng.randint(1, 3)):
+                        unit, cost, (low, high), _ = items[item_id]
+                        quantity = float(rng.randint(low, high)) if isinstance(low, int) else round(rng.uniform(low, high), 2)
+                        buffers[BatteryMaterialUsage].append({
+                            'battery_id': battery_pk, 'inventory_item_id': item_id, 'quantity_used': quantity,
+                            'unit_cost': cost, 'total_cost': round(quantity * cost, 2), 'used_by': technician,
+                            'used_at': at, 'notes': None,
+                        })
+                        use_stock(item_id, quantity, at, battery_code, technician)
+
+            if rng.random() < 0.12:
+                finished = status in ('Delivered', 'Returned', 'Not Repairable')
+                for _ in range(rng.randint(1, 3)):
+                    buffers[BatteryStaffNote].append({
+                        'battery_id': battery_pk, 'note': rng.choice(NOTES), 'note_type': rng.choice(NOTE_TYPES),
+                        'created_by': rng.choice(users['shop_staff']), 'is_resolved': finished,
+                        'created_at': min(inward + timedelta(hours=rng.uniform(0, 72)), now),
+                    })
+
+            if len(buffers[Battery]) >= chunk_size:
+                flush()
+    flush()
+
+    stock_table = InventoryItem.__table__
+    for item_id, current in stock.items():
+        connection.execute(stock_table.update().where(stock_table.c.id == item_id)
+                           .values(current_stock=round(current, 3), last_updated=now))
+    return counts
+
+
+def populate(batteries, years=3, seed=1, chunk_size=5000, progress=None):
+    """Generate batteries in the app's database, bring derived data up to date and commit"""
+    from battery_ids import reserve_block
+    from restore import reset_sequences, finish_restore
+    from search import suspend_search_triggers, resume_search_triggers
+    # Before the session starts writing: the reservation commits on its own connection
+    first_number = reserve_block(batteries)
+    connection = db.session.connection()
+    try:
+        # Fill the SQLite search table once at the end instead of row by row
+        suspend_search_triggers(connection)
+        counts = generate_data(connection, batteries, first_number, years, seed, chunk_size, progress)
+        resume_search_triggers(connection)
+        reset_sequences(connection)
+        finish_restore()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('ANALYZE')
+        connection.commit()
+    return counts
+
+
+@click.command('generate-data')
+@click.option('--batteries', default=10000, help='Batteries to add (10k to 5M).')
+@click.option('--years', default=3.0, help='Period the intake is spread over, ending today.')
+@click.option('--seed', default=1, help='Random seed.')
+@click.option('--chunk-size', default=5000, help='Batteries per insert batch.')
+@with_appcontext
+def generate_data_command(batteries, years, seed, chunk_size):
+    """Add synthetic batteries, customers, history, notes and inventory activity"""
+    if batteries < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--batteries')
+    started = time.perf_counter()
+
+    def progress(counts):
+        click.echo(f'  {counts["battery"]} batteries, {sum(counts.values())} rows '
+                   f'({time.perf_counter() - started:.0f}s)')
+
+    counts = populate(batteries, years, seed, chunk_size, progress)
+    for table, count in counts.items():
+        click.echo(f'{table:25} {count:10}')
+    click.echo(f'Generated {sum(counts.values())} rows in {time.perf_counter() - started:.1f}s.')
@@ -0,0 +1,52 @@
+"""
+Half-open date range predicates for report and list filters.
+
+`extract('month', Battery.inward_date) == m` cannot use an index, so every
+month/year/custom range filter is expressed as `column >= start AND column < end`
+instead, which the (status, inward_date) and inward_date indexes can serve.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+
+
+def month_range(year, month):
+    """[first day of month, first day of next month)"""
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def year_range(year):
+    """[1 January, 1 January of the next year)"""
+    return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+
+
+def day_range(first_day, last_day):
+    """Inclusive calendar dates turned into [first_day 00:00, day after last_day 00:00)"""
+    start = datetime(first_day.year, first_day.month, first_day.day)
+    end = datetime(last_day.year, last_day.month, last_day.day) + timedelta(days=1)
+    return start, end
+
+
+def in_range(column, date_range):
+    """SQL predicate for column within a (start, end) half-open range"""
+    start, end = date_range
+    return and_(column >= start, column < end)
+
+
+def range_from_args(args):
+    """Build a date range from request args, or None if no filter was given.
+
+    Accepts `from`/`to` (YYYY-MM-DD, both inclusive), `month` (YYYY-MM) or
+    `year` (YYYY), in that order of precedence. Raises ValueError on bad input.
+    """
+    if args.get('from') or args.get('to'):
+        first_day = datetime.strptime(args.get('from') or '1900-01-01', '%Y-%m-%d')
+        last_day = datetime.strptime(args.get('to') or '9998-12-31', '%Y-%m-%d')
+        return day_range(first_day, last_day)
+    if args.get('month'):
+        month = datetime.strptime(args['month'], '%Y-%m')
+        return month_range(month.year, month.month)
+    if args.get('year'):
+        return year_range(int(args['year']))
+    return None
@@ -0,0 +1,79 @@
+"""
+Streamed exports.
+
+Rows are fetched with `yield_per` (a server-side cursor on PostgreSQL) and
+written out in chunks as they arrive, so an export holds one batch of rows
+in memory no matter how large the table is. Optional gzip compresses the
+stream incrementally.
+"""
+import csv
+import io
+import zlib
+from sqlalchemy import select, func
+from app import db
+from models import Battery, Customer, BatteryStatusHistory
+from date_ranges import in_range
+
+EXPORT_BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+BATTERY_EXPORT_HEADER = [
+    'Battery ID', 'Customer Name', 'Mobile', 'Battery Type',
+    'Voltage', 'Capacity', 'Status', 'Inward Date',
+    'Service Price', 'Last Updated'
+]
+
+
+def battery_export_query(statuses=None, date_range=None):
+    """Battery export rows, with the latest status update per battery"""
+    # Correlated max() is one probe of the (battery_id, updated_at) index per row
+    last_update = select(func.max(BatteryStatusHistory.updated_at)) \
+        .where(BatteryStatusHistory.battery_id == Battery.id).correlate(Battery).scalar_subquery()
+    query = select(
+        Battery.battery_id, Customer.name, Customer.mobile, Battery.battery_type,
+        Battery.voltage, Battery.capacity, Battery.status, Battery.inward_date,
+        Battery.service_price, func.coalesce(last_update, Battery.inward_date).label('last_update')
+    ).join(Customer, Customer.id == Battery.customer_id)
+    if statuses:
+        query = query.where(Battery.status.in_(statuses))
+    if date_range:
+        query = query.where(in_range(Battery.inward_date, date_range))
+    return query.order_by(Battery.id)
+
+
+def _format_time(value):
+    return value.strftime('%Y-%m-%d %H:%M') if value else ''
+
+
+def battery_csv_lines(statuses=None, date_range=None):
+    """Yield the export as CSV text, a chunk at a time"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(BATTERY_EXPORT_HEADER)
+
+    result = db.session.execute(battery_export_query(statuses, date_range).execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in result:
+        writer.writerow([
+            row.battery_id, row.name, row.mobile, row.battery_type, row.voltage, row.capacity,
+            row.status, _format_time(row.inward_date), row.service_price, _format_time(row.last_update)
+        ])
+        if output.tell() >= CHUNK_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def encode_stream(chunks, compress=False):
+    """Encode text chunks as UTF-8, gzip-compressing them incrementally if asked"""
+    if not compress:
+        for chunk in chunks:
+            if chunk:
+                yield chunk.encode('utf-8')
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
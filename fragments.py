@@ -0,0 +1,145 @@
+"""
+Template compilation and fragment caching.
+
+Compiled templates are written to a Jinja bytecode cache
+(JINJA_BYTECODE_CACHE_DIR, default instance/cache/jinja) shared by all
+gunicorn workers and the job worker, so a recycled worker loads them
+instead of compiling base.html and the page again. gunicorn.conf.py also
+loads every template in the master before forking. An edited template has
+a new checksum and is compiled afresh.
+
+`{% cache 'name', key... %}...{% endcache %}` renders its body once and
+serves the stored markup until one of the reference_cache namespaces listed
+for it in FRAGMENTS is invalidated, or FRAGMENT_CACHE_TTL seconds (default
+REFERENCE_CACHE_TTL) have passed. The extra keys pick the variant, such as
+the role for the navigation. Fragments showing stock levels are keyed on
+stock_key() of the live levels, so a material use or purchase in any worker
+shows up at once. Settings changes reach every worker at once, other
+inventory changes within the TTL, as for the data the fragments are built
+from. `fragment_cache.invalidate()` drops fragments explicitly. Caching is
+off while templates auto-reload (debug mode) or with FRAGMENT_CACHE_TTL=0.
+"""
+import logging
+import os
+import threading
+import time
+from flask import has_request_context, request
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from refcache import reference_cache
+
+# Fragment name -> reference_cache namespaces its markup is built from
+FRAGMENTS = {
+    'navigation': (),
+    'account_menu': (),
+    'shop_header': ('settings',),
+    'material_options': ('inventory_items',),
+    'purchase_options': ('inventory_items',),
+}
+
+
+class FragmentCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (token, expires_at, markup)
+        self._versions = {}  # fragment name -> version
+        self.hits = 0
+        self.misses = 0
+
+    def _token(self, name):
+        if name not in FRAGMENTS:
+            raise KeyError(f'Unknown template fragment {name!r}; add it to fragments.FRAGMENTS')
+        with self._lock:
+            version = self._versions.get(name, 0)
+        return (version,) + tuple(reference_cache.version(namespace) for namespace in FRAGMENTS[name])
+
+    def get(self, name, keys, render):
+        """The markup for fragment name and keys, calling render() when it is missing or stale"""
+        if self.ttl <= 0:
+            return render()
+        # url_for() output in the markup depends on where the app is mounted
+        key = (name, request.script_root if has_request_context() else '') + tuple(keys)
+        token = self._token(name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == token and entry[1] > now:
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        markup = render()
+
+        with self._lock:
+            # Variants keyed on stock levels are never asked for again once the stock changes
+            self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+            self._entries[key] = (token, now + self.ttl, markup)
+        return markup
+
+    def invalidate(self, *names):
+        """Drop the given fragments (all of them if none are given) in this process"""
+        with self._lock:
+            for name in names or FRAGMENTS:
+                self._versions[name] = self._versions.get(name, 0) + 1
+            self._entries = {key: entry for key, entry in self._entries.items() if key[0] not in (names or FRAGMENTS)}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+            }
+
+
+fragment_cache = FragmentCache(float(os.environ.get('FRAGMENT_CACHE_TTL') or reference_cache.ttl))
+
+
+def stock_key(items):
+    """Fragment key for markup showing the stock of items (from InventoryItem.active_items())"""
+    return tuple((item.id, item.current_stock) for item in items)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'name', key... %}body{% endcache %}"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        keys = []
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [name, nodes.List(keys)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, keys, caller):
+        # Template edits must show up while templates auto-reload
+        if self.environment.auto_reload:
+            return caller()
+        return fragment_cache.get(name, keys, caller)
+
+
+def init_templates(app):
+    """Share compiled templates between processes and enable {% cache %}"""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.add_template_global(stock_key)
+    directory = os.environ.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'cache', 'jinja')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logging.warning(f'Templates are compiled by every worker, no bytecode cache in {directory}: {e}')
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def load_templates(app):
+    """Compile (or load from the bytecode cache) every template; returns how many"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
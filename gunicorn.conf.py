@@ -0,0 +1,122 @@
+"""
+Gunicorn settings for production: `gunicorn --config gunicorn.conf.py main:app`.
+
+The app is imported once in the master (preload_app) and the workers are
+forked from it. Database setup is not part of the import: the Dockerfile
+runs `flask init-db` and `flask seed` once before starting gunicorn. Each worker serves requests on a
+pool of threads; long exports and backups run in the `flask run-jobs`
+worker, so no request should come near the timeout.
+
+Every setting can be overridden from the environment:
+
+    WEB_CONCURRENCY     worker processes (default: CPU count, at least 2)
+    GUNICORN_THREADS    request threads per worker (default 4)
+    GUNICORN_BIND       listen address (default 0.0.0.0:5000)
+    DB_POOL_SIZE        connections kept per worker (default: one per thread)
+    DB_MAX_OVERFLOW     extra connections per worker under load (default: threads)
+    (DB_POOL_TIMEOUT, DB_STATEMENT_TIMEOUT_MS and DATABASE_REPLICA_URL: see database.py)
+    (JINJA_BYTECODE_CACHE_DIR and FRAGMENT_CACHE_TTL: see fragments.py)
+    PROMETHEUS_MULTIPROC_DIR  where workers share their /metrics samples
+                        (default: erp-metrics under /dev/shm, emptied at startup)
+
+At most WEB_CONCURRENCY x (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections are
+opened; keep that below PostgreSQL's max_connections (100 by default) minus
+what the job worker and psql sessions need. With DATABASE_REPLICA_URL each
+worker may open as many again on the replica.
+
+Load test: 16 logged-in clients for 30 s per flow against 5,000 seeded
+batteries, on 1 vCPU with SQLite (intake = POST /battery/entry and its
+receipt redirect, technician = GET /technician/panel):
+
+                                            intake req/s   technician req/s
+    before: --workers 2 --timeout 120 --reload   46.8-54.1          154.2
+    this file (2 workers x 4 threads)            43.9-47.4          154.7
+    with a simulated 1 ms database round trip per statement:
+    before                                            35.5          123.3
+    this file                                         32.6          137.0
+
+On one core throughput is CPU bound and unchanged within run-to-run noise;
+intake is limited by SQLite's single writer. Threads pay off once requests
+wait on the database (+11% on the technician panel with 1 ms round trips).
+The other gains do not show up as requests/sec: workers start from an
+imported app, nothing watches files, and one slow request no longer takes half
+of the workers. Multi-core PostgreSQL hosts were not measured. To size a
+node for a number of counter staff and technicians, run loadtest.py against it.
+"""
+import multiprocessing
+import os
+import shutil
+import time
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+preload_app = True
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY') or max(2, multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS') or 4)
+
+# Recycle workers now and then so slow leaks never accumulate; the jitter
+# keeps them from all restarting at once
+max_requests = 1000
+max_requests_jitter = 100
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Heartbeat files on tmpfs; a disk-backed /tmp can stall workers in Docker
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+# One connection per request thread, plus overflow for the short second
+# connection a battery ID reservation opens while the request holds one.
+# Read by create_app(), which preload runs after this file.
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(threads))
+
+# Workers write their metrics here and /metrics adds them up (see metrics.py).
+# It has to be set before the app imports prometheus_client, and samples of
+# a previous server must not be counted again.
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp', 'erp-metrics'))
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def on_starting(server):
+    per_worker = int(os.environ['DB_POOL_SIZE']) + int(os.environ['DB_MAX_OVERFLOW'])
+    server.log.info(f'{workers} workers x {threads} threads, at most {workers * per_worker} database connections')
+
+
+def when_ready(server):
+    # The preloaded app created gauge files for the master, which serves nothing
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(os.getpid())
+
+    # Workers inherit the compiled templates instead of each compiling them again
+    from main import app
+    from fragments import load_templates
+    started = time.perf_counter()
+    count = load_templates(app)
+    server.log.info(f'{count} templates loaded in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+
+def post_fork(server, worker):
+    # Connections the master opened (e.g. INIT_DB_ON_STARTUP=1) must not be
+    # shared with the children; drop them from the worker's pool without closing them
+    from main import app
+    from app import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's gauges; its counters and histograms stay in the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,147 @@
+"""
+Hot-path query plan checks.
+
+The indexes themselves are declared in models.py and built by the schema
+migrations (migrations.py). `flask explain-hot-queries` applies any pending
+migrations, then runs EXPLAIN on the queries behind the busiest pages and
+fails if any of them falls back to a full table scan; with --seed it first loads a synthetic dataset inside a transaction
+that is rolled back afterwards.
+"""
+import random
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert, select, func
+from app import db
+from models import (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, InventoryItem,
+                    StockTransaction, BatteryMaterialUsage)
+from date_ranges import month_range, year_range, in_range
+
+
+def hot_queries():
+    """(name, statement) pairs for the queries behind the busiest pages"""
+    now = datetime.now()
+    return [
+        ('technician panel', select(Battery).where(Battery.status.in_(['Received', 'Pending']))
+            .order_by(Battery.inward_date.asc())),
+        ('dashboard recent', select(Battery).where(Battery.status.in_(['Pending', 'Ready']))
+            .order_by(Battery.inward_date.desc()).limit(5)),
+        ('finished batteries', select(Battery).where(Battery.status == 'Ready')
+            .order_by(Battery.inward_date.desc())),
+        ('not repairable', select(Battery).where(Battery.status == 'Not Repairable')
+            .order_by(Battery.inward_date.desc())),
+        ('all batteries page', select(Battery).order_by(Battery.inward_date.desc()).limit(20)),
+        ('monthly report', select(Battery).where(in_range(Battery.inward_date, month_range(now.year, now.month)))),
+        ('delivered this year', select(func.count(Battery.id)).where(
+            Battery.status == 'Delivered', in_range(Battery.inward_date, year_range(now.year)))),
+        ('customer by mobile', select(Customer).where(Customer.mobile == '9876543210')),
+        ('customer batteries', select(Battery).where(Battery.customer_id == 42)),
+        ('status history', select(BatteryStatusHistory).where(BatteryStatusHistory.battery_id == 42)),
+        ('staff notes', select(BatteryStaffNote).where(BatteryStaffNote.battery_id == 42)),
+        ('materials used', select(BatteryMaterialUsage).where(BatteryMaterialUsage.battery_id == 42)),
+        ('recent stock transactions', select(StockTransaction)
+            .order_by(StockTransaction.created_at.desc()).limit(10)),
+    ]
+
+
+def explain(connection, statement):
+    """Return the query plan as a list of text lines"""
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if connection.dialect.name == 'postgresql':
+        rows = connection.exec_driver_sql(f'EXPLAIN {compiled}', params).fetchall()
+        return [row[0] for row in rows]
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(connection, plan):
+    """Plan lines that read a whole table instead of using an index"""
+    if connection.dialect.name == 'postgresql':
+        return [line.strip() for line in plan if 'Seq Scan' in line]
+    return [line for line in plan if line.startswith('SCAN ') and ' USING ' not in line]
+
+
+def seed_rows(connection, batteries, chunk_size=10000):
+    """Insert a synthetic dataset shaped like a few years of shop history"""
+    rng = random.Random(1234)
+    user_id = connection.execute(select(User.id).limit(1)).scalar()
+    first_customer = (connection.execute(select(func.max(Customer.id))).scalar() or 0) + 1
+    first_battery = (connection.execute(select(func.max(Battery.id))).scalar() or 0) + 1
+    item_id = connection.execute(insert(InventoryItem).values(
+        item_name='Seed acid', item_code=f'SEED-{first_battery}', category='acid', unit='liters',
+        current_stock=0.0, minimum_stock=0.0, unit_cost=0.0, active=True
+    ).returning(InventoryItem.id)).scalar()
+    statuses = ['Delivered'] * 80 + ['Returned'] * 5 + ['Not Repairable'] * 5 + ['Received', 'Pending', 'Ready'] * 3 + ['Ready']
+    customers = max(batteries // 3, 1)
+    start = datetime.now() - timedelta(days=5 * 365)
+
+    for offset in range(0, customers, chunk_size):
+        connection.execute(insert(Customer), [
+            {'id': first_customer + i, 'name': f'Seed Customer {i}', 'mobile': f'9{rng.randrange(10**9):09d}'}
+            for i in range(offset, min(offset + chunk_size, customers))
+        ])
+
+    for offset in range(0, batteries, chunk_size):
+        battery_rows, history_rows, note_rows, usage_rows, stock_rows = [], [], [], [], []
+        for i in range(offset, min(offset + chunk_size, batteries)):
+            battery_pk = first_battery + i
+            # Older batteries are almost all finished, recent ones are still active
+            inward = start + timedelta(minutes=i * 5 * 365 * 24 * 60 // batteries)
+            status = rng.choice(statuses) if i > batteries * 0.98 else rng.choice(statuses[:90])
+            battery_rows.append({
+                'id': battery_pk, 'battery_id': f'SEED{battery_pk:09d}',
+                'customer_id': first_customer + rng.randrange(customers), 'battery_type': 'Car',
+                'voltage': '12V', 'capacity': '100Ah', 'status': status, 'inward_date': inward,
+                'service_price': float(rng.randrange(200, 3000)), 'pickup_charge': 0.0, 'is_pickup': False,
+            })
+            history_rows.append({'battery_id': battery_pk, 'status': status, 'updated_by': user_id, 'updated_at': inward})
+            if i % 10 == 0:
+                note_rows.append({'battery_id': battery_pk, 'note': 'Seed note', 'created_by': user_id, 'created_at': inward})
+            if i % 4 == 0:
+                usage_rows.append({'battery_id': battery_pk, 'inventory_item_id': item_id, 'quantity_used': 1.0,
+                                   'used_by': user_id, 'used_at': inward})
+                stock_rows.append({'inventory_item_id': item_id, 'transaction_type': 'usage', 'quantity': -1.0,
+                                   'created_by': user_id, 'created_at': inward})
+        connection.execute(insert(Battery), battery_rows)
+        connection.execute(insert(BatteryStatusHistory), history_rows)
+        for model, rows in ((BatteryStaffNote, note_rows), (BatteryMaterialUsage, usage_rows),
+                            (StockTransaction, stock_rows)):
+            if rows:
+                connection.execute(insert(model), rows)
+
+    connection.exec_driver_sql('ANALYZE')
+
+
+@click.command('explain-hot-queries')
+@click.option('--seed', type=int, default=0,
+              help='Load this many synthetic batteries first (rolled back afterwards), e.g. 1000000.')
+@click.option('--verbose', is_flag=True, help='Print the full plan of every query.')
+@with_appcontext
+def explain_hot_queries_command(seed, verbose):
+    """Fail if a hot query does a full table scan"""
+    from migrations import apply_migrations
+    apply_migrations()
+    failures = 0
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            if seed:
+                click.echo(f'Seeding {seed} synthetic batteries...')
+                seed_rows(connection, seed)
+            for name, statement in hot_queries():
+                plan = explain(connection, statement)
+                scans = full_scans(connection, plan)
+                click.echo(f'{"FULL SCAN" if scans else "ok":9}  {name}' + (f'  ({"; ".join(scans)})' if scans else ''))
+                if verbose:
+                    for line in plan:
+                        click.echo(f'           {line}')
+                failures += bool(scans)
+        finally:
+            transaction.rollback()
+
+    if failures:
+        click.echo(f'{failures} hot query(s) fall back to full table scans.')
+        raise SystemExit(1)
@@ -0,0 +1,180 @@
+"""
+Bulk battery intake for fleet drop-offs.
+
+A CSV or JSON list of batteries is validated row by row, then registered with
+set-based statements in one transaction: one upsert for all customers (keyed
+on the normalized mobile, existing customers keep their details), one block
+of battery IDs, one multi-row insert each for the batteries and their initial
+status history, and one counter update per status/month touched.
+"""
+import csv
+import io
+import json
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from models import Customer, Battery, BatteryStatusHistory, normalize_mobile, get_indian_now
+from battery_ids import battery_ids
+from counters import battery_snapshot, record_new_batteries
+
+MAX_INTAKE_ROWS = 500
+
+INTAKE_FIELDS = ['customer_name', 'mobile', 'mobile_secondary', 'battery_type', 'voltage', 'capacity',
+                 'is_pickup', 'pickup_charge']
+REQUIRED_FIELDS = ['customer_name', 'mobile', 'battery_type', 'voltage', 'capacity']
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+
+
+class IntakeError(ValueError):
+    """The uploaded list could not be read at all"""
+
+
+def read_rows(filename, content):
+    """Parse an uploaded .csv or .json file into a list of dicts"""
+    text = content.decode('utf-8-sig') if isinstance(content, bytes) else content
+    if filename.lower().endswith('.json'):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            raise IntakeError(f'Invalid JSON: {e}')
+        return rows_from_json(data)
+    if filename.lower().endswith('.csv'):
+        reader = csv.DictReader(io.StringIO(text))
+        missing = [field for field in REQUIRED_FIELDS if field not in (reader.fieldnames or [])]
+        if missing:
+            raise IntakeError(f'CSV is missing the column(s): {", ".join(missing)}')
+        return list(reader)
+    raise IntakeError('Please upload a .csv or .json file.')
+
+
+def rows_from_json(data):
+    """Accept a list of batteries or {"batteries": [...]}"""
+    if isinstance(data, dict):
+        data = data.get('batteries')
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise IntakeError('Expected a JSON list of batteries.')
+    return data
+
+
+def clean_row(row, defaults):
+    """Return (values, error) for one input row, filling blanks from defaults"""
+    values = {}
+    for field in INTAKE_FIELDS:
+        value = row.get(field)
+        if value is None or str(value).strip() == '':
+            value = defaults.get(field)
+        values[field] = str(value).strip() if value is not None else ''
+
+    missing = [field for field in REQUIRED_FIELDS if not values[field]]
+    if missing:
+        return None, f'Missing {", ".join(missing)}'
+    values['mobile_normalized'] = normalize_mobile(values['mobile'])
+    if not values['mobile_normalized']:
+        return None, f'Invalid mobile number {values["mobile"]!r}'
+    values['mobile_secondary'] = values['mobile_secondary'] or None
+    values['is_pickup'] = values['is_pickup'].lower() in TRUE_VALUES
+    try:
+        values['pickup_charge'] = float(values['pickup_charge'] or 0) if values['is_pickup'] else 0.0
+    except ValueError:
+        return None, f'Invalid pickup charge {values["pickup_charge"]!r}'
+    if values['pickup_charge'] < 0:
+        return None, 'Pickup charge cannot be negative'
+    return values, None
+
+
+def upsert_customers(rows, created_at):
+    """Create the customers that do not exist yet; return {mobile_normalized: customer id}"""
+    customers = {}
+    for row in rows:
+        # The first row for a number decides the name of a new customer
+        customers.setdefault(row['mobile_normalized'], {
+            'name': row['customer_name'],
+            'mobile': row['mobile'],
+            'mobile_secondary': row['mobile_secondary'],
+            'mobile_normalized': row['mobile_normalized'],
+            'created_at': created_at,
+        })
+    if not customers:
+        return {}
+
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        db.session.execute(
+            dialect_insert(Customer.__table__).values(list(customers.values()))
+            .on_conflict_do_nothing(index_elements=['mobile_normalized'])
+        )
+    else:
+        existing = set(db.session.execute(
+            select(Customer.mobile_normalized).where(Customer.mobile_normalized.in_(list(customers)))
+        ).scalars())
+        new_customers = [values for normalized, values in customers.items() if normalized not in existing]
+        if new_customers:
+            db.session.execute(insert(Customer.__table__), new_customers)
+
+    return dict(db.session.execute(
+        select(Customer.mobile_normalized, Customer.id).where(Customer.mobile_normalized.in_(list(customers)))
+    ).all())
+
+
+def register_batteries(rows, user_id, defaults=None):
+    """Register every valid row in one transaction and return per-row results.
+
+    Each result is a dict with the 1-based row number, status ('registered'
+    or 'error'), and either the new battery's id/battery_id or an error.
+    The caller commits.
+    """
+    if len(rows) > MAX_INTAKE_ROWS:
+        raise IntakeError(f'At most {MAX_INTAKE_ROWS} batteries can be registered at once, got {len(rows)}.')
+
+    results = []
+    valid = []
+    for number, row in enumerate(rows, start=1):
+        values, error = clean_row(row, defaults or {})
+        if error:
+            results.append({'row': number, 'status': 'error', 'error': error})
+        else:
+            results.append({'row': number, 'status': 'registered', 'customer_name': values['customer_name']})
+            valid.append((results[-1], values))
+    if not valid:
+        return results
+
+    # IDs are reserved on their own connection, before this session writes anything
+    new_ids = battery_ids.take(len(valid))
+    now = get_indian_now()
+    customer_ids = upsert_customers([values for _, values in valid], now)
+
+    battery_rows = []
+    for battery_id, (result, values) in zip(new_ids, valid):
+        result['battery_id'] = battery_id
+        battery_rows.append({
+            'battery_id': battery_id,
+            'customer_id': customer_ids[values['mobile_normalized']],
+            'battery_type': values['battery_type'],
+            'voltage': values['voltage'],
+            'capacity': values['capacity'],
+            'status': 'Received',
+            'inward_date': now,
+            'service_price': 0.0,
+            'is_pickup': values['is_pickup'],
+            'pickup_charge': values['pickup_charge'],
+        })
+    db.session.execute(insert(Battery.__table__), battery_rows)
+
+    pks = dict(db.session.execute(
+        select(Battery.battery_id, Battery.id).where(Battery.battery_id.in_(new_ids))
+    ).all())
+    for result, _ in valid:
+        result['id'] = pks[result['battery_id']]
+
+    db.session.execute(insert(BatteryStatusHistory.__table__), [{
+        'battery_id': pks[row['battery_id']],
+        'status': 'Received',
+        'comments': f'Battery received from customer (bulk intake){" - Pickup service" if row["is_pickup"] else ""}',
+        'updated_by': user_id,
+        'updated_at': now,
+    } for row in battery_rows])
+
+    record_new_batteries(battery_snapshot(Battery(**row)) for row in battery_rows)
+    return results
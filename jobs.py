@@ -0,0 +1,311 @@
+"""
+Background jobs for long exports, backups and reports.
+
+The web request only inserts a row into background_job and returns; `flask
+run-jobs` is a separate worker process with a small thread pool that claims
+queued jobs (SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL, a conditional
+UPDATE on SQLite), streams the artifact to a file under JOB_DIR (default
+instance/jobs, shared with the web container) and records when the job was
+queued, started and finished. The development server (`python main.py`)
+runs the same worker on a thread of its own process instead.
+
+While a job runs the worker writes a heartbeat and its progress every few
+seconds and checks whether a cancel was requested. Jobs whose worker died
+are marked failed after JOB_STALE_MINUTES. Finished jobs and their files
+are deleted after JOB_RETENTION_HOURS.
+"""
+import csv
+import io
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from app import db
+from database import use_replica
+from models import BackgroundJob, get_indian_now
+
+JOB_THREADS = int(os.environ.get('JOB_THREADS', 2))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24))
+JOB_STALE_MINUTES = float(os.environ.get('JOB_STALE_MINUTES', 10))
+HEARTBEAT_SECONDS = 3
+CLEANUP_SECONDS = 600
+
+# kind -> (label, function(params) returning (filename, mimetype, byte chunks))
+JOB_KINDS = {}
+
+# Kinds that only read, so they run on the read replica when there is one
+READ_ONLY_KINDS = set()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_kind(name, label, read_only=False):
+    def register(function):
+        JOB_KINDS[name] = (label, function)
+        if read_only:
+            READ_ONLY_KINDS.add(name)
+        return function
+    return register
+
+
+@job_kind('battery_csv', 'Battery CSV export', read_only=True)
+def battery_csv_job(params):
+    from date_ranges import range_from_args
+    from exports import battery_csv_lines, encode_stream
+    compress = params.get('gzip', False)
+    filename = f'battery_records_{params["requested_at"]}.csv' + ('.gz' if compress else '')
+    lines = battery_csv_lines(params.get('statuses'), range_from_args(params.get('range', {})))
+    return filename, 'application/gzip' if compress else 'text/csv', encode_stream(lines, compress)
+
+
+@job_kind('backup', 'Backup', read_only=True)
+def backup_job(params):
+    from backups import backup_stream, backup_filename
+    since = datetime.fromisoformat(params['since']) if params.get('since') else None
+    from database import read_engine
+    return (backup_filename(incremental=since is not None), 'application/gzip',
+            backup_stream(engine=read_engine(), since=since))
+
+
+@job_kind('yearly_report', 'Yearly report', read_only=True)
+def yearly_report_job(params):
+    from counters import get_year_breakdown
+    from date_ranges import year_range
+    from exports import battery_csv_lines, encode_stream
+    year = int(params['year'])
+
+    def lines():
+        totals, breakdown = get_year_breakdown(year)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow([f'Yearly Report {year}'])
+        writer.writerow(['Month', 'Completed Batteries', 'Revenue'])
+        for month in breakdown:
+            writer.writerow([month['month'], month['count'], f'{month["revenue"]:.2f}'])
+        writer.writerow(['Total', totals['completed_count'], f'{totals["revenue"]:.2f}'])
+        writer.writerow([])
+        yield output.getvalue()
+        yield from battery_csv_lines(date_range=year_range(year))
+
+    return f'yearly_report_{year}.csv', 'text/csv', encode_stream(lines())
+
+
+def enqueue_job(kind, params, user_id):
+    """Queue a job and return it (the caller commits)"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind {kind}')
+    job = BackgroundJob(kind=kind, params=json.dumps(params), created_by=user_id, status='queued')
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+def cancel_job(job_id):
+    """Cancel a queued job, or ask the worker to stop a running one (the caller commits).
+
+    Returns False if the job had already finished.
+    """
+    table = BackgroundJob.__table__
+    cancelled = db.session.execute(
+        table.update().where(table.c.id == job_id, table.c.status == 'queued')
+        .values(status='cancelled', finished_at=get_indian_now())
+    ).rowcount
+    if not cancelled:
+        cancelled = db.session.execute(
+            table.update().where(table.c.id == job_id, table.c.status == 'running').values(cancel_requested=True)
+        ).rowcount
+    return bool(cancelled)
+
+
+def job_label(job):
+    return JOB_KINDS.get(job.kind, (job.kind,))[0]
+
+
+def job_dir():
+    directory = os.environ.get('JOB_DIR') or os.path.join(current_app.instance_path, 'jobs')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _update(job_id, **values):
+    table = BackgroundJob.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(table.update().where(table.c.id == job_id).values(**values)).rowcount
+
+
+def claim_next_job(worker):
+    """Mark the oldest queued job as running for worker and return its id"""
+    table = BackgroundJob.__table__
+    while True:
+        with db.engine.begin() as connection:
+            query = select(table.c.id).where(table.c.status == 'queued') \
+                .order_by(table.c.created_at, table.c.id).limit(1)
+            if connection.dialect.name == 'postgresql':
+                query = query.with_for_update(skip_locked=True)
+            job_id = connection.execute(query).scalar()
+            if job_id is None:
+                return None
+            now = get_indian_now()
+            # The status condition makes the claim safe where SKIP LOCKED is not available
+            claimed = connection.execute(
+                table.update().where(table.c.id == job_id, table.c.status == 'queued')
+                .values(status='running', started_at=now, heartbeat_at=now, worker=worker)
+            ).rowcount
+        if claimed:
+            return job_id
+
+
+def run_job(job_id):
+    """Produce the artifact of a claimed job and record the outcome"""
+    job = db.session.get(BackgroundJob, job_id)
+    kind, params = job.kind, job.params
+    db.session.rollback()
+    path = os.path.join(job_dir(), f'job-{job_id}')
+    partial = path + '.part'
+    size = 0
+    try:
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job kind {kind}')
+        # Progress and outcome are written with db.engine, so they still reach the primary
+        with use_replica() if kind in READ_ONLY_KINDS else nullcontext():
+            filename, mimetype, chunks = JOB_KINDS[kind][1](json.loads(params or '{}'))
+            last_heartbeat = time.monotonic()
+            with open(partial, 'wb') as fileobj:
+                for chunk in chunks:
+                    fileobj.write(chunk)
+                    size += len(chunk)
+                    if time.monotonic() - last_heartbeat >= HEARTBEAT_SECONDS:
+                        last_heartbeat = time.monotonic()
+                        _heartbeat(job_id, f'{size / 1e6:.1f} MB written')
+        path += os.path.splitext(filename)[1]
+        os.replace(partial, path)
+        _update(job_id, status='done', finished_at=get_indian_now(), progress=f'{size / 1e6:.1f} MB',
+                artifact_path=path, artifact_name=filename,
+                artifact_size=size, mimetype=mimetype)
+    except JobCancelled:
+        _update(job_id, status='cancelled', finished_at=get_indian_now(), progress=f'Cancelled after {size / 1e6:.1f} MB')
+    except Exception as e:
+        current_app.logger.exception(f'{kind} job {job_id} failed')
+        _update(job_id, status='failed', finished_at=get_indian_now(), error=str(e))
+    finally:
+        db.session.remove()
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def _heartbeat(job_id, progress):
+    """Record progress; raise JobCancelled if a cancel was requested"""
+    table = BackgroundJob.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.update().where(table.c.id == job_id)
+                           .values(heartbeat_at=get_indian_now(), progress=progress))
+        cancel = connection.execute(select(table.c.cancel_requested).where(table.c.id == job_id)).scalar()
+    if cancel is None or cancel:
+        raise JobCancelled()
+
+
+def recover_stale_jobs():
+    """Fail running jobs whose worker stopped sending heartbeats"""
+    table = BackgroundJob.__table__
+    now = get_indian_now()
+    with db.engine.begin() as connection:
+        return connection.execute(
+            table.update().where(table.c.status == 'running',
+                                 table.c.heartbeat_at < now - timedelta(minutes=JOB_STALE_MINUTES))
+            .values(status='failed', finished_at=now, error='The worker stopped while running this job')
+        ).rowcount
+
+
+def cleanup_jobs(retention_hours=JOB_RETENTION_HOURS):
+    """Delete finished jobs older than the retention period, their files and stray files"""
+    table = BackgroundJob.__table__
+    cutoff = get_indian_now() - timedelta(hours=retention_hours)
+    with db.engine.begin() as connection:
+        expired = connection.execute(
+            select(table.c.id, table.c.artifact_path)
+            .where(table.c.status.in_(['done', 'failed', 'cancelled']), table.c.finished_at < cutoff)
+        ).all()
+        for _, path in expired:
+            if path and os.path.exists(path):
+                os.remove(path)
+        if expired:
+            connection.execute(table.delete().where(table.c.id.in_([job_id for job_id, _ in expired])))
+        kept = set(connection.execute(select(table.c.artifact_path).where(table.c.artifact_path.isnot(None))).scalars())
+
+    # Files left behind by jobs deleted some other way (e.g. a restore)
+    directory = job_dir()
+    oldest = time.time() - retention_hours * 3600
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path not in kept and not name.endswith('.part') and os.path.getmtime(path) < oldest:
+            os.remove(path)
+    return len(expired)
+
+
+def run_worker(threads=JOB_THREADS, poll=JOB_POLL_SECONDS, once=False):
+    """Run jobs on a pool of threads until SIGTERM/SIGINT (or, with once, until the queue is empty)"""
+    app = current_app._get_current_object()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    stop = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stop.set())
+
+    def loop():
+        with app.app_context():
+            while not stop.is_set():
+                job_id = claim_next_job(worker)
+                if job_id is None:
+                    if once:
+                        return
+                    stop.wait(poll)
+                    continue
+                run_job(job_id)
+
+    recover_stale_jobs()
+    cleanup_jobs()
+    pool = [threading.Thread(target=loop, name=f'job-{number}', daemon=True) for number in range(threads)]
+    for thread in pool:
+        thread.start()
+    last_cleanup = time.monotonic()
+    while any(thread.is_alive() for thread in pool):
+        for thread in pool:
+            thread.join(timeout=1)
+        if time.monotonic() - last_cleanup >= CLEANUP_SECONDS:
+            last_cleanup = time.monotonic()
+            recover_stale_jobs()
+            cleanup_jobs()
+
+
+def start_worker_thread(app, threads=JOB_THREADS):
+    """Run the job worker on a daemon thread of this process, for the development server"""
+
+    def work():
+        with app.app_context():
+            run_worker(threads)
+
+    thread = threading.Thread(target=work, name='job-worker', daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command('run-jobs')
+@click.option('--threads', default=JOB_THREADS, help='Jobs run at the same time.')
+@click.option('--poll', default=JOB_POLL_SECONDS, help='Seconds between checks for new jobs.')
+@click.option('--once', is_flag=True, help='Run the queued jobs and exit.')
+@with_appcontext
+def run_jobs_command(threads, poll, once):
+    """Run queued exports, backups and reports (the background job worker)"""
+    click.echo(f'Job worker started with {threads} threads, files in {job_dir()}')
+    run_worker(threads, poll, once)
@@ -0,0 +1,139 @@
+"""
+Eager-loading profiles and query budgets for the list views.
+
+Every list view loads its batteries with the profile matching what its
+template touches, so rendering N rows costs a fixed number of queries
+instead of one or more per row. `flask check-query-budgets` renders each
+view against 10 to 10,000 seeded batteries (inside a transaction that is
+rolled back) and fails if any view goes over its declared budget.
+"""
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import joinedload, selectinload, contains_eager, with_expression, configure_mappers
+from app import db
+from models import User, Battery, BatteryStaffNote, BatteryMaterialUsage, StockTransaction, BackgroundJob
+
+# Backrefs such as Battery.customer only exist once the mappers are configured
+configure_mappers()
+
+# battery.customer only
+CUSTOMER = (joinedload(Battery.customer),)
+
+# Same, for queries that already join Customer (filters, pagination)
+JOINED_CUSTOMER = (contains_eager(Battery.customer),)
+
+# Note count badges on the finished / delivered / not repairable lists
+NOTE_COUNTS = CUSTOMER + (
+    with_expression(
+        Battery.note_count,
+        select(func.count(BatteryStaffNote.id))
+        .where(BatteryStaffNote.battery_id == Battery.id)
+        .correlate(Battery).scalar_subquery()
+    ),
+)
+
+# Technician panel cards: history and materials used
+WORK_DETAILS = CUSTOMER + (
+    selectinload(Battery.status_history),
+    selectinload(Battery.materials_used).joinedload(BatteryMaterialUsage.inventory_item),
+)
+
+# Inventory transaction lists
+TRANSACTION_DETAILS = (
+    joinedload(StockTransaction.inventory_item),
+    joinedload(StockTransaction.user),
+)
+
+# Background job list (admins see who started each job)
+JOB_CREATOR = (joinedload(BackgroundJob.creator),)
+
+# Maximum queries per request, with room for the Flask-Login user lookup
+# (usually answered from the reference cache, but it reloads now and then).
+# Each must hold no matter how many rows the view renders.
+QUERY_BUDGETS = {
+    'main.dashboard': 3,
+    'main.technician_panel': 6,
+    'main.search': 4,
+    'main.finished_batteries': 2,
+    'main.delivered_batteries': 2,
+    'main.not_repairable_batteries': 2,
+    'main.all_batteries': 4,
+    'main.all_bills': 6,
+    'main.monthly_report': 3,
+    'main.yearly_report': 3,
+    'main.inventory_dashboard': 5,
+    'main.stock_transactions': 2,
+    'main.jobs': 2,
+}
+
+# (endpoint, method, path, form data) requests driven by the budget check
+BUDGET_REQUESTS = [
+    ('main.dashboard', 'GET', '/dashboard', None),
+    ('main.technician_panel', 'GET', '/technician/panel', None),
+    ('main.technician_panel', 'POST', '/technician/panel', {'search_query': ''}),
+    ('main.technician_panel', 'GET', '/technician/panel?search=Seed', None),
+    ('main.search', 'POST', '/search', {'search_query': 'Seed Customer 1'}),
+    ('main.finished_batteries', 'GET', '/finished_batteries', None),
+    ('main.delivered_batteries', 'GET', '/delivered_batteries', None),
+    ('main.not_repairable_batteries', 'GET', '/not_repairable_batteries', None),
+    ('main.all_batteries', 'GET', '/all_batteries?page=2', None),
+    ('main.all_bills', 'GET', '/all_bills', None),
+    ('main.monthly_report', 'GET', '/reports/monthly', None),
+    ('main.yearly_report', 'GET', '/reports/yearly', None),
+    ('main.inventory_dashboard', 'GET', '/inventory/dashboard', None),
+    ('main.stock_transactions', 'GET', '/inventory/transactions', None),
+    ('main.jobs', 'GET', '/jobs', None),
+]
+
+
+@click.command('check-query-budgets')
+@click.option('--sizes', default='10,100,1000,10000', help='Comma separated battery counts to test with.')
+@with_appcontext
+def check_query_budgets_command(sizes):
+    """Fail if a list view issues more queries than its budget"""
+    from indexes import seed_rows
+
+    counts = []
+
+    def count_query(*args):
+        counts.append(1)
+
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    client = current_app.test_client()
+    admin_id = db.session.execute(select(User.id).where(User.role == 'admin').limit(1)).scalar()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+
+    # Budgets are for a warm worker: the first request also loads the reference data cache
+    client.get('/login')
+
+    failures = 0
+    seeded = 0
+    try:
+        # Requests reuse this app context and therefore this session and its
+        # open transaction, so they see the seeded rows until the rollback.
+        for size in [int(size) for size in sizes.split(',')]:
+            seed_rows(db.session.connection(), size - seeded)
+            seeded = size
+            click.echo(f'-- {size} batteries')
+            for endpoint, method, path, data in BUDGET_REQUESTS:
+                counts.clear()
+                started = time.perf_counter()
+                response = client.open(path, method=method, data=data)
+                elapsed = (time.perf_counter() - started) * 1000
+                budget = QUERY_BUDGETS[endpoint]
+                over = response.status_code != 200 or len(counts) > budget
+                click.echo(f'{"OVER" if over else "ok":4}  {method:4} {path:40} {len(counts):3}/{budget} queries '
+                           f'{elapsed:8.1f} ms  HTTP {response.status_code}')
+                failures += over
+    finally:
+        db.session.rollback()
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    if failures:
+        click.echo(f'{failures} request(s) went over their query budget.')
+        raise SystemExit(1)
@@ -0,0 +1,441 @@
+"""
+Load test that replays the shop's daily workflows over HTTP.
+
+Virtual users log in through /login as shop staff, technicians and admins
+and loop over weighted scenarios:
+
+- shop_staff: battery_entry (intake form and submit), deliver_and_bill
+  (hand over a Ready battery, then open its bill) and dashboard polling.
+- technician: technician_panel (search for a battery being worked on),
+  update_battery_status (Received -> Pending -> Ready with a price),
+  use_material and dashboard polling.
+- admin: dashboard polling, bill and technician_panel.
+
+Batteries flow between the roles: staff intake feeds the technicians,
+whose Ready batteries are delivered and billed by staff. A scenario without
+work waiting (nothing Ready yet, say) polls the dashboard instead.
+
+Each user keeps one keep-alive connection and its own session cookie. It
+follows redirects the way a browser does, so a step's latency covers the
+POST and the page it lands on, and waits a random think time (--think) between
+scenarios. A response counts as an error when it is an HTTP error, when it
+lands on the login page, or when it shows an error flash message. The report
+has the following per step, counted after the --ramp period:
+- throughput
+- error rate
+- latency p50/p90/p95/p99
+- the database time from the Server-Timing header
+
+It is written as JSON and compared between runs with `compare`:
+
+    python loadtest.py run --url http://localhost:5000 --staff 4 --technicians 4 --admins 1 --duration 120 --output before.json
+    python loadtest.py compare before.json after.json
+
+Only the standard library and click are used and the app is not imported, so
+it runs from any checkout against the dev server or gunicorn. It registers
+batteries and changes stock: point it at a scratch database filled with
+`flask generate-data`, which also provides the inventory items.
+"""
+import http.client
+import json
+import random
+import re
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+import click
+
+ROLE_SCENARIOS = {
+    'shop_staff': {'battery_entry': 3, 'deliver_and_bill': 2, 'dashboard': 4},
+    'technician': {'technician_panel': 4, 'update_battery_status': 4, 'use_material': 2, 'dashboard': 1},
+    'admin': {'dashboard': 4, 'bill': 1, 'technician_panel': 1},
+}
+DEFAULT_LOGINS = {'shop_staff': 'staff:staff123', 'technician': 'technician:tech123', 'admin': 'admin:admin123'}
+
+BATTERY_TYPES = [('Car', '12V', '65Ah'), ('Two Wheeler', '12V', '7Ah'), ('Inverter', '12V', '150Ah'),
+                 ('UPS', '12V', '26Ah'), ('E-Rickshaw', '48V', '120Ah')]
+FIRST_NAMES = ['Ravi', 'Suresh', 'Anita', 'Kiran', 'Farhan', 'Meena', 'Joseph', 'Lakshmi', 'Arjun', 'Pooja']
+LAST_NAMES = ['Kumar', 'Reddy', 'Sharma', 'Khan', 'Nair', 'Patel', 'Das', 'Iyer']
+
+REGISTERED = re.compile(r'Battery (\S+) has been successfully registered')
+RECEIPT_URL = re.compile(r'/receipt/(\d+)')
+ITEM_OPTION = re.compile(r'<option value="(\d+)"\s*>')
+ERROR_FLASH = re.compile(r'alert-danger alert-dismissible[^>]*>\s*([^<]*?)\s*<')
+SERVER_TIMING_DB = re.compile(r'\bdb;dur=([\d.]+)')
+MAX_REDIRECTS = 5
+ERROR_SAMPLES = 5
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+class Recorder:
+    """Latency samples and errors per step, shared by all virtual users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.measure_from = None
+        self.steps = {}
+        self.scenarios = {}
+
+    def record(self, step, started, ms, db_ms, error):
+        if self.measure_from is None or started < self.measure_from:
+            return
+        with self._lock:
+            samples = self.steps.setdefault(step, {'ms': [], 'db_ms': [], 'errors': 0, 'error_samples': []})
+            samples['ms'].append(ms)
+            if db_ms is not None:
+                samples['db_ms'].append(db_ms)
+            if error:
+                samples['errors'] += 1
+                if len(samples['error_samples']) < ERROR_SAMPLES:
+                    samples['error_samples'].append(error)
+
+    def record_scenario(self, scenario, started):
+        if self.measure_from is not None and started >= self.measure_from:
+            with self._lock:
+                self.scenarios[scenario] = self.scenarios.get(scenario, 0) + 1
+
+    def summary(self, seconds):
+        steps = {}
+        with self._lock:
+            snapshot = {step: dict(samples, ms=sorted(samples['ms']), db_ms=sorted(samples['db_ms']))
+                        for step, samples in self.steps.items()}
+            scenarios = dict(self.scenarios)
+        for step, samples in sorted(snapshot.items()):
+            timings = samples['ms']
+            steps[step] = {
+                'requests': len(timings),
+                'errors': samples['errors'],
+                'error_rate': round(samples['errors'] / len(timings), 4),
+                'throughput_rps': round(len(timings) / seconds, 2),
+                'mean_ms': round(statistics.mean(timings), 1),
+                'p50_ms': round(percentile(timings, 0.5), 1),
+                'p90_ms': round(percentile(timings, 0.9), 1),
+                'p95_ms': round(percentile(timings, 0.95), 1),
+                'p99_ms': round(percentile(timings, 0.99), 1),
+                'max_ms': round(timings[-1], 1),
+                'db_p50_ms': round(percentile(samples['db_ms'], 0.5), 1) if samples['db_ms'] else None,
+                'error_samples': samples['error_samples'],
+            }
+        return steps, {scenario: round(count / seconds, 2) for scenario, count in sorted(scenarios.items())}
+
+
+class Shop:
+    """Batteries handed from one role to the next during the run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.received = deque()
+        self.pending = deque()
+        self.ready = deque()
+        self.delivered = deque(maxlen=1000)
+        self.item_ids = []
+
+    def take(self, queue):
+        with self._lock:
+            return queue.popleft() if queue else None
+
+    def put(self, queue, battery):
+        with self._lock:
+            queue.append(battery)
+
+    def peek_random(self, *queues):
+        with self._lock:
+            candidates = [battery for queue in queues for battery in list(queue)[-50:]]
+        return random.choice(candidates) if candidates else None
+
+
+class VirtualUser:
+    def __init__(self, base_url, role, username, password, recorder, shop, timeout):
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self.role = role
+        self.username = username
+        self.password = password
+        self.recorder = recorder
+        self.shop = shop
+        self.cookies = {}
+
+    def _send(self, method, path, data):
+        body = urlencode(data).encode() if data is not None else None
+        headers = {'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items())}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnect once, e.g. when the server closed an idle keep-alive connection
+            self.connection.close()
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response, content
+
+    def request(self, step, method, path, data=None):
+        """Run one step, following redirects; returns (final path, page text) or None on error"""
+        started = time.monotonic()
+        error = None
+        db_ms = None
+        text = ''
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                response, content = self._send(method, path, data)
+                timing = SERVER_TIMING_DB.search(response.headers.get('Server-Timing', ''))
+                if timing:
+                    db_ms = (db_ms or 0.0) + float(timing.group(1))
+                if response.status in (301, 302, 303) and response.headers.get('Location'):
+                    location = urlsplit(response.headers['Location'])
+                    path = location.path.removeprefix(self.prefix) + (f'?{location.query}' if location.query else '')
+                    method, data = 'GET', None
+                    continue
+                break
+            text = content.decode('utf-8', 'replace')
+            if response.status >= 400:
+                error = f'HTTP {response.status} on {path}'
+            elif path.startswith('/login') and step != 'login':
+                error = 'Logged out'
+            else:
+                flash = ERROR_FLASH.search(text)
+                if flash:
+                    error = flash.group(1)[:200]
+        except (OSError, http.client.HTTPException) as e:
+            error = f'{type(e).__name__}: {e}'
+            self.connection.close()
+        self.recorder.record(step, started, (time.monotonic() - started) * 1000, db_ms, error)
+        return None if error else (path, text)
+
+    def login(self):
+        page = self.request('login', 'POST', '/login', {'username': self.username, 'password': self.password})
+        return page is not None and not page[0].startswith('/login')
+
+    # Scenarios return False when there was no work for them
+
+    def dashboard(self):
+        self.request('dashboard', 'GET', '/dashboard')
+
+    def battery_entry(self):
+        if self.request('battery_entry_form', 'GET', '/battery/entry') is None:
+            return
+        battery_type, voltage, capacity = random.choice(BATTERY_TYPES)
+        mobile = str(random.randrange(6_000_000_000, 10_000_000_000))
+        is_pickup = random.random() < 0.12
+        page = self.request('battery_entry', 'POST', '/battery/entry', {
+            'customer_name': f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}', 'mobile': mobile,
+            'battery_type': battery_type, 'voltage': voltage, 'capacity': capacity,
+            'is_pickup': '1' if is_pickup else '0', 'pickup_charge': '100' if is_pickup else '0',
+        })
+        if page:
+            pk, code = RECEIPT_URL.search(page[0]), REGISTERED.search(page[1])
+            if pk:
+                self.shop.put(self.shop.received, (int(pk.group(1)), code.group(1) if code else mobile, mobile))
+
+    def technician_panel(self):
+        battery = self.shop.peek_random(self.shop.received, self.shop.pending)
+        if battery is None:
+            return False
+        page = self.request('technician_panel', 'POST', '/technician/panel', {'search_query': battery[1]})
+        if page and not self.shop.item_ids:
+            self.shop.item_ids = [int(item_id) for item_id in ITEM_OPTION.findall(page[1])]
+
+    def update_battery_status(self):
+        if self.shop.pending and random.random() < 0.5:
+            battery = self.shop.take(self.shop.pending)
+            if battery and self.request('update_battery_status', 'POST', '/battery/update', {
+                    'battery_id': battery[0], 'status': 'Ready', 'comments': 'Repaired and load tested',
+                    'service_price': random.choice([350, 600, 900, 1400])}):
+                self.shop.put(self.shop.ready, battery)
+                return
+        battery = self.shop.take(self.shop.received)
+        if battery is None:
+            return False
+        if self.request('update_battery_status', 'POST', '/battery/update', {
+                'battery_id': battery[0], 'status': 'Pending', 'comments': 'Checking cells'}):
+            self.shop.put(self.shop.pending, battery)
+
+    def use_material(self):
+        battery = self.shop.peek_random(self.shop.received, self.shop.pending)
+        if battery is None or not self.shop.item_ids:
+            return False
+        self.request('use_material', 'POST', '/inventory/use_material', {
+            'battery_id': battery[0], 'item_id': random.choice(self.shop.item_ids), 'quantity': '0.1',
+            'notes': 'Load test'})
+
+    def deliver_and_bill(self):
+        battery = self.shop.take(self.shop.ready)
+        if battery is None:
+            return False
+        if self.request('deliver_and_bill', 'POST', f'/battery/{battery[0]}/deliver_and_bill',
+                        {'delivery_type': 'delivered', 'comments': ''}):
+            self.shop.put(self.shop.delivered, battery)
+            self.request('bill', 'GET', f'/bill/{battery[0]}')
+
+    def bill(self):
+        battery = self.shop.peek_random(self.shop.delivered)
+        if battery is None:
+            return False
+        self.request('bill', 'GET', f'/bill/{battery[0]}')
+
+    def run(self, deadline, think):
+        scenarios = ROLE_SCENARIOS[self.role]
+        names, weights = list(scenarios), list(scenarios.values())
+        while time.monotonic() < deadline:
+            scenario = random.choices(names, weights=weights)[0]
+            started = time.monotonic()
+            if getattr(self, scenario)() is False:
+                scenario = 'dashboard'
+                self.dashboard()
+            self.recorder.record_scenario(scenario, started)
+            if think:
+                time.sleep(min(random.expovariate(1 / think), think * 5, max(0.0, deadline - time.monotonic())))
+        self.connection.close()
+
+
+def run_load(url, users, logins, duration, ramp, think, timeout=30):
+    """Run the virtual users; returns the results dictionary"""
+    recorder = Recorder()
+    shop = Shop()
+    virtual_users = []
+    for role, count in users.items():
+        username, _, password = logins[role].partition(':')
+        virtual_users += [VirtualUser(url, role, username, password, recorder, shop, timeout) for _ in range(count)]
+    if not virtual_users:
+        raise click.UsageError('Give at least one user (--staff, --technicians or --admins).')
+
+    recorder.measure_from = 0.0  # Record the logins, which happen before the clock starts
+    for user in virtual_users:
+        if not user.login():
+            raise click.ClickException(f'Could not log in as {user.username} ({user.role}) at {url}.')
+    login_stats, _ = recorder.summary(1)
+    recorder.steps.clear()
+
+    started = time.monotonic()
+    deadline = started + ramp + duration
+    recorder.measure_from = started + ramp
+    threads = []
+    for index, user in enumerate(virtual_users):
+        thread = threading.Thread(target=user.run, args=(deadline, think), daemon=True)
+        threads.append(thread)
+        thread.start()
+        # Spread the starts over the ramp period
+        time.sleep(ramp / len(virtual_users) if ramp else 0)
+    for thread in threads:
+        thread.join(timeout=max(0.0, deadline - time.monotonic()) + timeout)
+
+    steps, scenarios = recorder.summary(duration)
+    requests = sum(step['requests'] for step in steps.values())
+    errors = sum(step['errors'] for step in steps.values())
+    return {
+        'url': url,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'duration_s': duration,
+        'ramp_s': ramp,
+        'think_s': think,
+        'users': users,
+        'totals': {'requests': requests, 'errors': errors,
+                   'error_rate': round(errors / requests, 4) if requests else 0.0,
+                   'throughput_rps': round(requests / duration, 2)},
+        'scenarios_per_s': scenarios,
+        'login': login_stats.get('login'),
+        'steps': steps,
+    }
+
+
+def print_report(results):
+    totals = results['totals']
+    click.echo(f'{totals["requests"]} requests in {results["duration_s"]}s: {totals["throughput_rps"]} req/s, '
+               f'{totals["error_rate"] * 100:.2f}% errors ({", ".join(f"{role} {count}" for role, count in results["users"].items())})')
+    click.echo(f'{"step":24} {"req/s":>8} {"errors":>7} {"p50":>8} {"p90":>8} {"p95":>8} {"p99":>8} {"max":>8} {"db p50":>8}')
+    for step, stats in results['steps'].items():
+        db_p50 = f'{stats["db_p50_ms"]:8.1f}' if stats['db_p50_ms'] is not None else f'{"-":>8}'
+        click.echo(f'{step:24} {stats["throughput_rps"]:8.2f} {stats["error_rate"] * 100:6.2f}% '
+                   f'{stats["p50_ms"]:8.1f} {stats["p90_ms"]:8.1f} {stats["p95_ms"]:8.1f} {stats["p99_ms"]:8.1f} '
+                   f'{stats["max_ms"]:8.1f} {db_p50}')
+        for error in stats['error_samples']:
+            click.echo(f'    error: {error}')
+
+
+@click.group()
+def cli():
+    """Load test the ERP over HTTP"""
+
+
+@cli.command('run')
+@click.option('--url', default='http://localhost:5000', help='Server to test.')
+@click.option('--staff', default=2, help='Shop staff users.')
+@click.option('--technicians', default=2, help='Technician users.')
+@click.option('--admins', default=1, help='Admin users.')
+@click.option('--duration', default=60.0, help='Measured seconds, after the ramp.')
+@click.option('--ramp', default=10.0, help='Seconds over which the users start (not measured).')
+@click.option('--think', default=1.0, help='Mean think time between scenarios in seconds (0 = no pauses).')
+@click.option('--staff-login', default=DEFAULT_LOGINS['shop_staff'], help='username:password')
+@click.option('--technician-login', default=DEFAULT_LOGINS['technician'], help='username:password')
+@click.option('--admin-login', default=DEFAULT_LOGINS['admin'], help='username:password')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON.')
+def run_command(url, staff, technicians, admins, duration, ramp, think, staff_login, technician_login, admin_login,
+                output):
+    """Replay weighted shop workflows and report latency per step"""
+    users = {role: count for role, count in
+             [('shop_staff', staff), ('technician', technicians), ('admin', admins)] if count}
+    logins = {'shop_staff': staff_login, 'technician': technician_login, 'admin': admin_login}
+    click.echo(f'{sum(users.values())} users against {url} for {ramp:g}s ramp + {duration:g}s...')
+    results = run_load(url.rstrip('/'), users, logins, duration, ramp, think)
+    print_report(results)
+    if output:
+        with open(output, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2)
+        click.echo(f'Results written to {output}')
+
+
+@cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--max-regression', default=0.2, help='Allowed p95 slowdown (0.2 = 20%).')
+@click.option('--max-error-increase', default=0.01, help='Allowed increase of a step\'s error rate (0.01 = 1 point).')
+def compare_command(baseline, current, max_regression, max_error_increase):
+    """Compare two runs step by step; exit 1 on a regression"""
+    before, after = json.load(baseline), json.load(current)
+    click.echo(f'{before["started_at"]} ({before["totals"]["throughput_rps"]} req/s) -> '
+               f'{after["started_at"]} ({after["totals"]["throughput_rps"]} req/s)')
+    for setting in ['users', 'think_s', 'duration_s']:
+        if before.get(setting) != after.get(setting):
+            click.echo(f'Note: the runs differ in {setting} ({before.get(setting)} vs {after.get(setting)})')
+    click.echo(f'{"step":24} {"req/s":>17} {"p50 ms":>17} {"p95 ms":>17} {"ratio":>6} {"errors":>15}')
+    regressions = []
+    for step in sorted(set(before['steps']) | set(after['steps'])):
+        old, new = before['steps'].get(step), after['steps'].get(step)
+        if old is None or new is None:
+            click.echo(f'{step:24} only in {"the current run" if old is None else "the baseline"}')
+            continue
+        ratio = new['p95_ms'] / old['p95_ms'] if old['p95_ms'] else 1.0
+        # A few milliseconds either way is noise on fast steps
+        slower = ratio > 1 + max_regression and new['p95_ms'] - old['p95_ms'] > 5
+        more_errors = new['error_rate'] - old['error_rate'] > max_error_increase
+        click.echo(f'{step:24} {old["throughput_rps"]:7.2f} -> {new["throughput_rps"]:6.2f} '
+                   f'{old["p50_ms"]:7.1f} -> {new["p50_ms"]:6.1f} {old["p95_ms"]:7.1f} -> {new["p95_ms"]:6.1f} '
+                   f'{ratio:5.2f}x {old["error_rate"] * 100:5.2f}% -> {new["error_rate"] * 100:5.2f}%'
+                   f'{"  SLOWER" if slower else ""}{"  MORE ERRORS" if more_errors else ""}')
+        if slower or more_errors:
+            regressions.append(step)
+    if regressions:
+        click.echo(f'{len(regressions)} step(s) regressed: {", ".join(regressions)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,4 +1,17 @@
-from app import app
+import os
+from app import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
+    # The development server sets up the database itself
+    from bootstrap import init_db, seed_database
+    with app.app_context():
+        init_db()
+        seed_database()
+    # ...and runs the queued exports, backups and reports, in the reloader's
+    # child process, which serves the requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from jobs import start_worker_thread
+        start_worker_thread(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
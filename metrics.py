@@ -0,0 +1,160 @@
+"""
+Prometheus metrics at /metrics.
+
+- erp_request_duration_seconds: latency histogram by endpoint and role
+  (anonymous for logged-out requests), plus erp_responses_total by
+  endpoint and status code.
+- Database pool: connections checked out, overflow connections in use and
+  the pool size per worker, and a histogram of the time spent getting a
+  connection (including opening a new one).
+- erp_worker_info and erp_worker_start_time_seconds identify the worker
+  processes (host:pid, as the job worker names itself).
+- Business throughput: batteries registered, status transitions,
+  deliveries and material usage. They count on commit, so a rolled back
+  request counts nothing.
+
+Under gunicorn every worker writes its samples to memory-mapped files in
+PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py sets it up and clears it when
+the server starts) and a scrape of any worker aggregates all of them.
+Without that variable, e.g. under `flask run`, the process serves its own
+registry. Recording a sample is a dictionary lookup and a write to shared
+memory; no request does any extra database work for it.
+
+Set METRICS_TOKEN to require `Authorization: Bearer <token>` on scrapes.
+"""
+import hmac
+import logging
+import os
+import socket
+import time
+from flask import Response, abort, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+_PENDING_KEY = 'metrics_pending'
+
+REQUEST_DURATION = Histogram(
+    'erp_request_duration_seconds', 'Time to serve a request', ['endpoint', 'role'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+RESPONSES = Counter('erp_responses_total', 'Responses sent', ['endpoint', 'status'])
+
+POOL_CHECKED_OUT = Gauge('erp_db_pool_checked_out', 'Database connections in use', multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('erp_db_pool_overflow', 'Connections open beyond the pool size', multiprocess_mode='livesum')
+POOL_SIZE = Gauge('erp_db_pool_size', 'Connections kept open per worker', multiprocess_mode='liveall')
+POOL_WAIT = Histogram(
+    'erp_db_pool_wait_seconds', 'Time to get a connection from the pool',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+WORKER_INFO = Gauge('erp_worker_info', 'Serving worker processes', ['worker'], multiprocess_mode='liveall')
+WORKER_STARTED = Gauge('erp_worker_start_time_seconds', 'When the worker served its first request',
+                       multiprocess_mode='liveall')
+
+BATTERIES_REGISTERED = Counter('erp_batteries_registered_total', 'Batteries taken in')
+STATUS_TRANSITIONS = Counter('erp_status_transitions_total', 'Battery status changes', ['from_status', 'to_status'])
+DELIVERIES = Counter('erp_deliveries_total', 'Batteries handed back to customers', ['outcome'])
+MATERIAL_USAGE = Counter('erp_material_usage_total', 'Material usage records')
+MATERIAL_QUANTITY = Counter('erp_material_quantity_total', 'Material quantity used', ['unit'])
+
+_identified_pid = None
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
+
+# Pools log under their class name; keep this one as quiet as sqlalchemy's own
+logging.getLogger(f'{__name__}.{TimedQueuePool.__name__}').setLevel(logging.WARNING)
+
+
+def count_on_commit(session, counter, amount=1, **labels):
+    """Increment counter once the session's transaction commits"""
+    session.info.setdefault(_PENDING_KEY, []).append((counter, amount, labels))
+
+
+@event.listens_for(Session, 'after_commit')
+def _count_committed(session):
+    for counter, amount, labels in session.info.pop(_PENDING_KEY, ()):
+        (counter.labels(**labels) if labels else counter).inc(amount)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _identify_worker():
+    global _identified_pid
+    # Per process: with preload_app the master imports the app before forking
+    if _identified_pid != os.getpid():
+        _identified_pid = os.getpid()
+        WORKER_INFO.labels(worker=f'{socket.gethostname()}:{_identified_pid}').set(1)
+        WORKER_STARTED.set(time.time())
+
+
+def _watch_pool(engine):
+    def checkout(*_):
+        POOL_CHECKED_OUT.inc()
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            POOL_OVERFLOW.set(max(0, pool.overflow()))
+            POOL_SIZE.set(pool.size())
+
+    def checkin(*_):
+        POOL_CHECKED_OUT.dec()
+
+    event.listen(engine, 'checkout', checkout)
+    event.listen(engine, 'checkin', checkin)
+
+
+def render_metrics():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def init_metrics(app):
+    """Record request metrics and serve /metrics"""
+    from app import db
+
+    with app.app_context():
+        _watch_pool(db.engine)
+
+    @app.before_request
+    def start_metrics_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        if started is None or request.endpoint == 'static':
+            return response
+        _identify_worker()
+        endpoint = request.endpoint or 'unmatched'
+        # Only a user Flask-Login already loaded; never a query just for the label
+        user = g.get('_login_user')
+        role = user.role if user is not None and user.is_authenticated else 'anonymous'
+        REQUEST_DURATION.labels(endpoint, role).observe(time.perf_counter() - started)
+        RESPONSES.labels(endpoint, str(response.status_code)).inc()
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if METRICS_TOKEN:
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(supplied, METRICS_TOKEN):
+                abort(401)
+        return Response(render_metrics(), content_type=CONTENT_TYPE_LATEST)
@@ -1,16 +1,31 @@
 from app import db
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy import func, event
+from sqlalchemy.orm import validates, query_expression
+from types import SimpleNamespace
+from refcache import reference_cache
 import pytz
 
 # Indian timezone
 INDIAN_TZ = pytz.timezone('Asia/Kolkata')
 
+# Batteries still being worked on (covered by the partial active index)
+ACTIVE_STATUSES = ['Received', 'Pending', 'Ready']
+
 def get_indian_now():
     """Get current time in Indian timezone"""
     return datetime.now(INDIAN_TZ).replace(tzinfo=None)  # Store as naive datetime
 
+def normalize_mobile(mobile):
+    """Digits only, with a +91 or leading 0 prefix stripped (None if there are no digits)"""
+    digits = ''.join(ch for ch in (mobile or '') if ch.isdigit())
+    if len(digits) > 10 and digits.startswith('91'):
+        digits = digits[2:]
+    elif len(digits) == 11 and digits.startswith('0'):
+        digits = digits[1:]
+    return digits or None
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
@@ -19,21 +34,58 @@ class User(UserMixin, db.Model):
     full_name = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=get_indian_now)
     active = db.Column(db.Boolean, default=True)
+    
+    @property
+    def is_active(self):
+        return self.active is not False
+
+    @staticmethod
+    def directory():
+        """Cached {id: UserIdentity} mapping of all users"""
+        def load():
+            return {user.id: UserIdentity(user) for user in User.query.all()}
+        return reference_cache.get('users', load)
+
+class UserIdentity(UserMixin):
+    """Who a user is, without their row: what current_user needs on every request"""
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.full_name = user.full_name
+        self.role = user.role
+        self.active = user.active is not False
+
+    @property
+    def is_active(self):
+        return self.active
 
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    mobile = db.Column(db.String(15), nullable=False)
+    mobile = db.Column(db.String(15), nullable=False, index=True)
     mobile_secondary = db.Column(db.String(15), nullable=True)
+    mobile_normalized = db.Column(db.String(15), nullable=True)  # Digits only, see normalize_mobile()
     created_at = db.Column(db.DateTime, default=get_indian_now)
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
     
     # Relationship with batteries
     batteries = db.relationship('Battery', backref='customer', lazy=True)
+    
+    __table_args__ = (
+        # One customer per phone number; also serves typeahead prefix lookups
+        db.Index('uq_customer_mobile_normalized', 'mobile_normalized', unique=True),
+    )
+    
+    @validates('mobile')
+    def _set_mobile_normalized(self, key, mobile):
+        self.mobile_normalized = normalize_mobile(mobile)
+        return mobile
 
 class Battery(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     battery_id = db.Column(db.String(20), unique=True, nullable=False)  # BAT0001, BAT0002, etc.
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
     battery_type = db.Column(db.String(100), nullable=False)
     voltage = db.Column(db.String(10), nullable=False)  # e.g., "12V"
     capacity = db.Column(db.String(10), nullable=False)  # e.g., "100Ah"
@@ -42,32 +94,32 @@ class Battery(db.Model):
     service_price = db.Column(db.Float, default=0.0)
     pickup_charge = db.Column(db.Float, default=0.0)  # Extra charge for pickup service
     is_pickup = db.Column(db.Boolean, default=False)  # Whether battery was picked up by employees
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
+    
+    __table_args__ = (
+        # Status filters ordered by inward date (panels, lists, reports)
+        db.Index('ix_battery_status_inward_date', 'status', 'inward_date'),
+        # Date range filters across all statuses (reports, exports)
+        db.Index('ix_battery_inward_date', 'inward_date'),
+        # Small index over the work-in-progress batteries only
+        db.Index('ix_battery_active_inward_date', 'inward_date',
+                 postgresql_where=status.in_(ACTIVE_STATUSES),
+                 sqlite_where=status.in_(ACTIVE_STATUSES)),
+    )
     
     # Relationship with status history and staff notes
-    status_history = db.relationship('BatteryStatusHistory', backref='battery', lazy=True, cascade='all, delete-orphan')
+    status_history = db.relationship('BatteryStatusHistory', backref='battery', lazy=True, cascade='all, delete-orphan',
+                                     order_by='BatteryStatusHistory.id')
     staff_notes = db.relationship('BatteryStaffNote', backref='battery', lazy=True, cascade='all, delete-orphan')
     
+    # Number of staff notes, only populated by list views that ask for it (see loading.py)
+    note_count = query_expression()
+    
     @staticmethod
     def generate_next_battery_id():
-        """Generate the next sequential battery ID using system settings"""
-        from app import db
-        
-        prefix = SystemSettings.get_setting('battery_id_prefix', 'BAT')
-        start_num = int(SystemSettings.get_setting('battery_id_start', '1'))
-        padding = int(SystemSettings.get_setting('battery_id_padding', '4'))
-        
-        last_battery = Battery.query.order_by(Battery.id.desc()).first()
-        if last_battery:
-            # Extract number from last battery ID (e.g., BAT0001 -> 1)
-            try:
-                last_num = int(last_battery.battery_id[len(prefix):])
-                next_num = last_num + 1
-            except (ValueError, IndexError):
-                next_num = start_num
-        else:
-            next_num = start_num
-        
-        return f"{prefix}{next_num:0{padding}d}"
+        """Allocate the next battery ID using system settings (see battery_ids.py)"""
+        from battery_ids import battery_ids
+        return battery_ids.next_id()
 
 class BatteryStatusHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -76,18 +128,25 @@ class BatteryStatusHistory(db.Model):
     comments = db.Column(db.Text)
     updated_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     updated_at = db.Column(db.DateTime, default=get_indian_now)
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
+    
+    __table_args__ = (
+        # Per-battery history lookups, also serving the latest-update per battery
+        db.Index('ix_battery_status_history_battery_id_updated_at', 'battery_id', 'updated_at'),
+    )
     
     # Relationship
     user = db.relationship('User', backref='status_updates')
 
 class BatteryStaffNote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False)
+    battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False, index=True)
     note = db.Column(db.Text, nullable=False)
     note_type = db.Column(db.String(50), default='followup')  # followup, reminder, issue, resolved
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=get_indian_now)
     is_resolved = db.Column(db.Boolean, default=False)
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
     
     # Relationship
     user = db.relationship('User', backref='staff_notes')
@@ -109,10 +168,32 @@ class InventoryItem(db.Model):
     # Relationships
     stock_transactions = db.relationship('StockTransaction', backref='inventory_item', lazy=True)
     material_usage = db.relationship('BatteryMaterialUsage', backref='inventory_item', lazy=True)
+    
+    # Change with every material use and purchase, so they are read live
+    LIVE_COLUMNS = ('current_stock', 'last_updated')
+
+    @staticmethod
+    def active_items():
+        """Active inventory items ordered by name: cached details with live stock levels"""
+        def load():
+            columns = [column.key for column in InventoryItem.__table__.columns
+                       if column.key not in InventoryItem.LIVE_COLUMNS]
+            return [
+                SimpleNamespace(**{key: getattr(item, key) for key in columns})
+                for item in InventoryItem.query.filter_by(active=True).order_by(InventoryItem.item_name).all()
+            ]
+        items = reference_cache.get('inventory_items', load)
+        live = {row.id: row for row in db.session.query(
+            InventoryItem.id, *[getattr(InventoryItem, key) for key in InventoryItem.LIVE_COLUMNS]
+        ).filter_by(active=True)}
+        return [
+            SimpleNamespace(**vars(item), **{key: getattr(live[item.id], key) for key in InventoryItem.LIVE_COLUMNS})
+            for item in items if item.id in live
+        ]
 
 class StockTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    inventory_item_id = db.Column(db.Integer, db.ForeignKey('inventory_item.id'), nullable=False)
+    inventory_item_id = db.Column(db.Integer, db.ForeignKey('inventory_item.id'), nullable=False, index=True)
     transaction_type = db.Column(db.String(20), nullable=False)  # purchase, usage, adjustment, return
     quantity = db.Column(db.Float, nullable=False)
     unit_cost = db.Column(db.Float, default=0.0)
@@ -120,14 +201,15 @@ class StockTransaction(db.Model):
     reference_id = db.Column(db.String(50))  # purchase order, battery ID, etc.
     notes = db.Column(db.Text)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=get_indian_now)
+    created_at = db.Column(db.DateTime, default=get_indian_now, index=True)
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
     
     # Relationships
     user = db.relationship('User', backref='stock_transactions')
 
 class BatteryMaterialUsage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False)
+    battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False, index=True)
     inventory_item_id = db.Column(db.Integer, db.ForeignKey('inventory_item.id'), nullable=False)
     quantity_used = db.Column(db.Float, nullable=False)
     unit_cost = db.Column(db.Float, default=0.0)
@@ -135,24 +217,107 @@ class BatteryMaterialUsage(db.Model):
     used_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     used_at = db.Column(db.DateTime, default=get_indian_now)
     notes = db.Column(db.Text)
+    changed_at = db.Column(db.DateTime, default=get_indian_now, onupdate=get_indian_now, index=True)  # Change tracking for incremental backups
     
     # Relationships
     user = db.relationship('User', backref='material_usage')
     battery = db.relationship('Battery', backref='materials_used')
 
+class BatteryStatusCounter(db.Model):
+    """Running per-status totals, maintained alongside every status transition"""
+    status = db.Column(db.String(20), primary_key=True)
+    battery_count = db.Column(db.Integer, default=0, nullable=False)
+    service_revenue = db.Column(db.Float, default=0.0, nullable=False)
+    pickup_revenue = db.Column(db.Float, default=0.0, nullable=False)  # Only counts is_pickup batteries
+    # Batteries with both prices set and the sum of service_price + pickup_charge over them, pickup or not,
+    # for the dashboard's average service price
+    priced_count = db.Column(db.Integer, default=0)
+    priced_total = db.Column(db.Float, default=0.0)
+
+class MonthlyStatusRollup(db.Model):
+    """Per inward month and status totals backing the monthly and yearly reports"""
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    battery_count = db.Column(db.Integer, default=0, nullable=False)
+    service_revenue = db.Column(db.Float, default=0.0, nullable=False)
+    pickup_revenue = db.Column(db.Float, default=0.0, nullable=False)  # Only counts is_pickup batteries
+
+class IdCounter(db.Model):
+    """Next unallocated number of a named ID series, locked briefly per allocation"""
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False)
+
+class DeletedRow(db.Model):
+    """Tombstone for a deleted row of a change-tracked table, replayed by incremental restores"""
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=get_indian_now, index=True)
+
+class BackgroundJob(db.Model):
+    """A long export, backup or report run by `flask run-jobs` instead of inside a request"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed, cancelled
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=get_indian_now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(100))  # hostname:pid of the runner
+    progress = db.Column(db.String(200))
+    artifact_path = db.Column(db.String(500))
+    artifact_name = db.Column(db.String(200))
+    artifact_size = db.Column(db.BigInteger)
+    mimetype = db.Column(db.String(100))
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_background_job_status_created', 'status', 'created_at'),
+    )
+
+    creator = db.relationship('User')
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    @property
+    def wait_seconds(self):
+        """Time spent queued before a worker picked the job up"""
+        if self.created_at and self.started_at:
+            return (self.started_at - self.created_at).total_seconds()
+        return None
+
+    @property
+    def run_seconds(self):
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
 class SystemSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     setting_key = db.Column(db.String(50), unique=True, nullable=False)
     setting_value = db.Column(db.Text, nullable=False)
     updated_at = db.Column(db.DateTime, default=get_indian_now)
     
+    @staticmethod
+    def get_all():
+        """Cached {key: value} mapping of every setting"""
+        def load():
+            return {setting.setting_key: setting.setting_value for setting in SystemSettings.query.all()}
+        return reference_cache.get('settings', load)
+    
     @staticmethod
     def get_setting(key, default_value=''):
-        setting = SystemSettings.query.filter_by(setting_key=key).first()
-        return setting.setting_value if setting else default_value
+        return SystemSettings.get_all().get(key, default_value)
     
     @staticmethod
     def set_setting(key, value):
+        reference_cache.invalidate_on_commit(db.session, 'settings')
         setting = SystemSettings.query.filter_by(setting_key=key).first()
         if setting:
             setting.setting_value = value
@@ -161,6 +326,18 @@ class SystemSettings(db.Model):
             setting = SystemSettings()
             setting.setting_key = key
             setting.setting_value = value
-            from app import db
             db.session.add(setting)
         return setting
+
+# Tables whose rows carry changed_at and leave a DeletedRow behind when deleted;
+# incremental backups only export their rows changed since the previous backup
+CHANGE_TRACKED_MODELS = [Customer, Battery, BatteryStatusHistory, BatteryStaffNote, StockTransaction,
+                         BatteryMaterialUsage]
+
+def _record_deleted_row(mapper, connection, target):
+    connection.execute(DeletedRow.__table__.insert().values(
+        table_name=mapper.local_table.name, row_id=target.id, deleted_at=get_indian_now()
+    ))
+
+for _model in CHANGE_TRACKED_MODELS:
+    event.listen(_model, 'after_delete', _record_deleted_row)
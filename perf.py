@@ -0,0 +1,222 @@
+"""
+Per-request SQL instrumentation.
+
+Cursor events count the queries and the database time of every request
+(failed statements included, up to their error) and keep its slowest
+statements. Each response carries a Server-Timing header (`db`, `render`
+and `total`), visible in the browser's network panel; render is the time
+spent in render_template(). Per endpoint the last PERF_WINDOW requests
+are kept for the p50/p95 latency, render time and query counts shown on
+/admin/perf, next to a ring buffer of the last PERF_SLOW_QUERY_LOG
+statements slower than PERF_SLOW_QUERY_MS. Parameters are reduced to
+their types before they are stored, so no customer data ends up in the
+log. Requests slower than PERF_SLOW_REQUEST_MS are also logged with
+their slowest statements.
+
+The numbers are per worker process: with several gunicorn workers the
+page shows the worker that served it. Database time is measured around
+cursor.execute(): psycopg2 has the whole result by then, but SQLite does
+most of a SELECT's work while the rows are fetched, so there it reads low.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from flask import g, has_app_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import get_indian_now
+
+PERF_WINDOW = int(os.environ.get('PERF_WINDOW', 500))
+PERF_SLOW_QUERY_MS = float(os.environ.get('PERF_SLOW_QUERY_MS', 100))
+PERF_SLOW_QUERY_LOG = int(os.environ.get('PERF_SLOW_QUERY_LOG', 100))
+PERF_SLOW_REQUEST_MS = float(os.environ.get('PERF_SLOW_REQUEST_MS', 1000))
+SLOWEST_PER_REQUEST = 3
+STATEMENT_CHARS = 2000
+
+_STARTS_KEY = 'perf_query_starts'
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def _placeholder(value):
+    return None if value is None else f'<{type(value).__name__}>'
+
+
+def redact(parameters, executemany=False):
+    """Replace bound values by their type names"""
+    if executemany:
+        return f'{len(parameters)} rows of {redact(parameters[0]) if parameters else "()"}'
+    if isinstance(parameters, dict):
+        return {key: _placeholder(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_placeholder(value) for value in parameters]
+    return _placeholder(parameters)
+
+
+def _compact(statement):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= STATEMENT_CHARS else statement[:STATEMENT_CHARS] + ' ...'
+
+
+class RequestProfiler:
+    def __init__(self, window, slow_query_log):
+        self.window = window
+        self._lock = threading.Lock()
+        self._endpoints = {}  # endpoint -> deque of (total_ms, db_ms, queries, render_ms)
+        self._slowest = {}  # endpoint -> (ms, statement) of its slowest statement
+        self.slow_queries = deque(maxlen=slow_query_log)
+        self.started_at = get_indian_now()
+
+    def record_request(self, endpoint, total_ms, db_ms, queries, slowest, render_ms=0.0):
+        with self._lock:
+            samples = self._endpoints.get(endpoint)
+            if samples is None:
+                samples = self._endpoints[endpoint] = deque(maxlen=self.window)
+            samples.append((total_ms, db_ms, queries, render_ms))
+            if slowest and slowest[0][0] > self._slowest.get(endpoint, (0,))[0]:
+                self._slowest[endpoint] = slowest[0]
+
+    def record_slow_query(self, endpoint, ms, statement, parameters):
+        with self._lock:
+            self.slow_queries.appendleft({
+                'at': get_indian_now(),
+                'endpoint': endpoint,
+                'ms': ms,
+                'statement': statement,
+                'parameters': parameters,
+            })
+
+    def endpoint_stats(self):
+        """Rolling latency and query counts per endpoint, slowest p95 first"""
+        with self._lock:
+            snapshot = {endpoint: list(samples) for endpoint, samples in self._endpoints.items()}
+            slowest = dict(self._slowest)
+        stats = []
+        for endpoint, samples in snapshot.items():
+            totals = [sample[0] for sample in samples]
+            db_times = [sample[1] for sample in samples]
+            queries = [sample[2] for sample in samples]
+            render_times = [sample[3] for sample in samples]
+            stats.append({
+                'endpoint': endpoint,
+                'requests': len(samples),
+                'p50_ms': percentile(totals, 0.5),
+                'p95_ms': percentile(totals, 0.95),
+                'db_p50_ms': percentile(db_times, 0.5),
+                'db_p95_ms': percentile(db_times, 0.95),
+                'render_p50_ms': percentile(render_times, 0.5),
+                'render_p95_ms': percentile(render_times, 0.95),
+                'queries_p50': percentile(queries, 0.5),
+                'queries_max': max(queries),
+                'slowest_statement': slowest.get(endpoint),
+            })
+        return sorted(stats, key=lambda item: item['p95_ms'], reverse=True)
+
+    def recent_slow_queries(self):
+        with self._lock:
+            return list(self.slow_queries)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._slowest.clear()
+            self.slow_queries.clear()
+            self.started_at = get_indian_now()
+
+
+request_profiler = RequestProfiler(PERF_WINDOW, PERF_SLOW_QUERY_LOG)
+
+
+def _current_request_stats():
+    return g.get('perf') if has_app_context() else None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_STARTS_KEY, []).append(time.perf_counter())
+
+
+def _record_query(conn, statement, parameters, executemany):
+    starts = conn.info.get(_STARTS_KEY)
+    if not starts:
+        return
+    ms = (time.perf_counter() - starts.pop()) * 1000
+    stats = _current_request_stats()
+    if stats is not None:
+        stats['queries'] += 1
+        stats['db_ms'] += ms
+        slowest = stats['slowest']
+        if len(slowest) < SLOWEST_PER_REQUEST or ms > slowest[-1][0]:
+            slowest.append((ms, _compact(statement)))
+            slowest.sort(key=lambda item: item[0], reverse=True)
+            del slowest[SLOWEST_PER_REQUEST:]
+    if ms >= PERF_SLOW_QUERY_MS:
+        endpoint = stats['endpoint'] if stats is not None else None
+        request_profiler.record_slow_query(endpoint, ms, _compact(statement), redact(parameters, executemany))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_query(conn, statement, parameters, executemany)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    # A failed statement (a timeout, a constraint violation) never reaches
+    # after_cursor_execute; its start would otherwise be taken as the start
+    # of the connection's next statement
+    context = exception_context.execution_context
+    if exception_context.connection is not None and context is not None:
+        _record_query(exception_context.connection, exception_context.statement, exception_context.parameters,
+                      context.executemany)
+
+
+def init_perf(app):
+    """Time every request and attach Server-Timing headers"""
+
+    @app.before_request
+    def start_request_timer():
+        if request.endpoint and request.endpoint != 'static':
+            g.perf = {'endpoint': request.endpoint, 'started': time.perf_counter(), 'queries': 0, 'db_ms': 0.0,
+                      'slowest': [], 'render_ms': 0.0, 'render_started': []}
+
+    def start_render_timer(sender, template, context, **extra):
+        stats = _current_request_stats()
+        if stats is not None:
+            stats['render_started'].append(time.perf_counter())
+
+    def stop_render_timer(sender, template, context, **extra):
+        stats = _current_request_stats()
+        if stats is not None and stats['render_started']:
+            started = stats['render_started'].pop()
+            # A template rendered inside another one is already in the outer time
+            if not stats['render_started']:
+                stats['render_ms'] += (time.perf_counter() - started) * 1000
+
+    before_render_template.connect(start_render_timer, app, weak=False)
+    template_rendered.connect(stop_render_timer, app, weak=False)
+
+    @app.after_request
+    def record_request_timing(response):
+        stats = g.pop('perf', None)
+        if stats is None:
+            return response
+        total_ms = (time.perf_counter() - stats['started']) * 1000
+        response.headers['Server-Timing'] = (f'db;dur={stats["db_ms"]:.1f};desc="{stats["queries"]} queries", '
+                                             f'render;dur={stats["render_ms"]:.1f}, total;dur={total_ms:.1f}')
+        request_profiler.record_request(stats['endpoint'], total_ms, stats['db_ms'], stats['queries'],
+                                        stats['slowest'], stats['render_ms'])
+        if total_ms >= PERF_SLOW_REQUEST_MS:
+            logging.warning(f'Slow request {request.method} {request.path} ({stats["endpoint"]}): {total_ms:.0f} ms, '
+                            f'{stats["queries"]} queries, {stats["db_ms"]:.0f} ms in the database; slowest: '
+                            + '; '.join(f'{ms:.0f} ms {statement[:200]}' for ms, statement in stats['slowest']))
+        return response
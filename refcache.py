@@ -0,0 +1,146 @@
+"""
+Process-local cache for slow-changing reference data.
+
+System settings, the active inventory item list and the user directory are
+read on hot request paths but change rarely. Each namespace is cached with a
+TTL and a version number; invalidation bumps the version so that a value
+loaded concurrently with a write is never stored. Writers call
+`invalidate_on_commit()` so other requests only reload once the new data is
+actually committed. Other gunicorn workers pick up changes when the TTL
+expires (REFERENCE_CACHE_TTL seconds, default 30).
+
+The users and settings namespaces cannot wait that long: the user directory
+is also what Flask-Login loads the logged-in user from, and a deactivated
+user must be refused on their next request, whichever worker serves it.
+Invalidating one of them therefore also appends a byte to a stamp file
+(REFERENCE_CACHE_STAMP_DIR, default instance/cache), and every lookup
+compares the file's stat() with the one its entry was loaded under. That
+is one system call per lookup, shared by all processes on the host that
+see the directory.
+"""
+import logging
+import os
+import threading
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+_PENDING_KEY = 'refcache_pending'
+
+# Namespaces whose invalidation reaches every process at once
+SHARED_NAMESPACES = {'users', 'settings'}
+
+
+class ReferenceCache:
+    def __init__(self, ttl, shared=(), stamp_dir=None):
+        self.ttl = ttl
+        self.shared = set(shared)
+        self.stamp_dir = stamp_dir
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> (version, expires_at, value, stamp)
+        self._versions = {}  # name -> version
+        self.hits = 0
+        self.misses = 0
+
+    def _stamp_path(self, name):
+        directory = self.stamp_dir or (os.path.join(current_app.instance_path, 'cache') if has_app_context() else None)
+        return os.path.join(directory, f'refcache-{name}') if directory else None
+
+    def _stamp(self, name):
+        """Identifies the last cross-process invalidation of a shared namespace"""
+        path = self._stamp_path(name) if name in self.shared else None
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def _bump_stamp(self, name):
+        path = self._stamp_path(name)
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Appends are atomic and the size only grows, so no two invalidations look alike
+            with open(path, 'ab') as stamp:
+                stamp.write(b'.')
+        except OSError as e:
+            # Runs after the commit; other workers still catch up within the TTL
+            logging.warning(f'Could not mark {name} as changed for other workers: {e}')
+
+    def get(self, name, loader):
+        """Return the cached value for name, calling loader() on a miss"""
+        now = time.monotonic()
+        stamp = self._stamp(name)
+        with self._lock:
+            version = self._versions.get(name, 0)
+            entry = self._entries.get(name)
+            if entry and entry[0] == version and entry[1] > now and entry[3] == stamp:
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        value = loader()
+
+        with self._lock:
+            # Skip storing if the namespace was invalidated while loading
+            if self._versions.get(name, 0) == version:
+                self._entries[name] = (version, now + self.ttl, value, stamp)
+        return value
+
+    def version(self, name):
+        """Changes whenever name is invalidated, here or (for shared namespaces) in another process"""
+        stamp = self._stamp(name)
+        with self._lock:
+            return self._versions.get(name, 0), stamp
+
+    def invalidate(self, *names):
+        """Drop the given namespaces (all of them if none are given)"""
+        with self._lock:
+            names = names or list(self._entries)
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+                self._entries.pop(name, None)
+        for name in self.shared.intersection(names):
+            self._bump_stamp(name)
+
+    def invalidate_on_commit(self, session, *names):
+        """Invalidate the namespaces once the current transaction commits"""
+        session.info.setdefault(_PENDING_KEY, set()).update(names)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'ttl': self.ttl,
+                'namespaces': {
+                    name: {
+                        'version': self._versions.get(name, 0),
+                        'expires_in': round(entry[1] - now, 1),
+                    }
+                    for name, entry in self._entries.items()
+                },
+            }
+
+
+reference_cache = ReferenceCache(ttl=float(os.environ.get('REFERENCE_CACHE_TTL', '30')), shared=SHARED_NAMESPACES,
+                                 stamp_dir=os.environ.get('REFERENCE_CACHE_STAMP_DIR'))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        reference_cache.invalidate(*pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
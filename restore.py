@@ -0,0 +1,614 @@
+"""
+Streaming restore of NDJSON backups (see backups.py).
+
+The backup is parsed a line at a time and each table is loaded in batches:
+multi-row executemany inserts, or COPY ... FROM STDIN on PostgreSQL. Primary
+keys are kept as they are in the backup, and PostgreSQL sequences are moved
+past them afterwards, so no id remapping is needed. Row counts and per-table
+checksums are verified against the backup as each table finishes; any
+mismatch aborts the whole restore (the caller's transaction is rolled back).
+
+A dry run parses and verifies the whole file without touching the database.
+Old single-document JSON backups are converted to the same table sections.
+
+Incremental backups are replayed on top of a restored full backup: their
+rows are upserted by primary key, then the rows deleted since the previous
+backup (per the deleted_row tombstones) are deleted again. `flask
+restore-chain` checks that each increment continues from the watermark of
+the backup before it.
+"""
+import gzip
+import hashlib
+import io
+import json
+import time
+from datetime import datetime, date
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import DateTime, Date, Integer, insert, select, delete, text
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.security import generate_password_hash
+from app import db
+from models import normalize_mobile, CHANGE_TRACKED_MODELS, DeletedRow
+from backups import BACKUP_FORMAT, BACKUP_VERSION, CHANGE_OVERLAP
+from search import suspend_search_triggers, resume_search_triggers
+
+RESTORE_BATCH_SIZE = 5000
+RESET_PASSWORD = 'password123'
+
+
+class RestoreError(ValueError):
+    """The backup is unreadable, incomplete or does not match this database"""
+
+
+class RestoreReport:
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.header = {}
+        self.tables = {}  # table name -> rows restored (or validated)
+        self.kept_user_id = None
+        self.deleted = 0  # rows removed again by an increment's tombstones
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def format(self):
+        if self.header.get('format') == 'legacy-json':
+            return 'legacy-json'
+        return f'{self.header.get("format")} v{self.header.get("version")} {self.header.get("kind", "full")}'
+
+    @property
+    def total_rows(self):
+        return sum(self.tables.values())
+
+    @property
+    def rows_per_second(self):
+        return self.total_rows / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        action = 'Validated' if self.dry_run else 'Restored'
+        deleted = f', deleted {self.deleted} rows' if self.deleted else ''
+        return (f'{action} {self.total_rows} rows in {len(self.tables)} tables{deleted} in {self.elapsed:.1f}s '
+                f'({self.rows_per_second:.0f} rows/s).')
+
+
+def open_backup(fileobj):
+    """Text line iterator over a binary backup file, gzip-compressed or not"""
+    if hasattr(fileobj, 'peek'):
+        magic = fileobj.peek(2)[:2]
+    else:
+        magic = fileobj.read(2)
+        fileobj.seek(0)
+    if magic == b'\x1f\x8b':
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    return io.TextIOWrapper(fileobj, encoding='utf-8-sig')
+
+
+def read_events(lines, keep_user=None):
+    """Yield ('header', header), ('table', name, columns), ('row', line, values),
+    ('table_end', info) and ('manifest', info) events from a backup"""
+    first = lines.readline()
+    try:
+        header = json.loads(first)
+    except ValueError:
+        header = None
+    if not (isinstance(header, dict) and header.get('type') == 'header'):
+        # Old indented single-document JSON backup
+        try:
+            data = json.loads(first + lines.read())
+        except ValueError as e:
+            raise RestoreError(f'Not a backup file: {e}')
+        yield ('header', {'format': 'legacy-json', 'kind': 'full'})
+        yield from legacy_events(data, keep_user)
+        return
+
+    if header.get('format') != BACKUP_FORMAT or header.get('version', 0) > BACKUP_VERSION:
+        raise RestoreError(f'Unsupported backup format {header.get("format")} version {header.get("version")}')
+    yield ('header', header)
+    for number, line in enumerate(lines, start=2):
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as e:
+            raise RestoreError(f'Line {number} is not valid JSON: {e}')
+        if isinstance(value, list):
+            yield ('row', line, value)
+        elif not isinstance(value, dict):
+            raise RestoreError(f'Line {number} is neither a row nor a section marker')
+        elif value.get('type') == 'table':
+            yield ('table', value['table'], value['columns'])
+        elif value.get('type') == 'table_end':
+            yield ('table_end', value)
+        elif value.get('type') == 'manifest':
+            yield ('manifest', value)
+
+
+def legacy_events(data, keep_user=None):
+    """Table sections for an old single-document JSON backup"""
+    users = data.get('users', [])
+    usernames = [user['username'] for user in users]
+    if keep_user and keep_user['username'] in usernames:
+        author_id = usernames.index(keep_user['username']) + 1
+    elif keep_user:
+        author_id = len(users) + 1
+    else:
+        # Old backups did not record who made each status change
+        roles = [user['role'] for user in users]
+        author_id = roles.index('admin') + 1 if 'admin' in roles else (1 if users else None)
+
+    yield ('table', 'user', ['id', 'username', 'full_name', 'role', 'created_at', 'active'])
+    for number, user in enumerate(users, start=1):
+        yield ('row', None, [number, user['username'], user['full_name'], user['role'],
+                             user.get('created_at'), user.get('is_active', True)])
+    yield ('table_end', None)
+
+    yield ('table', 'customer', ['id', 'name', 'mobile', 'mobile_normalized', 'created_at'])
+    seen = set()
+    for customer in data.get('customers', []):
+        normalized = normalize_mobile(customer['mobile'])
+        # Later customers sharing a number keep NULL, like the mobile_normalized migration backfill
+        if normalized in seen:
+            normalized = None
+        seen.add(normalized)
+        yield ('row', None, [customer['id'], customer['name'], customer['mobile'], normalized,
+                             customer.get('created_at')])
+    yield ('table_end', None)
+
+    yield ('table', 'battery', ['id', 'battery_id', 'customer_id', 'battery_type', 'voltage', 'capacity',
+                                'status', 'inward_date', 'service_price'])
+    for battery in data.get('batteries', []):
+        yield ('row', None, [battery['id'], battery['battery_id'], battery['customer_id'], battery['battery_type'],
+                             battery['voltage'], battery['capacity'], battery['status'],
+                             battery.get('inward_date'), battery.get('service_price', 0.0)])
+    yield ('table_end', None)
+
+    history = data.get('status_history', [])
+    if history and author_id is None:
+        raise RestoreError('The backup has status history but no users to attribute it to.')
+    yield ('table', 'battery_status_history', ['id', 'battery_id', 'status', 'comments', 'updated_by', 'updated_at'])
+    for entry in history:
+        yield ('row', None, [entry['id'], entry['battery_id'], entry['status'], entry.get('comments', ''),
+                             author_id, entry.get('updated_at')])
+    yield ('table_end', None)
+
+    yield ('table', 'system_settings', ['setting_key', 'setting_value', 'updated_at'])
+    for setting in data.get('settings', []):
+        yield ('row', None, [setting['setting_key'], setting['setting_value'], setting.get('updated_at')])
+    yield ('table_end', None)
+
+
+def _converter(column):
+    """Turn a JSON value into what the column's type expects"""
+    if isinstance(column.type, DateTime):
+        return lambda value: datetime.fromisoformat(value) if isinstance(value, str) else value
+    if isinstance(column.type, Date):
+        return lambda value: date.fromisoformat(value) if isinstance(value, str) else value
+    return None
+
+
+def _copy_value(value):
+    """One field of a COPY ... (FORMAT csv) line; an unquoted empty field is NULL"""
+    if value is None:
+        return ''
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class TableLoader:
+    """Loads the rows of one table section in batches"""
+
+    def __init__(self, connection, table, columns, report, dry_run=False, keep_user=None,
+                 batch_size=RESTORE_BATCH_SIZE, progress=None, upsert=False):
+        self.connection = connection
+        self.table = table
+        self.report = report
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.progress = progress
+        self.rows = 0
+        self.batch = []
+        self.checksum = hashlib.sha256()
+        self.max_id = 0
+
+        unknown = [name for name in columns if name not in table.columns]
+        if unknown:
+            raise RestoreError(f'Table {table.name} in the backup has columns this database does not: '
+                               f'{", ".join(unknown)}')
+        self.columns = list(columns)
+
+        # Columns missing from the backup (left out, or added since) get their default
+        self.fillers = []
+        for column in table.columns:
+            if column.name in self.columns or column.primary_key and column.autoincrement is not False:
+                continue
+            if column.name == 'changed_at':
+                continue  # Unknown; stamping restored rows with now would put them all in the next increment
+            if table.name == 'user' and column.name == 'password_hash':
+                reset_hash = generate_password_hash(RESET_PASSWORD)
+                self.fillers.append((column.name, lambda reset_hash=reset_hash: reset_hash))
+            elif column.default is not None and column.default.is_scalar:
+                self.fillers.append((column.name, lambda value=column.default.arg: value))
+            elif column.default is not None and column.default.is_callable:
+                self.fillers.append((column.name, lambda function=column.default.arg: function(None)))
+            elif not column.nullable:
+                raise RestoreError(f'The backup has no values for {table.name}.{column.name}')
+        self.names = self.columns + [name for name, _ in self.fillers]
+        self.converters = [(index, converter) for index, converter in
+                           enumerate(_converter(table.columns[name]) for name in self.names) if converter]
+
+        self.keep_user = keep_user if table.name == 'user' else None
+        self.kept = False
+        self.use_copy = connection is not None and connection.dialect.name == 'postgresql' and not upsert
+        self.upsert = self._upsert_statement() if upsert and connection is not None else None
+
+    def _upsert_statement(self):
+        """INSERT ... ON CONFLICT (primary key) DO UPDATE with the backup's columns"""
+        dialect = self.connection.dialect.name
+        if dialect not in ('postgresql', 'sqlite'):
+            raise RestoreError(f'Incremental restores need PostgreSQL or SQLite, not {dialect}')
+        statement = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(self.table)
+        keys = [column.name for column in self.table.primary_key.columns]
+        # Filled columns (like reset passwords) are only used for new rows
+        updates = {name: statement.excluded[name] for name in self.columns if name not in keys}
+        if not updates:
+            return statement.on_conflict_do_nothing(index_elements=keys)
+        return statement.on_conflict_do_update(index_elements=keys, set_=updates)
+
+    def add(self, line, values):
+        if len(values) != len(self.columns):
+            raise RestoreError(f'Row {self.rows + 1} of {self.table.name} has {len(values)} values, '
+                               f'expected {len(self.columns)}')
+        if line is not None:
+            self.checksum.update(line.encode('utf-8'))
+        row = list(values) + [filler() for _, filler in self.fillers]
+        if 'id' in self.names and isinstance(row[self.names.index('id')], int):
+            self.max_id = max(self.max_id, row[self.names.index('id')])
+        if self.keep_user and row[self.names.index('username')] == self.keep_user['username']:
+            self._keep(row)
+        self.rows += 1
+        if not self.dry_run:
+            self.batch.append(row)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        elif self.progress and self.rows % self.batch_size == 0:
+            self.progress(self.table.name, self.rows, self.report.total_rows + self.rows)
+
+    def _keep(self, row):
+        """The restoring admin keeps their password and admin role"""
+        for name in ('password_hash', 'role', 'full_name'):
+            row[self.names.index(name)] = self.keep_user[name]
+        if 'active' in self.names:
+            row[self.names.index('active')] = True
+        self.kept = True
+        self.report.kept_user_id = row[self.names.index('id')]
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.use_copy:
+            self._copy(self.batch)
+        else:
+            for row in self.batch:
+                for index, converter in self.converters:
+                    row[index] = converter(row[index])
+            self.connection.execute(self.upsert if self.upsert is not None else insert(self.table),
+                                    [dict(zip(self.names, row)) for row in self.batch])
+        self.batch = []
+        if self.progress:
+            self.progress(self.table.name, self.rows, self.report.total_rows + self.rows)
+
+    def _copy(self, rows):
+        preparer = self.connection.dialect.identifier_preparer
+        columns = ', '.join(preparer.quote(name) for name in self.names)
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(','.join(_copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {preparer.format_table(self.table)} ({columns}) FROM STDIN WITH (FORMAT csv)',
+                               buffer)
+        finally:
+            cursor.close()
+
+    def finish(self, info):
+        if self.keep_user and not self.kept:
+            # The restoring admin is not in the backup: add them after everyone else
+            self.add(None, [self._kept_user_value(name) for name in self.columns])
+            self.rows -= 1
+        self.flush()
+        if info is not None:
+            if info.get('rows') != self.rows:
+                raise RestoreError(f'Table {self.table.name}: the backup lists {info.get("rows")} rows '
+                                   f'but contains {self.rows}; the file is truncated or damaged')
+            if info.get('sha256') != self.checksum.hexdigest():
+                raise RestoreError(f'Table {self.table.name}: checksum mismatch, the file is damaged')
+        self.report.tables[self.table.name] = self.rows
+
+    def _kept_user_value(self, name):
+        if name == 'id':
+            return self.max_id + 1
+        if name == 'active':
+            return True
+        if name == 'created_at':
+            return datetime.now().isoformat()
+        return self.keep_user.get(name)
+
+
+def clear_tables(connection):
+    """Delete every row of every mapped table"""
+    tables = list(reversed(db.metadata.sorted_tables))
+    if connection.dialect.name == 'postgresql':
+        preparer = connection.dialect.identifier_preparer
+        connection.exec_driver_sql('TRUNCATE ' + ', '.join(preparer.format_table(table) for table in tables))
+        return
+    for table in tables:
+        connection.execute(table.delete())
+
+
+def reset_sequences(connection):
+    """Move PostgreSQL serial sequences past the restored primary keys"""
+    if connection.dialect.name != 'postgresql':
+        return  # SQLite continues from max(rowid) by itself
+    preparer = connection.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        keys = list(table.primary_key.columns)
+        if len(keys) != 1 or not isinstance(keys[0].type, Integer):
+            continue
+        column = preparer.quote(keys[0].name)
+        connection.execute(text(
+            f'SELECT setval(pg_get_serial_sequence(:table, :column), coalesce(max({column}), 0) + 1, false) '
+            f'FROM {preparer.format_table(table)}'
+        ), {'table': preparer.format_table(table), 'column': keys[0].name})
+
+
+def _load(connection, fileobj, report, dry_run=False, keep_user=None, progress=None,
+          batch_size=RESTORE_BATCH_SIZE, upsert=False, check_header=None, prepare=None):
+    """Load every table section of a backup file; see restore_backup()"""
+    tables = {table.name: table for table in db.metadata.sorted_tables}
+    loader = None
+    manifest = None
+    for event in read_events(open_backup(fileobj), keep_user):
+        kind = event[0]
+        if kind == 'header':
+            report.header = event[1]
+            if check_header:
+                check_header(event[1])
+            if prepare and not dry_run:
+                prepare()
+        elif kind == 'table':
+            if loader is not None:
+                raise RestoreError(f'Table {loader.table.name} is incomplete')
+            if event[1] not in tables:
+                raise RestoreError(f'The backup has a table this database does not: {event[1]}')
+            loader = TableLoader(connection, tables[event[1]], event[2], report, dry_run, keep_user,
+                                 batch_size, progress, upsert)
+        elif kind == 'row':
+            if loader is None:
+                raise RestoreError('Row outside of a table section')
+            loader.add(event[1], event[2])
+        elif kind == 'table_end':
+            if loader is None:
+                raise RestoreError('Table end without a table')
+            loader.finish(event[1])
+            loader = None
+        elif kind == 'manifest':
+            manifest = event[1]
+
+    if loader is not None:
+        raise RestoreError(f'The backup ends in the middle of table {loader.table.name}')
+    if report.format != 'legacy-json':
+        if manifest is None:
+            raise RestoreError('The backup has no manifest; the file is truncated')
+        listed = {name: info['rows'] for name, info in manifest['tables'].items()}
+        if listed != report.tables:
+            raise RestoreError('The backup manifest does not match its table sections')
+
+
+def restore_backup(connection, fileobj, dry_run=False, keep_user=None, progress=None,
+                   batch_size=RESTORE_BATCH_SIZE):
+    """Replace all data on connection with the full backup in fileobj (a binary file).
+
+    keep_user (username, password_hash, role, full_name) is the admin running
+    the restore; everyone else's password is reset. progress(table, table_rows,
+    total_rows) is called after every batch. The caller commits, or rolls back
+    on RestoreError. With dry_run nothing is written and connection may be None.
+    """
+    report = RestoreReport(dry_run)
+
+    def check_header(header):
+        if header.get('kind') == 'incremental':
+            raise RestoreError('This is an incremental backup; restore it after its full backup '
+                               '(flask restore-chain)')
+
+    def prepare():
+        suspend_search_triggers(connection)
+        clear_tables(connection)
+
+    _load(connection, fileobj, report, dry_run, keep_user, progress, batch_size,
+          check_header=check_header, prepare=prepare)
+    if not dry_run:
+        reset_sequences(connection)
+        resume_search_triggers(connection)
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+
+def apply_tombstones(connection, since):
+    """Delete the tracked rows that were deleted at or after since"""
+    tombstones = {}
+    table = DeletedRow.__table__
+    for table_name, row_id in connection.execute(
+            select(table.c.table_name, table.c.row_id).where(table.c.deleted_at >= since)):
+        tombstones.setdefault(table_name, set()).add(row_id)
+    tracked = {model.__table__.name for model in CHANGE_TRACKED_MODELS}
+    deleted = 0
+    # Children first
+    for target in reversed(db.metadata.sorted_tables):
+        ids = sorted(tombstones.get(target.name, ())) if target.name in tracked else []
+        for offset in range(0, len(ids), RESTORE_BATCH_SIZE):
+            result = connection.execute(delete(target).where(target.c.id.in_(ids[offset:offset + RESTORE_BATCH_SIZE])))
+            deleted += result.rowcount
+    return deleted
+
+
+def apply_increment(connection, fileobj, expected_since=None, dry_run=False, progress=None,
+                    batch_size=RESTORE_BATCH_SIZE):
+    """Upsert an incremental backup on top of the data on connection and replay its deletes.
+
+    expected_since is the watermark of the backup it must follow, if known.
+    """
+    report = RestoreReport(dry_run)
+
+    def check_header(header):
+        if header.get('kind') != 'incremental':
+            raise RestoreError('This is a full backup, not an increment')
+        if expected_since is not None and header.get('since') != expected_since:
+            raise RestoreError(f'This increment covers changes since {header.get("since")}, but the backup '
+                               f'before it was taken at {expected_since}; an increment is missing')
+
+    _load(connection, fileobj, report, dry_run, progress=progress, batch_size=batch_size, upsert=True,
+          check_header=check_header)
+    if not dry_run:
+        report.deleted = apply_tombstones(connection, datetime.fromisoformat(report.header['since']) - CHANGE_OVERLAP)
+        reset_sequences(connection)
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+
+def restore_chain(connection, paths, dry_run=False, progress=None):
+    """Restore a full backup followed by its increments, in order; returns one report per file"""
+    reports = []
+    for number, path in enumerate(paths):
+        with open(path, 'rb') as fileobj:
+            if number == 0:
+                report = restore_backup(connection, fileobj, dry_run, progress=progress)
+            else:
+                watermark = reports[-1].header.get('watermark')
+                if not watermark:
+                    raise RestoreError(f'{paths[number - 1]} has no watermark, increments cannot follow it')
+                report = apply_increment(connection, fileobj, watermark, dry_run, progress)
+        reports.append(report)
+    return reports
+
+
+def finish_restore():
+    """Rebuild everything derived from the restored rows (caller commits)"""
+    from counters import rebuild_counters
+    from battery_ids import sync_counter
+    from refcache import reference_cache
+    rebuild_counters()
+    sync_counter(db.session.connection())
+    reference_cache.invalidate_on_commit(db.session, 'settings', 'users', 'inventory_items')
+
+
+def _echo_progress(table, table_rows, total_rows):
+    click.echo(f'  {table}: {table_rows} rows ({total_rows} total)')
+
+
+@click.command('restore-backup')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Only parse and verify the backup.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+@with_appcontext
+def restore_backup_command(path, dry_run, yes):
+    """Replace all data with a backup file (.ndjson.gz, .ndjson or old .json)"""
+    if not dry_run and not yes:
+        click.confirm('This replaces ALL data and resets every password to '
+                      f'"{RESET_PASSWORD}". Continue?', abort=True)
+    with open(path, 'rb') as fileobj:
+        try:
+            report = restore_backup(None if dry_run else db.session.connection(), fileobj, dry_run,
+                                    progress=_echo_progress)
+            if not dry_run:
+                finish_restore()
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f'Restore failed: {e}')
+            raise SystemExit(1)
+    click.echo(f'{report.format}: {report.summary()}')
+
+
+@click.command('restore-chain')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Only parse and verify the backups.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+@with_appcontext
+def restore_chain_command(paths, dry_run, yes):
+    """Restore a full backup followed by its incremental backups, oldest first"""
+    if not dry_run and not yes:
+        click.confirm('This replaces ALL data and resets every password to '
+                      f'"{RESET_PASSWORD}". Continue?', abort=True)
+    try:
+        reports = restore_chain(None if dry_run else db.session.connection(), paths, dry_run,
+                                progress=_echo_progress)
+        if not dry_run:
+            finish_restore()
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f'Restore failed: {e}')
+        raise SystemExit(1)
+    for path, report in zip(paths, reports):
+        click.echo(f'{path} ({report.format}): {report.summary()}')
+
+
+@click.command('benchmark-restore')
+@click.option('--batteries', default=100000, help='Synthetic batteries to back up and restore.')
+@click.option('--database-url', default=None,
+              help='Scratch database to run against (default: a temporary SQLite file). It is overwritten.')
+def benchmark_restore_command(batteries, database_url):
+    """Measure backup and restore throughput on a scratch database"""
+    import os
+    import tempfile
+    from sqlalchemy import create_engine
+    from backups import backup_stream
+    from indexes import seed_rows
+    from models import User
+
+    directory = tempfile.mkdtemp()
+    url = database_url or f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+    engine = create_engine(url)
+    try:
+        db.metadata.drop_all(engine)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(User), [{'username': 'admin', 'password_hash': '-', 'role': 'admin',
+                                               'full_name': 'Administrator'}])
+            click.echo(f'Seeding {batteries} batteries...')
+            seed_rows(connection, batteries)
+
+        path = os.path.join(directory, 'benchmark.ndjson.gz')
+        started = time.perf_counter()
+        with open(path, 'wb') as fileobj:
+            for chunk in backup_stream(engine):
+                fileobj.write(chunk)
+        backup_seconds = time.perf_counter() - started
+
+        with open(path, 'rb') as fileobj:
+            check = restore_backup(None, fileobj, dry_run=True)
+        with engine.begin() as connection, open(path, 'rb') as fileobj:
+            report = restore_backup(connection, fileobj)
+
+        click.echo(f'{engine.dialect.name}, {check.total_rows} rows, {os.path.getsize(path) / 1e6:.1f} MB compressed')
+        click.echo(f'backup   {backup_seconds:7.1f}s  {check.total_rows / backup_seconds:9.0f} rows/s')
+        click.echo(f'dry run  {check.elapsed:7.1f}s  {check.rows_per_second:9.0f} rows/s')
+        click.echo(f'restore  {report.elapsed:7.1f}s  {report.rows_per_second:9.0f} rows/s')
+        for name, rows in report.tables.items():
+            click.echo(f'  {name:28} {rows:9}')
+    finally:
+        engine.dispose()
+        if not database_url:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
@@ -1,18 +1,32 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, make_response, jsonify, send_file
-from flask_login import login_required, current_user
+from flask_login import login_required, login_user, current_user
 from app import db, get_indian_time, format_indian_time
-from models import User, Customer, Battery, BatteryStatusHistory, SystemSettings, BatteryStaffNote, InventoryItem, StockTransaction, BatteryMaterialUsage, get_indian_now
+from models import User, Customer, Battery, BatteryStatusHistory, SystemSettings, BatteryStaffNote, InventoryItem, StockTransaction, BatteryMaterialUsage, BackgroundJob, get_indian_now
 from werkzeug.security import generate_password_hash
+from refcache import reference_cache
+from fragments import fragment_cache
+from perf import request_profiler, PERF_SLOW_QUERY_MS, PERF_WINDOW
+from metrics import MATERIAL_USAGE, MATERIAL_QUANTITY, count_on_commit
+from search import search_batteries
+from loading import CUSTOMER, JOINED_CUSTOMER, NOTE_COUNTS, WORK_DETAILS, TRANSACTION_DETAILS, JOB_CREATOR
+from customers import upsert_customer, typeahead
+from battery_ids import battery_ids
+from intake import IntakeError, INTAKE_FIELDS, MAX_INTAKE_ROWS, read_rows, rows_from_json, register_batteries
+from date_ranges import month_range, year_range, in_range, range_from_args
+from jobs import enqueue_job, cancel_job, job_label
+from database import read_replica
+from restore import RestoreError, RESET_PASSWORD, restore_backup, finish_restore
+from counters import battery_snapshot, record_new_battery, record_transition, get_dashboard_totals, get_month_totals, get_year_breakdown
 from datetime import datetime
 from sqlalchemy import func
-import csv
-import io
-import json
 import tempfile
 import os
 
 main_bp = Blueprint('main', __name__)
 
+# Rows listed on the yearly report page; the full year is a background download
+YEARLY_REPORT_ROWS = 200
+
 @main_bp.route('/')
 def index():
     return redirect(url_for('main.dashboard'))
@@ -20,39 +34,15 @@ def index():
 @main_bp.route('/dashboard')
 @login_required
 def dashboard():
-    from sqlalchemy import func
-    
-    # Get statistics for dashboard
-    total_batteries = Battery.query.count()
-    pending_batteries = Battery.query.filter(Battery.status.in_(['Received', 'Pending'])).count()
-    ready_batteries = Battery.query.filter_by(status='Ready').count()
-    completed_batteries = Battery.query.filter(Battery.status.in_(['Delivered', 'Returned'])).count()
-    not_repairable_batteries = Battery.query.filter_by(status='Not Repairable').count()
-    
-    # Calculate revenue statistics including pickup charges from delivered batteries
-    delivered_service_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-        Battery.status.in_(['Delivered', 'Returned'])
-    ).scalar() or 0
-    delivered_pickup_revenue = db.session.query(func.sum(Battery.pickup_charge)).filter(
-        Battery.status.in_(['Delivered', 'Returned']), Battery.is_pickup == True
-    ).scalar() or 0
-    total_revenue = delivered_service_revenue + delivered_pickup_revenue
-    avg_service_price = db.session.query(func.avg(Battery.service_price + Battery.pickup_charge)).filter(
-        Battery.status.in_(['Delivered', 'Returned'])
-    ).scalar() or 0
+    # Statistics come from the incrementally maintained status counters
+    totals = get_dashboard_totals()
     
     # Recent batteries (only pending and ready - active work)
-    recent_batteries = Battery.query.filter(Battery.status.in_(['Pending', 'Ready'])).order_by(Battery.inward_date.desc()).limit(5).all()
+    recent_batteries = Battery.query.options(*CUSTOMER).filter(Battery.status.in_(['Pending', 'Ready'])).order_by(Battery.inward_date.desc()).limit(5).all()
     
     return render_template('dashboard.html', 
-                         total_batteries=total_batteries,
-                         pending_batteries=pending_batteries,
-                         ready_batteries=ready_batteries,
-                         completed_batteries=completed_batteries,
-                         not_repairable_batteries=not_repairable_batteries,
                          recent_batteries=recent_batteries,
-                         total_revenue=float(total_revenue),
-                         avg_service_price=float(avg_service_price))
+                         **totals)
 
 @main_bp.route('/battery/entry', methods=['GET', 'POST'])
 @login_required
@@ -76,23 +66,16 @@ def battery_entry():
             return render_template('battery_entry.html')
         
         try:
-            # Check if customer exists or create new one
-            customer = Customer.query.filter_by(mobile=mobile).first()
-            if not customer:
-                customer = Customer()
-                customer.name = customer_name
-                customer.mobile = mobile
-                customer.mobile_secondary = mobile_secondary
-                db.session.add(customer)
-                db.session.flush()  # Get customer ID
+            # Reserve the battery ID first, it commits on its own connection
+            battery_id = battery_ids.next_id()
             
-            # Generate battery ID
-            battery_id = Battery.generate_next_battery_id()
+            # Find the customer by normalized mobile or create them, race-free
+            customer_id = upsert_customer(customer_name, mobile, mobile_secondary)
             
             # Create battery record
             battery = Battery()
             battery.battery_id = battery_id
-            battery.customer_id = customer.id
+            battery.customer_id = customer_id
             battery.battery_type = battery_type
             battery.voltage = voltage
             battery.capacity = capacity
@@ -101,6 +84,7 @@ def battery_entry():
             battery.pickup_charge = pickup_charge
             db.session.add(battery)
             db.session.flush()  # Get battery record ID
+            record_new_battery(battery)
             
             # Add initial status history
             status_history = BatteryStatusHistory()
@@ -120,6 +104,88 @@ def battery_entry():
     
     return render_template('battery_entry.html')
 
+@main_bp.route('/battery/bulk_entry', methods=['GET', 'POST'])
+@login_required
+def bulk_battery_entry():
+    """Register a fleet drop-off from an uploaded CSV/JSON list, or a JSON request body"""
+    if current_user.role not in ['shop_staff', 'admin']:
+        if request.is_json:
+            return jsonify({'error': 'Access denied'}), 403
+        flash('Access denied. This feature is only available to shop staff and admin.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    if request.method == 'GET':
+        return render_template('bulk_battery_entry.html', fields=INTAKE_FIELDS, max_rows=MAX_INTAKE_ROWS)
+    
+    try:
+        if request.is_json:
+            rows = rows_from_json(request.get_json(silent=True))
+            defaults = {}
+        else:
+            file = request.files.get('intake_file')
+            if not file or not file.filename:
+                raise IntakeError('No file selected.')
+            rows = read_rows(file.filename, file.read())
+            # Fleet drop-offs: one customer for every row that leaves it blank
+            defaults = {field: request.form.get(field) for field in ['customer_name', 'mobile', 'mobile_secondary']}
+        results = register_batteries(rows, current_user.id, defaults)
+        db.session.commit()
+    except IntakeError as e:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'error')
+        return render_template('bulk_battery_entry.html', fields=INTAKE_FIELDS, max_rows=MAX_INTAKE_ROWS)
+    except Exception as e:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify({'error': f'Error registering batteries: {str(e)}'}), 500
+        flash(f'Error registering batteries: {str(e)}', 'error')
+        return render_template('bulk_battery_entry.html', fields=INTAKE_FIELDS, max_rows=MAX_INTAKE_ROWS)
+    
+    registered = [result['id'] for result in results if result['status'] == 'registered']
+    receipt_url = url_for('main.receipt_batch', ids=','.join(map(str, registered))) if registered else None
+    if request.is_json:
+        return jsonify({
+            'registered': len(registered),
+            'failed': len(results) - len(registered),
+            'results': results,
+            'receipt_url': receipt_url,
+        })
+    
+    if registered:
+        flash(f'{len(registered)} batteries have been successfully registered.', 'success')
+    if len(registered) < len(results):
+        flash(f'{len(results) - len(registered)} rows could not be registered, see below.', 'error')
+    return render_template('bulk_battery_entry.html', fields=INTAKE_FIELDS, max_rows=MAX_INTAKE_ROWS,
+                           results=results, receipt_url=receipt_url)
+
+@main_bp.route('/receipts/batch')
+@login_required
+def receipt_batch():
+    """Printable inward receipts for several batteries, one per page"""
+    try:
+        ids = [int(battery_pk) for battery_pk in request.args.get('ids', '').split(',') if battery_pk]
+    except ValueError:
+        ids = []
+    if not ids:
+        flash('No batteries selected.', 'error')
+        return redirect(url_for('main.bulk_battery_entry'))
+    
+    batteries = Battery.query.options(*CUSTOMER).filter(Battery.id.in_(ids[:MAX_INTAKE_ROWS])) \
+        .order_by(Battery.battery_id).all()
+    shop_name = SystemSettings.get_setting('shop_name', 'Battery Repair Service')
+    return render_template('receipt_batch.html', batteries=batteries, shop_name=shop_name)
+
+@main_bp.route('/customers/typeahead')
+@login_required
+def customer_typeahead():
+    """Customers matching a partially typed mobile number, for the intake form"""
+    if current_user.role not in ['shop_staff', 'admin']:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify({'customers': typeahead(request.args.get('q', ''))})
+
 @main_bp.route('/technician/panel', methods=['GET', 'POST'])
 @login_required
 def technician_panel():
@@ -134,16 +200,7 @@ def technician_panel():
     if request.method == 'GET' and request.args.get('search'):
         search_query = request.args.get('search', '').strip()
         if search_query:
-            batteries = Battery.query.join(Customer).filter(
-                db.and_(
-                    Battery.status.in_(['Received', 'Pending']),
-                    db.or_(
-                        Battery.battery_id.ilike(f'%{search_query}%'),
-                        Customer.mobile.ilike(f'%{search_query}%'),
-                        Customer.name.ilike(f'%{search_query}%')
-                    )
-                )
-            ).order_by(Battery.inward_date.asc()).all()
+            batteries = search_batteries(search_query, statuses=['Received', 'Pending'], options=WORK_DETAILS)
             show_full_details = True
         else:
             batteries = Battery.query.filter(
@@ -154,21 +211,12 @@ def technician_panel():
         search_query = request.form.get('search_query', '').strip()
         
         if search_query:
-            # Search by battery ID, customer mobile, or customer name
-            batteries = Battery.query.join(Customer).filter(
-                db.and_(
-                    Battery.status.in_(['Received', 'Pending']),
-                    db.or_(
-                        Battery.battery_id.ilike(f'%{search_query}%'),
-                        Customer.mobile.ilike(f'%{search_query}%'),
-                        Customer.name.ilike(f'%{search_query}%')
-                    )
-                )
-            ).order_by(Battery.inward_date.asc()).all()
+            # Search by battery ID, customer mobile or name, notes and status comments
+            batteries = search_batteries(search_query, statuses=['Received', 'Pending'], options=WORK_DETAILS)
             show_full_details = True
         else:
             # If no search query, show all pending batteries
-            batteries = Battery.query.filter(
+            batteries = Battery.query.options(*WORK_DETAILS).filter(
                 Battery.status.in_(['Received', 'Pending'])
             ).order_by(Battery.inward_date.asc()).all()
             show_full_details = True
@@ -180,7 +228,7 @@ def technician_panel():
         show_full_details = False
     
     # Get inventory items for material usage
-    inventory_items = InventoryItem.query.filter_by(active=True).order_by(InventoryItem.item_name).all()
+    inventory_items = InventoryItem.active_items()
     
     return render_template('technician_panel.html', batteries=batteries, search_query=search_query, show_full_details=show_full_details, inventory_items=inventory_items)
 
@@ -198,10 +246,12 @@ def update_battery_status():
     
     try:
         battery = Battery.query.get_or_404(battery_id)
+        before = battery_snapshot(battery)
         battery.status = new_status
         
         if service_price:
             battery.service_price = float(service_price)
+        record_transition(before, battery)
         
         # Add status history
         status_history = BatteryStatusHistory()
@@ -229,15 +279,8 @@ def search():
         search_query = request.form.get('search_query', '').strip()
         
         if search_query:
-            # Search by battery ID or customer mobile
-            batteries = Battery.query.join(Customer).filter(
-                db.or_(
-                    Battery.battery_id.ilike(f'%{search_query}%'),
-                    Customer.mobile.ilike(f'%{search_query}%'),
-                    Customer.name.ilike(f'%{search_query}%')
-                )
-            ).all()
-            results = batteries
+            # Ranked search by battery ID, customer mobile or name, notes and status comments
+            results = search_batteries(search_query, options=CUSTOMER)
     
     return render_template('search.html', results=results, search_query=search_query)
 
@@ -270,46 +313,25 @@ def bill(battery_id):
 @main_bp.route('/export/csv')
 @login_required
 def export_csv():
+    """Queue a CSV export of the battery records and show its job page.
+
+    Optional filters: status (repeatable or comma separated), from/to, month
+    or year (see date_ranges.range_from_args); gzip=1 compresses the file.
+    """
     try:
-        batteries = Battery.query.join(Customer).all()
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow([
-            'Battery ID', 'Customer Name', 'Mobile', 'Battery Type', 
-            'Voltage', 'Capacity', 'Status', 'Inward Date', 
-            'Service Price', 'Last Updated'
-        ])
-        
-        # Write data
-        for battery in batteries:
-            last_update = battery.status_history[-1].updated_at if battery.status_history else battery.inward_date
-            writer.writerow([
-                battery.battery_id,
-                battery.customer.name,
-                battery.customer.mobile,
-                battery.battery_type,
-                battery.voltage,
-                battery.capacity,
-                battery.status,
-                battery.inward_date.strftime('%Y-%m-%d %H:%M'),
-                battery.service_price,
-                last_update.strftime('%Y-%m-%d %H:%M')
-            ])
-        
-        output.seek(0)
-        
-        response = make_response(output.getvalue())
-        response.headers['Content-Disposition'] = f'attachment; filename=battery_records_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        response.headers['Content-type'] = 'text/csv'
-        
-        return response
-        
-    except Exception as e:
-        flash(f'Error exporting data: {str(e)}', 'error')
+        statuses = [status for value in request.args.getlist('status') for status in value.split(',') if status]
+        range_from_args(request.args)
+    except ValueError as e:
+        flash(f'Error exporting data: invalid filter ({str(e)})', 'error')
         return redirect(url_for('main.dashboard'))
+    
+    params = {
+        'statuses': statuses,
+        'range': {key: request.args[key] for key in ['from', 'to', 'month', 'year'] if request.args.get(key)},
+        'gzip': request.args.get('gzip') == '1',
+        'requested_at': datetime.now().strftime('%Y%m%d_%H%M%S'),
+    }
+    return _start_job('battery_csv', params)
 
 @main_bp.route('/battery/<int:battery_id>/details')
 @login_required
@@ -365,7 +387,9 @@ def mark_battery_delivered(battery_id):
     comments = request.form.get('comments', '')
     
     try:
+        before = battery_snapshot(battery)
         battery.status = 'Delivered' if delivery_type == 'delivered' else 'Returned'
+        record_transition(before, battery)
         
         # Add status history
         status_history = BatteryStatusHistory()
@@ -405,7 +429,9 @@ def deliver_and_bill(battery_id):
     comments = request.form.get('comments', '')
     
     try:
+        before = battery_snapshot(battery)
         battery.status = 'Delivered' if delivery_type == 'delivered' else 'Returned'
+        record_transition(before, battery)
         
         # Add status history
         status_history = BatteryStatusHistory()
@@ -434,7 +460,7 @@ def delivered_batteries():
         return redirect(url_for('main.dashboard'))
     
     # Get all delivered and returned batteries (excluding not repairable)
-    batteries = Battery.query.filter(Battery.status.in_(['Delivered', 'Returned'])).order_by(Battery.inward_date.desc()).all()
+    batteries = Battery.query.options(*NOTE_COUNTS).filter(Battery.status.in_(['Delivered', 'Returned'])).order_by(Battery.inward_date.desc()).all()
     
     return render_template('delivered_batteries.html', batteries=batteries)
 
@@ -446,7 +472,7 @@ def not_repairable_batteries():
         return redirect(url_for('main.dashboard'))
     
     # Get all not repairable batteries
-    batteries = Battery.query.filter_by(status='Not Repairable').order_by(Battery.inward_date.desc()).all()
+    batteries = Battery.query.options(*NOTE_COUNTS).filter_by(status='Not Repairable').order_by(Battery.inward_date.desc()).all()
     
     return render_template('not_repairable_batteries.html', batteries=batteries)
 
@@ -502,8 +528,10 @@ def reopen_for_warranty(battery_id):
     try:
         # Change status back to Pending for re-work
         old_status = battery.status
+        before = battery_snapshot(battery)
         battery.status = 'Pending'
         db.session.add(battery)
+        record_transition(before, battery)
         
         # Add status history
         status_history = BatteryStatusHistory()
@@ -540,7 +568,7 @@ def all_batteries():
     page = request.args.get('page', 1, type=int)
     status_filter = request.args.get('status', '')
     
-    query = Battery.query.join(Customer)
+    query = Battery.query.join(Customer).options(*JOINED_CUSTOMER)
     
     if status_filter:
         query = query.filter(Battery.status == status_filter)
@@ -560,6 +588,7 @@ def all_batteries():
 
 @main_bp.route('/all_bills')
 @login_required
+@read_replica
 def all_bills():
     if current_user.role not in ['shop_staff', 'admin']:
         flash('Access denied. Only staff and admin can view all bills.', 'error')
@@ -569,7 +598,7 @@ def all_bills():
     page = request.args.get('page', 1, type=int)
     status_filter = request.args.get('status', '')
     
-    query = Battery.query.join(Customer).filter(Battery.service_price > 0)
+    query = Battery.query.join(Customer).options(*JOINED_CUSTOMER).filter(Battery.service_price > 0)
     
     if status_filter:
         query = query.filter(Battery.status == status_filter)
@@ -635,6 +664,7 @@ def admin_add_user():
             if password:
                 user.password_hash = generate_password_hash(password)
             db.session.add(user)
+            reference_cache.invalidate_on_commit(db.session, 'users')
             db.session.commit()
             flash(f'User {username} created successfully.', 'success')
             return redirect(url_for('main.admin_users'))
@@ -658,6 +688,7 @@ def admin_toggle_user(user_id):
     
     user.active = not user.active
     try:
+        reference_cache.invalidate_on_commit(db.session, 'users')
         db.session.commit()
         status = 'activated' if user.active else 'deactivated'
         flash(f'User {user.username} has been {status}.', 'success')
@@ -667,6 +698,26 @@ def admin_toggle_user(user_id):
     
     return redirect(url_for('main.admin_users'))
 
+@main_bp.route('/admin/perf', methods=['GET', 'POST'])
+@login_required
+def admin_perf():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+
+    if request.method == 'POST':
+        request_profiler.reset()
+        flash('Performance statistics cleared for this worker.', 'success')
+        return redirect(url_for('main.admin_perf'))
+
+    return render_template('admin/perf.html',
+                         endpoints=request_profiler.endpoint_stats(),
+                         slow_queries=request_profiler.recent_slow_queries(),
+                         started_at=request_profiler.started_at,
+                         worker_pid=os.getpid(),
+                         window=PERF_WINDOW,
+                         slow_query_ms=PERF_SLOW_QUERY_MS)
+
 @main_bp.route('/admin/settings', methods=['GET', 'POST'])
 @login_required
 def admin_settings():
@@ -700,6 +751,14 @@ def admin_settings():
     
     return render_template('admin/settings.html', settings=settings)
 
+@main_bp.route('/admin/cache_stats')
+@login_required
+def admin_cache_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    return jsonify(dict(reference_cache.stats(), fragments=fragment_cache.stats()))
+
 @main_bp.route('/admin/backup')
 @login_required
 def admin_backup():
@@ -707,81 +766,16 @@ def admin_backup():
         flash('Access denied. Admin or staff access required.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    try:
-        # Create comprehensive backup data
-        backup_data = {
-            'timestamp': datetime.now().isoformat(),
-            'users': [],
-            'customers': [],
-            'batteries': [],
-            'status_history': [],
-            'settings': []
-        }
-        
-        # Export users (without passwords for security)
-        for user in User.query.all():
-            backup_data['users'].append({
-                'username': user.username,
-                'full_name': user.full_name,
-                'role': user.role,
-                'created_at': user.created_at.isoformat() if user.created_at else None,
-                'is_active': user.is_active
-            })
-        
-        # Export customers
-        for customer in Customer.query.all():
-            backup_data['customers'].append({
-                'id': customer.id,
-                'name': customer.name,
-                'mobile': customer.mobile,
-                'created_at': customer.created_at.isoformat() if customer.created_at else None
-            })
-        
-        # Export batteries
-        for battery in Battery.query.all():
-            backup_data['batteries'].append({
-                'id': battery.id,
-                'battery_id': battery.battery_id,
-                'customer_id': battery.customer_id,
-                'battery_type': battery.battery_type,
-                'voltage': battery.voltage,
-                'capacity': battery.capacity,
-                'status': battery.status,
-                'inward_date': battery.inward_date.isoformat() if battery.inward_date else None,
-                'service_price': battery.service_price
-            })
-        
-        # Export status history
-        for history in BatteryStatusHistory.query.all():
-            backup_data['status_history'].append({
-                'id': history.id,
-                'battery_id': history.battery_id,
-                'status': history.status,
-                'comments': history.comments,
-                'updated_by': history.updated_by,
-                'updated_at': history.updated_at.isoformat() if history.updated_at else None
-            })
-        
-        # Export settings
-        for setting in SystemSettings.query.all():
-            backup_data['settings'].append({
-                'setting_key': setting.setting_key,
-                'setting_value': setting.setting_value,
-                'updated_at': setting.updated_at.isoformat() if setting.updated_at else None
-            })
-        
-        # Create JSON response
-        backup_json = json.dumps(backup_data, indent=2)
-        
-        response = make_response(backup_json)
-        response.headers['Content-Disposition'] = f'attachment; filename=battery_erp_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        response.headers['Content-Type'] = 'application/json'
-        
-        return response
-        
-    except Exception as e:
-        flash(f'Error creating backup: {str(e)}', 'error')
-        return redirect(url_for('main.dashboard'))
+    # ?since=<watermark of an earlier backup> downloads only the changes since then
+    since = None
+    if request.args.get('since'):
+        try:
+            since = datetime.fromisoformat(request.args['since'])
+        except ValueError:
+            flash('Invalid "since" watermark for an incremental backup.', 'error')
+            return redirect(url_for('main.dashboard'))
+    
+    return _start_job('backup', {'since': since.isoformat() if since else None})
 
 @main_bp.route('/admin/restore', methods=['GET', 'POST'])
 @login_required
@@ -800,111 +794,44 @@ def admin_restore():
             flash('No file selected.', 'error')
             return render_template('admin/restore.html')
         
-        if file and file.filename and file.filename.endswith('.json'):
-            try:
-                backup_data = json.loads(file.read().decode('utf-8'))
-                
-                # Clear existing data (be careful!)
-                confirm = request.form.get('confirm_restore')
-                if confirm != 'CONFIRM':
-                    flash('Please type "CONFIRM" to proceed with restore.', 'error')
-                    return render_template('admin/restore.html')
-                
-                # Implement actual restore functionality
-                try:
-                    # Backup current admin user before clearing data
-                    admin_user_backup = {
-                        'username': current_user.username,
-                        'password_hash': current_user.password_hash,
-                        'role': current_user.role,
-                        'full_name': current_user.full_name
-                    }
-                    
-                    # Clear existing data (preserve current admin)
-                    BatteryStatusHistory.query.delete()
-                    Battery.query.delete()
-                    Customer.query.delete()
-                    SystemSettings.query.delete()
-                    # Don't delete current admin user
-                    User.query.filter(User.id != current_user.id).delete()
-                    
-                    db.session.commit()
-                    
-                    # Restore customers
-                    customer_id_mapping = {}
-                    for customer_data in backup_data.get('customers', []):
-                        customer = Customer()
-                        customer.name = customer_data['name']
-                        customer.mobile = customer_data['mobile']
-                        if customer_data.get('created_at'):
-                            customer.created_at = datetime.fromisoformat(customer_data['created_at'])
-                        db.session.add(customer)
-                        db.session.flush()
-                        customer_id_mapping[customer_data['id']] = customer.id
-                    
-                    # Restore batteries
-                    battery_id_mapping = {}
-                    for battery_data in backup_data.get('batteries', []):
-                        battery = Battery()
-                        battery.battery_id = battery_data['battery_id']
-                        battery.customer_id = customer_id_mapping.get(battery_data['customer_id'])
-                        battery.battery_type = battery_data['battery_type']
-                        battery.voltage = battery_data['voltage']
-                        battery.capacity = battery_data['capacity']
-                        battery.status = battery_data['status']
-                        battery.service_price = battery_data.get('service_price', 0.0)
-                        if battery_data.get('inward_date'):
-                            battery.inward_date = datetime.fromisoformat(battery_data['inward_date'])
-                        db.session.add(battery)
-                        db.session.flush()
-                        battery_id_mapping[battery_data['id']] = battery.id
-                    
-                    # Restore users (except passwords)
-                    for user_data in backup_data.get('users', []):
-                        if user_data['username'] != current_user.username:  # Don't overwrite current admin
-                            user = User()
-                            user.username = user_data['username']
-                            user.full_name = user_data['full_name']
-                            user.role = user_data['role']
-                            user.password_hash = generate_password_hash('password123')
-                            user.active = user_data.get('is_active', True)
-                            if user_data.get('created_at'):
-                                user.created_at = datetime.fromisoformat(user_data['created_at'])
-                            db.session.add(user)
-                    
-                    # Restore status history
-                    for history_data in backup_data.get('status_history', []):
-                        if battery_id_mapping.get(history_data['battery_id']):
-                            history = BatteryStatusHistory()
-                            history.battery_id = battery_id_mapping[history_data['battery_id']]
-                            history.status = history_data['status']
-                            history.comments = history_data.get('comments', '')
-                            history.updated_by = current_user.id  # Assign to current admin
-                            if history_data.get('updated_at'):
-                                history.updated_at = datetime.fromisoformat(history_data['updated_at'])
-                            db.session.add(history)
-                    
-                    # Restore system settings
-                    for setting_data in backup_data.get('settings', []):
-                        setting = SystemSettings()
-                        setting.setting_key = setting_data['setting_key']
-                        setting.setting_value = setting_data['setting_value']
-                        if setting_data.get('updated_at'):
-                            setting.updated_at = datetime.fromisoformat(setting_data['updated_at'])
-                        db.session.add(setting)
-                    
-                    db.session.commit()
-                    flash('Data restored successfully! Note: Restored user passwords have been reset to "password123".', 'success')
-                    return redirect(url_for('main.dashboard'))
-                    
-                except Exception as restore_error:
-                    db.session.rollback()
-                    flash(f'Error during restore: {str(restore_error)}', 'error')
-                
-            except Exception as e:
-                flash(f'Error reading backup file: {str(e)}', 'error')
-        else:
-            flash('Please upload a valid JSON backup file.', 'error')
+        if not file.filename.endswith(('.json', '.ndjson', '.gz')):
+            flash('Please upload a backup file (.ndjson.gz, or an older .json backup).', 'error')
+            return render_template('admin/restore.html')
+        
+        dry_run = request.form.get('dry_run') == '1'
+        if not dry_run and request.form.get('confirm_restore') != 'CONFIRM':
+            flash('Please type "CONFIRM" to proceed with restore.', 'error')
+            return render_template('admin/restore.html')
+        
+        # The restoring admin keeps their login, everyone else's password is reset
+        keep_user = {
+            'username': current_user.username,
+            'password_hash': db.session.get(User, current_user.id).password_hash,
+            'role': current_user.role,
+            'full_name': current_user.full_name
+        }
+        try:
+            report = restore_backup(None if dry_run else db.session.connection(), file.stream,
+                                    dry_run=dry_run, keep_user=keep_user)
+            if dry_run:
+                flash(f'Backup is valid ({report.format}). {report.summary()} Nothing was changed.', 'success')
+                return render_template('admin/restore.html', report=report)
+            
+            finish_restore()
+            db.session.commit()
+            battery_ids.discard()
+            if report.kept_user_id is not None and report.kept_user_id != current_user.id:
+                login_user(User.query.get(report.kept_user_id))
+            flash(f'Data restored successfully! {report.summary()} '
+                  f'Note: Restored user passwords have been reset to "{RESET_PASSWORD}".', 'success')
+            return redirect(url_for('main.dashboard'))
+        
+        except RestoreError as e:
+            db.session.rollback()
+            flash(f'Backup rejected, nothing was changed: {str(e)}', 'error')
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error during restore: {str(e)}', 'error')
     
     return render_template('admin/restore.html')
 
@@ -927,120 +854,150 @@ def finished_batteries():
     # Check if we need to open a bill automatically
     open_bill_id = request.args.get('open_bill')
     
-    finished = Battery.query.filter_by(status='Ready').order_by(Battery.inward_date.desc()).all()
+    finished = Battery.query.options(*NOTE_COUNTS).filter_by(status='Ready').order_by(Battery.inward_date.desc()).all()
     return render_template('finished_batteries.html', batteries=finished, open_bill_id=open_bill_id)
 
 @main_bp.route('/reports/monthly')
 @login_required
+@read_replica
 def monthly_report():
-    from sqlalchemy import func, extract
-    
     # Get current month data
     current_month = datetime.now().month
     current_year = datetime.now().year
     
-    monthly_batteries = Battery.query.filter(
-        extract('month', Battery.inward_date) == current_month,
-        extract('year', Battery.inward_date) == current_year
+    monthly_batteries = Battery.query.options(*CUSTOMER).filter(
+        in_range(Battery.inward_date, month_range(current_year, current_month))
     ).all()
     
-    monthly_completed = Battery.query.filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        extract('month', Battery.inward_date) == current_month,
-        extract('year', Battery.inward_date) == current_year
-    ).count()
-    
-    # Calculate revenue from delivered/returned batteries including pickup charges
-    monthly_service_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        extract('month', Battery.inward_date) == current_month,
-        extract('year', Battery.inward_date) == current_year
-    ).scalar() or 0
-    
-    monthly_pickup_revenue = db.session.query(func.sum(Battery.pickup_charge)).filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        Battery.is_pickup == True,
-        extract('month', Battery.inward_date) == current_month,
-        extract('year', Battery.inward_date) == current_year
-    ).scalar() or 0
-    
-    monthly_revenue = monthly_service_revenue + monthly_pickup_revenue
+    # Completed count and revenue (including pickup charges) come from the monthly rollup
+    totals = get_month_totals(current_year, current_month)
     
     return render_template('reports/monthly.html', 
                          batteries=monthly_batteries,
-                         completed_count=monthly_completed,
-                         total_revenue=float(monthly_revenue),
+                         completed_count=totals['completed_count'],
+                         total_revenue=totals['revenue'],
                          month_name=datetime.now().strftime('%B %Y'))
 
 @main_bp.route('/reports/yearly')
 @login_required
+@read_replica
 def yearly_report():
-    from sqlalchemy import func, extract
-    
     # Get current year data
     current_year = datetime.now().year
     
-    yearly_batteries = Battery.query.filter(
-        extract('year', Battery.inward_date) == current_year
-    ).all()
+    # The full list is a background download (main.yearly_report_download)
+    yearly_batteries = Battery.query.options(*CUSTOMER).filter(
+        in_range(Battery.inward_date, year_range(current_year))
+    ).order_by(Battery.inward_date.desc()).limit(YEARLY_REPORT_ROWS).all()
     
-    yearly_completed = Battery.query.filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        extract('year', Battery.inward_date) == current_year
-    ).count()
-    
-    # Calculate yearly revenue from delivered/returned batteries including pickup charges
-    yearly_service_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        extract('year', Battery.inward_date) == current_year
-    ).scalar() or 0
-    
-    yearly_pickup_revenue = db.session.query(func.sum(Battery.pickup_charge)).filter(
-        Battery.status.in_(['Delivered', 'Returned']),
-        Battery.is_pickup == True,
-        extract('year', Battery.inward_date) == current_year
-    ).scalar() or 0
-    
-    yearly_revenue = yearly_service_revenue + yearly_pickup_revenue
-    
-    # Get monthly breakdown
-    monthly_breakdown = []
-    for month in range(1, 13):
-        # Calculate monthly revenue from delivered/returned batteries including pickup charges
-        month_service_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-            Battery.status.in_(['Delivered', 'Returned']),
-            extract('month', Battery.inward_date) == month,
-            extract('year', Battery.inward_date) == current_year
-        ).scalar() or 0
-        
-        month_pickup_revenue = db.session.query(func.sum(Battery.pickup_charge)).filter(
-            Battery.status.in_(['Delivered', 'Returned']),
-            Battery.is_pickup == True,
-            extract('month', Battery.inward_date) == month,
-            extract('year', Battery.inward_date) == current_year
-        ).scalar() or 0
-        
-        month_revenue = month_service_revenue + month_pickup_revenue
-        
-        month_count = Battery.query.filter(
-            Battery.status.in_(['Delivered', 'Returned']),
-            extract('month', Battery.inward_date) == month,
-            extract('year', Battery.inward_date) == current_year
-        ).count()
-        
-        monthly_breakdown.append({
-            'month': datetime(current_year, month, 1).strftime('%B'),
-            'revenue': float(month_revenue),
-            'count': month_count
-        })
+    # Yearly totals and the monthly breakdown come from the twelve monthly rollups
+    totals, monthly_breakdown = get_year_breakdown(current_year)
     
     return render_template('reports/yearly.html', 
                          batteries=yearly_batteries,
-                         completed_count=yearly_completed,
-                         total_revenue=float(yearly_revenue),
+                         battery_count=totals['count'],
+                         completed_count=totals['completed_count'],
+                         total_revenue=totals['revenue'],
                          year=current_year,
                          monthly_breakdown=monthly_breakdown)
 
+@main_bp.route('/reports/yearly/download')
+@login_required
+def yearly_report_download():
+    year = request.args.get('year', type=int) or datetime.now().year
+    return _start_job('yearly_report', {'year': year})
+
+# BACKGROUND JOBS
+
+def _start_job(kind, params):
+    """Queue a job for the current user and send them to its status page"""
+    try:
+        job = enqueue_job(kind, params, current_user.id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error starting {kind.replace("_", " ")}: {str(e)}', 'error')
+        return redirect(url_for('main.dashboard'))
+    return redirect(url_for('main.job_status', job_id=job.id))
+
+def _get_job(job_id):
+    """The job, if the current user may see it (admins see every job)"""
+    job = BackgroundJob.query.get_or_404(job_id)
+    if job.created_by != current_user.id and current_user.role != 'admin':
+        return None
+    return job
+
+def _job_json(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'wait_seconds': job.wait_seconds,
+        'run_seconds': job.run_seconds,
+        'artifact_size': job.artifact_size,
+        'download_url': url_for('main.job_download', job_id=job.id) if job.status == 'done' else None,
+    }
+
+@main_bp.route('/jobs')
+@login_required
+def jobs():
+    query = BackgroundJob.query.options(*JOB_CREATOR)
+    if current_user.role != 'admin':
+        query = query.filter_by(created_by=current_user.id)
+    recent_jobs = query.order_by(BackgroundJob.created_at.desc()).limit(50).all()
+    return render_template('jobs.html', jobs=recent_jobs, job_label=job_label)
+
+@main_bp.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
+    return render_template('job_status.html', job=job, label=job_label(job))
+
+@main_bp.route('/jobs/<int:job_id>/status')
+@login_required
+def job_status_json(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Access denied'}), 403
+    return jsonify(_job_json(job))
+
+@main_bp.route('/jobs/<int:job_id>/download')
+@login_required
+def job_download(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
+    if job.status != 'done' or not job.artifact_path or not os.path.exists(job.artifact_path):
+        flash('This file is not available (still running, failed, or already cleaned up).', 'error')
+        return redirect(url_for('main.job_status', job_id=job.id))
+    return send_file(job.artifact_path, mimetype=job.mimetype, as_attachment=True,
+                     download_name=job.artifact_name)
+
+@main_bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def job_cancel(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
+    try:
+        if cancel_job(job.id):
+            flash('The job is being cancelled.', 'success')
+        else:
+            flash('The job has already finished.', 'error')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error cancelling job: {str(e)}', 'error')
+    return redirect(url_for('main.job_status', job_id=job.id))
+
 # INVENTORY MANAGEMENT ROUTES
 
 @main_bp.route('/inventory/dashboard')
@@ -1058,7 +1015,7 @@ def inventory_dashboard():
     ).count()
     
     # Get recent transactions
-    recent_transactions = StockTransaction.query.order_by(StockTransaction.created_at.desc()).limit(10).all()
+    recent_transactions = StockTransaction.query.options(*TRANSACTION_DETAILS).order_by(StockTransaction.created_at.desc()).limit(10).all()
     
     # Get categories and their stock values
     categories = db.session.query(
@@ -1079,7 +1036,7 @@ def inventory_items():
         flash('Access denied. This feature is only available to shop staff and admin.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    items = InventoryItem.query.filter_by(active=True).order_by(InventoryItem.item_name).all()
+    items = InventoryItem.active_items()
     return render_template('inventory/items.html', items=items)
 
 @main_bp.route('/inventory/add_item', methods=['GET', 'POST'])
@@ -1102,6 +1059,7 @@ def add_inventory_item():
         
         try:
             db.session.add(item)
+            reference_cache.invalidate_on_commit(db.session, 'inventory_items')
             db.session.commit()
             flash(f'Inventory item {item.item_name} added successfully!', 'success')
             return redirect(url_for('main.inventory_items'))
@@ -1143,6 +1101,7 @@ def purchase_materials():
         
         try:
             db.session.add(transaction)
+            reference_cache.invalidate_on_commit(db.session, 'inventory_items')
             db.session.commit()
             flash(f'Purchase recorded successfully! Stock updated for {item.item_name}', 'success')
             return redirect(url_for('main.inventory_items'))
@@ -1150,7 +1109,7 @@ def purchase_materials():
             db.session.rollback()
             flash(f'Error recording purchase: {str(e)}', 'error')
     
-    items = InventoryItem.query.filter_by(active=True).order_by(InventoryItem.item_name).all()
+    items = InventoryItem.active_items()
     return render_template('inventory/purchase.html', items=items)
 
 @main_bp.route('/inventory/transactions')
@@ -1160,7 +1119,7 @@ def stock_transactions():
         flash('Access denied. This feature is only available to shop staff and admin.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    transactions = StockTransaction.query.order_by(StockTransaction.created_at.desc()).all()
+    transactions = StockTransaction.query.options(*TRANSACTION_DETAILS).order_by(StockTransaction.created_at.desc()).all()
     return render_template('inventory/transactions.html', transactions=transactions)
 
 @main_bp.route('/inventory/use_material', methods=['POST'])
@@ -1211,6 +1170,9 @@ def use_material():
     try:
         db.session.add(usage)
         db.session.add(transaction)
+        reference_cache.invalidate_on_commit(db.session, 'inventory_items')
+        count_on_commit(db.session, MATERIAL_USAGE)
+        count_on_commit(db.session, MATERIAL_QUANTITY, quantity, unit=item.unit)
         db.session.commit()
         flash(f'Material usage recorded: {quantity} {item.unit} of {item.item_name}', 'success')
     except Exception as e:
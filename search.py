@@ -0,0 +1,256 @@
+"""
+Indexed battery search behind /search and the technician panel.
+
+Exact battery IDs and mobile numbers are answered straight from their B-tree
+indexes. Everything else goes to a ranked substring search over battery IDs,
+customer names and mobiles, staff notes and status history comments:
+
+* PostgreSQL: ILIKE '%q%' served by pg_trgm GIN indexes, ranked by similarity().
+* SQLite: an FTS5 trigram shadow table (battery_search, rowid = battery.id)
+  kept current by triggers in the same transaction as every write, ranked by bm25().
+  Queries of one or two characters, too short for a trigram MATCH, scan its
+  columns with LIKE and list the newest batteries first.
+
+Results are always capped at a hard limit.
+"""
+import logging
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, union_all, func, or_, text, bindparam
+from app import db
+from models import Battery, Customer, BatteryStaffNote, BatteryStatusHistory, normalize_mobile
+
+SEARCH_RESULT_LIMIT = 50
+
+TRIGRAM_INDEXES = [
+    ('ix_battery_battery_id_trgm', 'battery', 'battery_id'),
+    ('ix_customer_name_trgm', 'customer', 'name'),
+    ('ix_customer_mobile_trgm', 'customer', 'mobile'),
+    ('ix_battery_staff_note_note_trgm', 'battery_staff_note', 'note'),
+    ('ix_battery_status_history_comments_trgm', 'battery_status_history', 'comments'),
+]
+
+SEARCH_COLUMNS = ['battery_code', 'customer_name', 'mobile', 'notes', 'comments']
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS battery_search USING fts5(
+        battery_code, customer_name, mobile, notes, comments, tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_battery_insert AFTER INSERT ON battery BEGIN
+        INSERT INTO battery_search(rowid, battery_code, customer_name, mobile, notes, comments)
+        SELECT NEW.id, NEW.battery_id, customer.name,
+               customer.mobile || ' ' || coalesce(customer.mobile_secondary, ''), '', ''
+        FROM customer WHERE customer.id = NEW.customer_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_battery_update AFTER UPDATE OF battery_id, customer_id ON battery BEGIN
+        UPDATE battery_search SET battery_code = NEW.battery_id,
+            customer_name = (SELECT name FROM customer WHERE id = NEW.customer_id),
+            mobile = (SELECT mobile || ' ' || coalesce(mobile_secondary, '') FROM customer WHERE id = NEW.customer_id)
+        WHERE rowid = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_battery_delete AFTER DELETE ON battery BEGIN
+        DELETE FROM battery_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_customer_update AFTER UPDATE OF name, mobile, mobile_secondary ON customer BEGIN
+        UPDATE battery_search SET customer_name = NEW.name,
+            mobile = NEW.mobile || ' ' || coalesce(NEW.mobile_secondary, '')
+        WHERE rowid IN (SELECT id FROM battery WHERE customer_id = NEW.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_note_insert AFTER INSERT ON battery_staff_note BEGIN
+        UPDATE battery_search SET notes = notes || ' ' || NEW.note WHERE rowid = NEW.battery_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS battery_search_history_insert AFTER INSERT ON battery_status_history
+    WHEN coalesce(NEW.comments, '') != '' BEGIN
+        UPDATE battery_search SET comments = comments || ' ' || NEW.comments WHERE rowid = NEW.battery_id;
+    END""",
+]
+
+SQLITE_SEARCH_ROWS = """INSERT OR REPLACE INTO battery_search(rowid, battery_code, customer_name, mobile, notes, comments)
+    SELECT battery.id, battery.battery_id, customer.name,
+           customer.mobile || ' ' || coalesce(customer.mobile_secondary, ''),
+           coalesce((SELECT group_concat(note, ' ') FROM battery_staff_note
+                     WHERE battery_staff_note.battery_id = battery.id), ''),
+           coalesce((SELECT group_concat(comments, ' ') FROM battery_status_history
+                     WHERE battery_status_history.battery_id = battery.id), '')
+    FROM battery JOIN customer ON customer.id = battery.customer_id"""
+
+SQLITE_REBUILD = ["DELETE FROM battery_search", SQLITE_SEARCH_ROWS]
+
+
+def sqlite_search_rows(after_id, upto_id=None):
+    """Copy batteries with after_id < id <= upto_id into the SQLite search table"""
+    statement = SQLITE_SEARCH_ROWS + ' WHERE battery.id > :after_id'
+    if upto_id is not None:
+        statement += ' AND battery.id <= :upto_id'
+    return text(statement).bindparams(after_id=after_id, **({'upto_id': upto_id} if upto_id is not None else {}))
+
+
+def ensure_search_backend(engine=None):
+    """Create the trigram indexes (PostgreSQL) or FTS5 shadow table (SQLite)"""
+    engine = engine or db.engine
+    dialect = engine.dialect.name
+    with engine.begin() as connection:
+        if dialect == 'postgresql':
+            try:
+                with connection.begin_nested():
+                    connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            except Exception as e:
+                logging.error(f'pg_trgm is not available, search will not use trigram indexes: {e}')
+                return
+            for name, table, column in TRIGRAM_INDEXES:
+                connection.exec_driver_sql(
+                    f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)'
+                )
+        elif dialect == 'sqlite':
+            exists = connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'battery_search'"
+            ).first()
+            for statement in SQLITE_SEARCH_DDL:
+                connection.exec_driver_sql(statement)
+            if not exists:
+                for statement in SQLITE_REBUILD:
+                    connection.exec_driver_sql(statement)
+
+
+SQLITE_TRIGGERS = ['battery_search_battery_insert', 'battery_search_battery_update', 'battery_search_battery_delete',
+                   'battery_search_customer_update', 'battery_search_note_insert', 'battery_search_history_insert']
+
+
+def suspend_search_triggers(connection):
+    """Stop maintaining the SQLite search table row by row (bulk loads)"""
+    if connection.dialect.name != 'sqlite':
+        return
+    for trigger in SQLITE_TRIGGERS:
+        connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {trigger}')
+
+
+def resume_search_triggers(connection):
+    """Recreate the SQLite search triggers and rebuild the table in one pass"""
+    if connection.dialect.name != 'sqlite':
+        return
+    for statement in SQLITE_SEARCH_DDL + SQLITE_REBUILD:
+        connection.exec_driver_sql(statement)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _ordered(ids, statuses, options):
+    """Load batteries by primary key, keeping the ranked order"""
+    if not ids:
+        return []
+    query = Battery.query.options(*options).filter(Battery.id.in_(ids))
+    if statuses:
+        query = query.filter(Battery.status.in_(statuses))
+    by_id = {battery.id: battery for battery in query.all()}
+    return [by_id[battery_pk] for battery_pk in ids if battery_pk in by_id]
+
+
+def _exact_matches(q, statuses, limit, options):
+    """Exact battery ID or mobile number, answered from the unique/B-tree indexes"""
+    query = Battery.query.options(*options).filter(Battery.battery_id.in_({q, q.upper()}))
+    if statuses:
+        query = query.filter(Battery.status.in_(statuses))
+    batteries = query.all()
+    if batteries:
+        return batteries
+
+    digits = q.replace(' ', '').replace('-', '').lstrip('+')
+    if digits.isdigit() and len(digits) >= 10:
+        query = Battery.query.options(*options).join(Customer).filter(Customer.mobile_normalized == normalize_mobile(digits))
+        if statuses:
+            query = query.filter(Battery.status.in_(statuses))
+        return query.order_by(Battery.inward_date.desc()).limit(limit).all()
+    return []
+
+
+def _postgres_matches(q, statuses, limit, options):
+    pattern = f'%{_escape_like(q)}%'
+    candidates = union_all(
+        select(Battery.id.label('battery_pk'), (func.similarity(Battery.battery_id, q) + 1.0).label('score'))
+            .where(Battery.battery_id.ilike(pattern, escape='\\')),
+        select(Battery.id, func.greatest(func.similarity(Customer.name, q), func.similarity(Customer.mobile, q)))
+            .join(Customer, Customer.id == Battery.customer_id)
+            .where(or_(Customer.name.ilike(pattern, escape='\\'), Customer.mobile.ilike(pattern, escape='\\'))),
+        select(BatteryStaffNote.battery_id, func.similarity(BatteryStaffNote.note, q) * 0.5)
+            .where(BatteryStaffNote.note.ilike(pattern, escape='\\')),
+        select(BatteryStatusHistory.battery_id, func.similarity(BatteryStatusHistory.comments, q) * 0.5)
+            .where(BatteryStatusHistory.comments.ilike(pattern, escape='\\')),
+    ).subquery()
+    ranked = select(candidates.c.battery_pk, func.max(candidates.c.score).label('score')) \
+        .group_by(candidates.c.battery_pk).subquery()
+    query = select(Battery.id).join(ranked, ranked.c.battery_pk == Battery.id)
+    if statuses:
+        query = query.where(Battery.status.in_(statuses))
+    query = query.order_by(ranked.c.score.desc(), Battery.inward_date.desc()).limit(limit)
+    return _ordered(db.session.execute(query).scalars().all(), statuses, options)
+
+
+def _sqlite_matches(q, statuses, limit, options):
+    status_filter = 'AND battery.status IN :statuses' if statuses else ''
+    if len(q) >= 3:
+        # Trigram MATCH needs at least three characters; quote it as a phrase
+        condition = 'battery_search MATCH :q'
+        order = 'bm25(battery_search, 10.0, 5.0, 5.0, 1.0, 1.0), battery.inward_date DESC'
+        params = {'q': '"' + q.replace('"', '""') + '"'}
+    else:
+        # Shorter queries scan the indexed text; without a MATCH there is no bm25() rank
+        condition = '(' + ' OR '.join(f"battery_search.{column} LIKE :q ESCAPE '\\'" for column in SEARCH_COLUMNS) + ')'
+        order = 'battery.inward_date DESC'
+        params = {'q': f'%{_escape_like(q)}%'}
+    statement = text(f"""
+        SELECT battery.id FROM battery_search JOIN battery ON battery.id = battery_search.rowid
+        WHERE {condition} {status_filter}
+        ORDER BY {order}
+        LIMIT :limit
+    """)
+    if statuses:
+        statement = statement.bindparams(bindparam('statuses', expanding=True))
+        params['statuses'] = list(statuses)
+    params['limit'] = limit
+    return _ordered(db.session.execute(statement, params).scalars().all(), statuses, options)
+
+
+def _fallback_matches(q, statuses, limit, options):
+    pattern = f'%{_escape_like(q)}%'
+    query = Battery.query.options(*options).join(Customer).filter(or_(
+        Battery.battery_id.ilike(pattern, escape='\\'),
+        Customer.mobile.ilike(pattern, escape='\\'),
+        Customer.name.ilike(pattern, escape='\\')
+    ))
+    if statuses:
+        query = query.filter(Battery.status.in_(statuses))
+    return query.order_by(Battery.inward_date.desc()).limit(limit).all()
+
+
+def search_batteries(q, statuses=None, limit=SEARCH_RESULT_LIMIT, options=()):
+    """Ranked batteries matching q, optionally restricted to some statuses.
+
+    options are loader options for the returned batteries (see loading.py).
+    """
+    q = (q or '').strip()
+    if not q:
+        return []
+
+    exact = _exact_matches(q, statuses, limit, options)
+    if exact:
+        return exact
+
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return _postgres_matches(q, statuses, limit, options)
+    if dialect == 'sqlite':
+        return _sqlite_matches(q, statuses, limit, options)
+    return _fallback_matches(q, statuses, limit, options)
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Recreate the search indexes (and repopulate the SQLite shadow table)"""
+    ensure_search_backend()
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as connection:
+            for statement in SQLITE_REBUILD:
+                connection.exec_driver_sql(statement)
+    click.echo('Search index rebuilt.')